@@ -7,13 +7,15 @@ from functools import partial
 
 from typing import Optional, Iterable
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 from transformers import PretrainedConfig, set_seed
 from transformers.models.informer.modeling_informer import InformerMeanScaler, InformerStdScaler, InformerNOPScaler
 from datasets import concatenate_datasets
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import pdb
 from collections import Counter
 
@@ -31,6 +33,20 @@ def normalize_by_channel(example, field_name):
         example[field_name][row] = (row_values - min_value) / (np.max(row_values) - min_value)
     return example
 
+def normalize_all_batch(values):
+    # batched normalize_all, on a (B, C, T) array
+    min_values = values.min(axis=(1, 2), keepdims=True)
+    max_values = values.max(axis=(1, 2), keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - min_values) / (max_values - min_values)
+
+def normalize_by_channel_batch(values):
+    # batched normalize_by_channel, on a (B, C, T) array; channels without non-zero values become nan and are filtered out
+    min_values = np.where(values != 0, values, np.inf).min(axis=2, keepdims=True)
+    max_values = values.max(axis=2, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - min_values) / (max_values - min_values)
+
 def create_attention_mask(example):
     # create attention mask to ignore padding
     example["attention_mask"] = np.zeros_like(example["transposed_target"])
@@ -45,7 +61,33 @@ def masked_data_collator(mask_probability, cols_to_keep, data):
         if batch_key not in cols_to_keep:
             continue
         batch[batch_key] = torch.stack([torch.tensor(example[key]) for example in data]) if key != 'objid' else [example[key] for example in data]
+    return mask_batch(mask_probability, cols_to_keep, batch)
 
+def masked_batch_collator(mask_probability, cols_to_keep, data):
+    # same as masked_data_collator, for a whole batch read at once from a dataset in arrow format,
+    # with each field converted from one contiguous buffer, with the dtypes of the numpy format
+    batch = {}
+    for key in data.column_names:
+        batch_key = key if key not in ['values', 'observed_mask', 'time_features'] else f"past_{key}"
+        if batch_key not in cols_to_keep:
+            continue
+        if key == 'objid':
+            batch[batch_key] = data[key].to_pylist()
+            continue
+        if pa.types.is_list(data[key].type):
+            values = list_column_to_numpy(data[key])
+            if values is None:
+                raise ValueError(f"{key} holds sequences of different lengths, which cannot be batched")
+        else:
+            values = data[key].to_numpy()
+        if np.issubdtype(values.dtype, np.floating):
+            values = values.astype(np.float32)
+        elif np.issubdtype(values.dtype, np.integer):
+            values = values.astype(np.int64)
+        batch[batch_key] = torch.from_numpy(np.require(values, requirements=['C', 'W']))
+    return mask_batch(mask_probability, cols_to_keep, batch)
+
+def mask_batch(mask_probability, cols_to_keep, batch):
     labels = batch['past_values'][:, 0, :].clone() # only take flux values, should be [batch_size, 1, seq_len]
 
     masked_indices = torch.bernoulli(torch.full(labels.shape, mask_probability)).bool()#.squeeze()
@@ -87,12 +129,76 @@ def transform_raw_data_example(example):
     #     example = mask(example, config.mask_fraction if hasattr(config, "mask_fraction") else 0.5)
     return example
 
-def transform_raw_data(dataset):
+def list_column_to_numpy(column):
+    # (B, T, C) array of the values of a list<list<value>> arrow column, None if the lists have different lengths
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    rows = column.flatten()
+    if len(column) == 0:
+        return np.zeros((0, 0, 0))
+    row_lengths = pc.list_value_length(column).to_numpy(zero_copy_only=False)
+    value_lengths = pc.list_value_length(rows).to_numpy(zero_copy_only=False)
+    if (row_lengths != row_lengths[0]).any() or (value_lengths != value_lengths[0]).any():
+        return None
+    return rows.flatten().to_numpy(zero_copy_only=False).reshape(len(column), row_lengths[0], value_lengths[0])
+
+def numpy_to_list_column(values):
+    # list<list<value>> arrow column of a (B, C, T) array
+    n_rows, n_channels, length = values.shape
+    channels = pa.ListArray.from_arrays(pa.array(np.arange(n_rows * n_channels + 1, dtype=np.int32) * length),
+                                        pa.array(np.ascontiguousarray(values).reshape(-1)))
+    return pa.ListArray.from_arrays(pa.array(np.arange(n_rows + 1, dtype=np.int32) * n_channels), channels)
+
+def transform_raw_data_arrays(target, times_wv):
+    # batched transform_raw_data_example, on (B, T, C) arrays of light curves of the same length
+    transposed_target = np.asarray(target, dtype=np.float64).transpose(0, 2, 1)
+    transposed_times_wv = np.asarray(times_wv, dtype=np.float64).transpose(0, 2, 1)
+    # mask if time value is 0 (padding), before normalization
+    attention_mask = np.broadcast_to((transposed_times_wv[:, :1] != 0).astype(np.float64), transposed_target.shape)
+    return {
+        'transposed_target': normalize_all_batch(transposed_target),
+        'transposed_times_wv': normalize_by_channel_batch(transposed_times_wv),
+        'attention_mask': attention_mask,
+    }
+
+def transform_raw_data_batch(batch):
+    # batched transform_raw_data_example, on an arrow batch whose light curves are read as (B, T, C) arrays
+    target, times_wv = list_column_to_numpy(batch['target']), list_column_to_numpy(batch['times_wv'])
+    if target is None or times_wv is None:
+        # light curves of different lengths cannot be stacked, transform them one at a time as (1, T, C) arrays,
+        # so that channels without non-zero times become nan and are filtered out as in stacked batches
+        examples = [transform_raw_data_arrays([t], [w])
+                    for t, w in zip(batch['target'].to_pylist(), batch['times_wv'].to_pylist())]
+        columns = {key: pa.concat_arrays([numpy_to_list_column(example[key]) for example in examples])
+                   for key in examples[0]}
+    else:
+        columns = {key: numpy_to_list_column(values) for key, values in transform_raw_data_arrays(target, times_wv).items()}
+    # functions mapped on arrow batches return the whole table
+    for key, column in columns.items():
+        batch = batch.append_column(key, column)
+    return batch
+
+def has_nans(column):
+    # whether each row of a list<list<value>> arrow column holds a nan
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    rows = column.flatten()
+    values = rows.flatten().to_numpy(zero_copy_only=False)
+    # example of each value
+    parents = pc.list_parent_indices(column).to_numpy()[pc.list_parent_indices(rows).to_numpy()]
+    return np.bincount(parents[np.isnan(values)], minlength=len(column)) > 0
+
+def has_no_nans_batch(batch):
+    # batched nan filter, on an arrow batch
+    return ~(has_nans(batch['transposed_target']) | has_nans(batch['transposed_times_wv']))
+
+def transform_raw_data(dataset, num_proc: Optional[int] = None, batch_size: int = 1000):
     # normalize time, data; create attention mask
-    dataset = dataset.map(transform_raw_data_example)
+    # batches are read in arrow format, as the numpy format converts nested lists row by row
+    dataset = dataset.with_format('arrow').map(transform_raw_data_batch, batched=True, batch_size=batch_size, num_proc=num_proc)
     print(f"original dataset size: {len(dataset)}")
     # filter out nans
-    dataset = dataset.filter(lambda example: not np.isnan(example['transposed_target']).any() and not np.isnan(example['transposed_times_wv']).any())
+    dataset = dataset.filter(has_no_nans_batch, batched=True, batch_size=batch_size, num_proc=num_proc)
     print(f"remove nans dataset size: {len(dataset)}")
     # have to swap out these field names because can't change dataset field shapes in place
     dataset = dataset.remove_columns(["target", "times_wv"])
@@ -122,6 +228,8 @@ def create_test_dataloader_raw(
     compute_loss: Optional[bool] = False,
     has_labels: Optional[bool] = False,
     mask_probability: Optional[float] = 0.6,
+    num_workers: int = 0,
+    num_proc: Optional[int] = None,
     **kwargs,
 ):
     set_seed(seed)
@@ -139,15 +247,18 @@ def create_test_dataloader_raw(
     if add_objid:
         INPUT_NAMES.append("objid")
 
-    transformed_data = transform_raw_data(dataset)
+    transformed_data = transform_raw_data(dataset, num_proc=num_proc)
     transformed_data = transformed_data.shuffle(seed=seed).flatten_indices()
     mask_probability = 0. if has_labels else mask_probability# don't mask for fine-tuning
+    # whole batches are read from the dataset at once, as arrow tables
+    transformed_data = transformed_data.with_format('arrow')
     return DataLoader(
         transformed_data,
-        batch_size=batch_size,
-        # sampler=sampler,
-        num_workers=0,
-        collate_fn=partial(masked_data_collator, mask_probability, INPUT_NAMES)
+        batch_size=None,
+        sampler=BatchSampler(SequentialSampler(transformed_data), batch_size=batch_size, drop_last=False),
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        collate_fn=partial(masked_batch_collator, mask_probability, INPUT_NAMES)
     )
 
 def create_network_inputs(
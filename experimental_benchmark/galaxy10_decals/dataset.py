@@ -3,6 +3,7 @@ import datasets
 from datasets.arrow_dataset import Dataset as HF_Dataset  # for typing etc
 from lightning import LightningDataModule
 from torch.utils.data import DataLoader
+from mmu.benchmark.dataset_utils import batch_dataloader
 
 
 class GZ10Dataset(LightningDataModule):
@@ -37,24 +38,32 @@ class GZ10Dataset(LightningDataModule):
         pass
 
     def collate_fn(self, batch):
-        batch = torch.utils.data.default_collate(batch)
+        if isinstance(batch, list):
+            # Examples of a streamed dataset
+            batch = torch.utils.data.default_collate(batch)
         x = batch['rgb_image'] / 255.0
         y = batch['gz10_label']
         return x, y
 
-    def train_dataloader(self):
-        return DataLoader(
-            self.train_dataset, 
+    def _dataloader(self, dataset):
+        if self.hparams.streaming:
+            return DataLoader(
+                dataset, 
+                batch_size=self.hparams.batch_size, 
+                num_workers=self.hparams.num_workers, 
+                collate_fn=self.collate_fn
+            )
+        return batch_dataloader(
+            dataset, 
             batch_size=self.hparams.batch_size, 
             num_workers=self.hparams.num_workers, 
-            collate_fn=self.collate_fn
+            collate_fn=self.collate_fn,
+            pin_memory=torch.cuda.is_available()
         )
+
+    def train_dataloader(self):
+        return self._dataloader(self.train_dataset)
     
     def val_dataloader(self):
-        return DataLoader(
-            self.val_dataset, 
-            batch_size=self.hparams.batch_size, 
-            num_workers=self.hparams.num_workers, 
-            collate_fn=self.collate_fn
-        )    
+        return self._dataloader(self.val_dataset)    
     
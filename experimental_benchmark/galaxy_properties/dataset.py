@@ -2,7 +2,7 @@ import torch
 import datasets
 from typing import Any, Tuple
 from lightning import LightningDataModule
-from torch.utils.data import DataLoader
+from mmu.benchmark.dataset_utils import batch_dataloader
 
 
 class PROVABGSDataset(LightningDataModule):
@@ -59,8 +59,6 @@ class PROVABGSDataset(LightningDataModule):
         self.prop_mean = torch.stack([self.train_dataset[p].mean() for p in self.hparams.properties])
         
     def collate_fn(self, batch):
-        batch = torch.utils.data.default_collate(batch)
-
         # Get image and range compress
         if self.hparams.modality == 'image':
             x = batch['image']['array']
@@ -82,7 +80,7 @@ class PROVABGSDataset(LightningDataModule):
         return x, y
 
     def train_dataloader(self):
-        return DataLoader(
+        return batch_dataloader(
             self.train_dataset, 
             batch_size=self.hparams.batch_size, 
             num_workers=self.hparams.num_workers, 
@@ -93,7 +91,7 @@ class PROVABGSDataset(LightningDataModule):
         )
 
     def val_dataloader(self):
-        return DataLoader(
+        return batch_dataloader(
             self.test_dataset, 
             batch_size=self.hparams.batch_size, 
             num_workers=self.hparams.num_workers, 
@@ -33,7 +33,8 @@ class PROVABGSModel(L.LightningModule):
         y_hat = self(x)
         loss = F.huber_loss(y_hat, y)
         self.log('val_loss', loss, on_epoch=True, prog_bar=True)
-        return loss
+        # Returning the predictions so that evaluation callbacks don't run the model again
+        return {'loss': loss, 'preds': y_hat}
     
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.hparams.lr)
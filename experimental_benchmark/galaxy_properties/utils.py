@@ -1,8 +1,8 @@
 import seaborn as sns
 import matplotlib.pyplot as plt
-from sklearn.metrics import r2_score
 import lightning as L
-import numpy as np
+
+from mmu.benchmark.eval.metrics import RegressionMetrics, get_predictions
 
 
 class R2ScoreCallback(L.Callback):
@@ -13,25 +13,23 @@ class R2ScoreCallback(L.Callback):
     ):
         super().__init__()
         self.properties = properties
-        self.predictions = []
-        self.targets = []
+        self.metrics = RegressionMetrics(n_properties=len(properties))
 
-    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
         img, z = batch
         targets = z
-        preds = pl_module(img)
-        self.predictions.extend(preds.cpu().numpy())
-        self.targets.extend(targets.cpu().numpy())
+        preds = get_predictions(outputs)
+        if preds is None:
+            preds = pl_module(img)
+        self.metrics.update(preds, targets)
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        predictions = np.array(self.predictions)
-        targets = np.array(self.targets)
+        self.metrics.reduce(trainer.strategy)
+        metrics = self.metrics.compute()
 
         # Log the R^2 score for each property
-        for i in range(predictions.shape[1]):
-            r2 = r2_score(targets[:, i], predictions[:, i])
-            pl_module.log(f'{self.properties[i]} R^2', r2, on_epoch=True, prog_bar=True, logger=True)
+        for i, prop in enumerate(self.properties):
+            pl_module.log(f'{prop} R^2', float(metrics['r2'][i]), on_epoch=True, prog_bar=True, logger=True)
 
-        # Clear the lists for the next epoch
-        self.predictions = []
-        self.targets = []
\ No newline at end of file
+        # Clear the buffers for the next epoch
+        self.metrics.reset()
\ No newline at end of file
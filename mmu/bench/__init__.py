@@ -0,0 +1,2 @@
+from .fixtures import FIXTURES, build_fixture_dataset, write_fixture
+from .runner import bench_cross_match, bench_survey, compare, run
@@ -0,0 +1,21 @@
+import argparse
+
+from .fixtures import FIXTURES
+from .runner import _default_scripts_dir, main
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the survey builders on synthetic fixtures')
+    parser.add_argument('--output', type=str, default='bench.json', help='Path to the output JSON file')
+    parser.add_argument('--surveys', type=str, nargs='+', default=None, choices=sorted(FIXTURES), help='Surveys to benchmark, all by default')
+    parser.add_argument('--cross_match', type=str, nargs=2, default=['desi', 'ssl_legacysurvey'], help='Pair of surveys to cross-match')
+    parser.add_argument('--no_cross_match', action='store_true', help='Skip the cross-matching benchmark')
+    parser.add_argument('--scripts_dir', type=str, default=_default_scripts_dir, help='Directory of the survey builder scripts')
+    parser.add_argument('--n_cells', type=int, default=2, help='Number of healpix cells in each fixture')
+    parser.add_argument('--n_objects', type=int, default=32, help='Number of objects per healpix cell')
+    parser.add_argument('--repeats', type=int, default=1, help='Number of passes over the generator, the fastest one is reported')
+    parser.add_argument('--work_dir', type=str, default=None, help='Directory in which the temporary fixtures are written')
+    parser.add_argument('--compare', type=str, default=None, help='Results of a previous run to compare against')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,456 @@
+# Synthetic HDF5 fixtures following the schema of each survey builder in scripts/
+import os
+import shutil
+import typing as T
+from collections import namedtuple
+
+import h5py
+import numpy as np
+
+# Description of the fixture of a survey:
+# - config: name of the builder configuration to benchmark
+# - columns: function (module, ids, ra, dec, cell, rng) returning the content of the
+#   files of a healpix cell, see `write_fixture`
+# - layout: 'catalog' for one file per cell with one row per object, 'object' for one
+#   file per object, 'group' for one file per cell with one group per object
+# - id_dtype: dtype of the object ids, 'S' for byte strings
+Fixture = namedtuple('Fixture', ['config', 'columns', 'layout', 'id_dtype'], defaults=['catalog', 'S'])
+
+
+def _str(values, n=None):
+    values = [values] * n if n is not None else values
+    return np.array([v.encode('utf-8') if isinstance(v, str) else v for v in values], dtype='S')
+
+
+def _float(rng, *shape, dtype='float32'):
+    return rng.normal(size=shape).astype(dtype)
+
+
+def _value(rng, dtype, *shape):
+    """ Random data for a datasets.Value dtype """
+    if dtype == 'string':
+        return _str(['x' * 8] * int(np.prod(shape))).reshape(shape)
+    if dtype == 'bool':
+        return rng.integers(0, 2, size=shape).astype(bool)
+    if dtype.startswith('int'):
+        return rng.integers(0, 100, size=shape).astype(dtype)
+    return _float(rng, *shape, dtype=dtype)
+
+
+def _base(ids, ra, dec, cell):
+    return {'object_id': ids, 'ra': ra, 'dec': dec, 'healpix': np.full(len(ids), cell, dtype='int64')}
+
+
+def _mapping(id_key=None):
+    """ Catalogs whose columns are listed with their dtype in the `_mapping` of the builder """
+    def columns(m, ids, ra, dec, cell, rng):
+        data = {k: _value(rng, v, len(ids)) for k, v in m._mapping.items()}
+        data.update(_base(ids, ra, dec, cell))
+        if id_key is not None:
+            data[id_key] = ids
+        return data
+    return columns
+
+
+def _spectrum(rng, n, length, keys, prefix='spectrum_'):
+    data = {f'{prefix}{k}': _float(rng, n, length) for k in keys}
+    if f'{prefix}lambda' in data:
+        data[f'{prefix}lambda'] = np.tile(np.linspace(3600, 9800, length, dtype='float32'), (n, 1))
+    return data
+
+
+def _images(rng, n, bands, size, keys=('array', 'ivar', 'mask'), prefix='image_'):
+    data = {f'{prefix}{k}': _float(rng, n, len(bands), size, size) for k in keys}
+    if f'{prefix}mask' in data:
+        data[f'{prefix}mask'] = np.zeros((n, len(bands), size, size), dtype=bool)
+    data[f'{prefix}band'] = np.tile(_str([b.lower() for b in bands]), (n, 1))
+    data[f'{prefix}psf_fwhm'] = np.ones((n, len(bands)), dtype='float32')
+    data[f'{prefix}scale'] = np.full((n, len(bands)), 0.2, dtype='float32')
+    return data
+
+
+def _apogee(m, ids, ra, dec, cell, rng):
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, len(ids), 8575, ['flux', 'ivar', 'lsf_sigma', 'lambda', 'mask',
+                                                'pseudo_continuum_flux', 'pseudo_continuum_ivar']))
+    data.update({f: _float(rng, len(ids)) for f in m._FLOAT_FEATURES})
+    data.update({f: np.zeros(len(ids), dtype=bool) for f in m._BOOL_FEATURES})
+    return data
+
+
+def _btsbot(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['band'] = _str('r', n)
+    data['image_triplet'] = _float(rng, n, m.BTSbot._image_size, m.BTSbot._image_size, len(m.BTSbot._views))
+    data['image_scale'] = np.full(n, 1.01, dtype='float32')
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    data.update({f: rng.integers(0, 10, n) for f in m._INT_FEATURES if f != 'object_id'})
+    data.update({f: np.zeros(n, dtype=bool) for f in m._BOOL_FEATURES})
+    data.update({f: _str('x', n) for f in m._STRING_FEATURES})
+    return data
+
+
+def _ragged(rng, n, keys, min_length, max_length, dtype='float64'):
+    """ Group of ragged columns, with the flat values of each column and the offsets of the rows """
+    offsets = np.concatenate([[0], np.cumsum(rng.integers(min_length, max_length, n))])
+    group = {k: _float(rng, offsets[-1], dtype=dtype) for k in keys}
+    group['offsets'] = offsets
+    return group
+
+
+def _chandra(m, ids, ra, dec, cell, rng):
+    """ Binned spectra of variable length, stored as ragged columns of the `spectrum` group """
+    data = _base(ids, ra, dec, cell)
+    data['spectrum'] = _ragged(rng, len(ids), m._SPECTRUM_COLUMNS.values(), 16, 1024)
+    data.update({f: _float(rng, len(ids)) for f in m._FLOAT_FEATURES})
+    return data
+
+
+def _lightcurves(float_features, str_features, bands, length, key='flux'):
+    """ Supernova light curves, stored with one file per object """
+    def columns(m, ids, ra, dec, cell, rng):
+        objects = []
+        for object_id, r, d in zip(ids, ra, dec):
+            data = {
+                'object_id': np.bytes_(object_id), 'ra': r, 'dec': d, 'healpix': cell,
+                'time': _float(rng, len(bands), length),
+                key: _float(rng, len(bands), length),
+                f'{key}_err': np.abs(_float(rng, len(bands), length)),
+            }
+            data.update({f: np.float32(rng.normal()) for f in float_features})
+            data.update({f: np.bytes_(b'SNIa') for f in str_features if f != 'object_id'})
+            data['bands'] = np.bytes_(','.join(bands))
+            objects.append(data)
+        return objects
+    return columns
+
+
+def _cfa_like(float_features, str_features, bands, length):
+    """ CfA and CSP light curves, with the band names stored as an array """
+    def columns(m, ids, ra, dec, cell, rng):
+        objects = _lightcurves(float_features, str_features, bands, length, key='mag')(m, ids, ra, dec, cell, rng)
+        for data in objects:
+            data['bands'] = _str(bands)
+        return objects
+    return columns
+
+
+def _desi(m, ids, ra, dec, cell, rng):
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, len(ids), m.DESI._spectrum_length, ['flux', 'ivar', 'lsf_sigma', 'lambda', 'mask']))
+    data.update({f: _float(rng, len(ids)) for f in m._FLOAT_FEATURES})
+    data.update({f: np.zeros(len(ids), dtype='int64') for f in m._BOOL_FEATURES})
+    return data
+
+
+def _desi_provabgs(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['PROVABGS_MCMC'] = _float(rng, n, 100, 13)
+    data['PROVABGS_THETA_BF'] = _float(rng, n, 13)
+    data['PROVABGS_LOGMSTAR_BF'] = _float(rng, n)
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    return data
+
+
+def _gaia(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['source_id'] = ids
+    data.update({f: _float(rng, n, 55) for f in m._SPECTRUM_FEATURES})
+    for features in [m._PHOTOMETRY_FEATURES, m._ASTROMETRY_FEATURES, m._RV_FEATURES,
+                     m._GSPPHOT_FEATURES, m._FLAG_FEATURES, m._CORRECTION_FEATURES]:
+        data.update({f: _float(rng, n) for f in features if f not in data})
+    return data
+
+
+def _galah(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, n, 16384, ['flux', 'ivar', 'lsf_sigma', 'lambda', 'norm_flux', 'norm_ivar', 'norm_lambda']))
+    for b in 'BGRI':
+        data[f'spectrum_{b}_ind_start'] = np.zeros(n, dtype='int32')
+        data[f'spectrum_{b}_ind_end'] = np.full(n, 4096, dtype='int32')
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES if f not in data})
+    data.update({f: rng.integers(0, 2, n).astype('int32') for f in m._INT_FEATURES if f not in data})
+    return data
+
+
+def _gz10(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['ans'] = rng.integers(0, 10, n)
+    data['redshift'] = _float(rng, n)
+    data['images'] = rng.integers(0, 256, (n, m.GZ10._image_size, m.GZ10._image_size, 3), dtype='uint8')
+    data['pxscale'] = np.full(n, 0.262, dtype='float32')
+    return data
+
+
+def _hsc(m, ids, ra, dec, cell, rng):
+    data = _base(ids, ra, dec, cell)
+    data.update(_images(rng, len(ids), m.HSC._bands, m.HSC._image_size))
+    data.update({f: _float(rng, len(ids)) for f in m._FLOAT_FEATURES})
+    return data
+
+
+def _jwst(m, ids, ra, dec, cell, rng):
+    bands = m.CustomBuilderConfig(name='fixture').bands
+    data = _base(ids, ra, dec, cell)
+    data.update(_images(rng, len(ids), bands, 96, keys=('flux', 'ivar', 'mask')))
+    data.update({f: _float(rng, len(ids)) for f in m.JWST._float_features})
+    return data
+
+
+def _kepler(m, ids, ra, dec, cell, rng):
+    data = _base(ids, ra, dec, cell)
+    data['lightcurve'] = _ragged(rng, len(ids), m._LIGHTCURVE_COLUMNS, 1000, 4000)
+    return data
+
+
+def _lamost(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, n, 3700, ['flux', 'wavelength']))
+    for k, v in {**m._COMMON_FEATURES, **m._EXTRA_FEATURES['lrs_catalogue']}.items():
+        if k not in data:
+            data[k] = _value(rng, v, n)
+    return data
+
+
+def _legacysurvey(m, ids, ra, dec, cell, rng):
+    n, size = len(ids), m.DECaLS._image_size
+    data = _base(ids, ra, dec, cell)
+    data.update(_images(rng, n, m.DECaLS._bands, size, keys=('array', 'ivar')))
+    data['image_mask'] = np.zeros((n, size, size), dtype=bool)
+    for k in ['blobmodel', 'image_rgb']:
+        data[k] = rng.integers(0, 256, (n, size, size, 3), dtype='uint8')
+    data['object_mask'] = rng.integers(0, 2, (n, size, size), dtype='uint8')
+    data.update({f'catalog_{f}': _float(rng, n, 20) for f in m.CATALOG_FEATURES})
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    data['TYPE'] = _str('SER', n)
+    return data
+
+
+def _manga(m, ids, ra, dec, cell, rng):
+    length, size, n_spaxels = m.MaNGA._spectrum_size, m.MaNGA._image_size, 16
+    spaxel_dtype = np.dtype([('flux', 'f4', length), ('ivar', 'f4', length), ('mask', 'i8', length),
+                             ('lsf', 'f4', length), ('lambda', 'f4', length), ('x', 'i1'), ('y', 'i1'),
+                             ('spaxel_idx', 'i2'), ('flux_units', 'S32'), ('lambda_units', 'S32'),
+                             ('skycoo_x', 'f4'), ('skycoo_y', 'f4'), ('ellcoo_r', 'f4'), ('ellcoo_rre', 'f4'),
+                             ('ellcoo_rkpc', 'f4'), ('ellcoo_theta', 'f4'), ('skycoo_units', 'S32'),
+                             ('ellcoo_r_units', 'S32'), ('ellcoo_rre_units', 'S32'),
+                             ('ellcoo_rkpc_units', 'S32'), ('ellcoo_theta_units', 'S32')])
+    image_dtype = np.dtype([('filter', 'S8'), ('flux', 'f4', (size, size)), ('flux_units', 'S32'),
+                            ('psf', 'f4', (size, size)), ('psf_units', 'S32'), ('scale', 'f4'), ('scale_units', 'S32')])
+    map_dtype = np.dtype([('group', 'S32'), ('label', 'S32'), ('flux', 'f4', (size, size)),
+                          ('ivar', 'f4', (size, size)), ('mask', 'f4', (size, size)), ('flux_units', 'S32')])
+    groups = {}
+    for object_id, r, d in zip(ids, ra, dec):
+        spaxels = np.zeros(n_spaxels, dtype=spaxel_dtype)
+        spaxels['flux'] = _float(rng, n_spaxels, length)
+        images = np.zeros(len(m.MaNGA._image_filters), dtype=image_dtype)
+        images['filter'] = _str(m.MaNGA._image_filters)
+        images['flux'] = _float(rng, len(images), size, size)
+        maps = np.zeros(4, dtype=map_dtype)
+        maps['flux'] = _float(rng, len(maps), size, size)
+        groups[object_id.decode()] = {
+            'object_id': object_id, 'ra': r, 'dec': d, 'healpix': cell, 'z': np.float32(0.03),
+            'spaxel_size': np.float32(0.5), 'spaxel_size_unit': b'arcsec',
+            'spaxels': spaxels, 'images': images, 'maps': maps,
+        }
+    return groups
+
+
+def _plasticc(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['lightcurve'] = _float(rng, n, len(m._BANDS), 3, 64)
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    data['obj_type'] = np.full(n, 90)
+    return data
+
+
+def _sdss(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, n, 3800, ['flux', 'ivar', 'lsf_sigma', 'lambda', 'mask']))
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    data.update({f: _float(rng, n, len(m.SDSS._flux_filters)) for f in m._FLUX_FEATURES})
+    data.update({f: np.zeros(n, dtype='int64') for f in m._BOOL_FEATURES})
+    return data
+
+
+def _ssl_legacysurvey(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data.update(_images(rng, n, m.SSLLegacySurvey._bands, m.SSLLegacySurvey._image_size, keys=('array',)))
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    return data
+
+
+def _tess(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data['RA'], data['DEC'] = ra, dec
+    data['lightcurve'] = _ragged(rng, n, ['time', 'flux', 'flux_err', 'quality'], 250, 1000)
+    return data
+
+
+def _vipers(m, ids, ra, dec, cell, rng):
+    n = len(ids)
+    data = _base(ids, ra, dec, cell)
+    data.update(_spectrum(rng, n, 557, ['flux', 'noise', 'wave', 'mask']))
+    data['spectrum_noise'] = np.abs(data['spectrum_noise']) + 1
+    data.update({f: _float(rng, n) for f in m._FLOAT_FEATURES})
+    return data
+
+
+_SN_FLOAT_FEATURES = ['redshift', 'host_log_mass']
+_SN_STR_FEATURES = ['object_id', 'obj_type']
+
+FIXTURES = {
+    'allwise': Fixture('allwise', _mapping(id_key='cntr'), id_dtype='int64'),
+    'apogee': Fixture('apogee', _apogee),
+    'btsbot': Fixture('BTSbot', _btsbot, id_dtype='int64'),
+    'cfa': Fixture('cfa3', _cfa_like([], ['object_id', 'obj_type'], ['B', 'V', 'R', 'I'], 40), layout='object'),
+    'chandra': Fixture('spectra', _chandra),
+    'csp': Fixture('csp_dr3', _cfa_like(['ra', 'dec', 'redshift'], ['object_id', 'spec_class'], ['u', 'g', 'r', 'i'], 40), layout='object'),
+    'des_y3_sne_ia': Fixture('des_y3_sne_ia', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['g', 'r', 'i', 'z'], 40), layout='object'),
+    'desi': Fixture('dr1_main', _desi),
+    'desi_provabgs': Fixture('provabgs', _desi_provabgs),
+    'foundation': Fixture('foundation_dr1', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['g', 'r', 'i', 'z'], 40), layout='object'),
+    'gaia': Fixture('gaia_dr3', _gaia, id_dtype='int64'),
+    'galah': Fixture('dr3', _galah),
+    'galex': Fixture('ais', _mapping()),
+    'gz10': Fixture('gz10_rgb_images', _gz10),
+    'hsc': Fixture('pdr3_dud_22.5', _hsc),
+    'jwst': Fixture('ceers', _jwst),
+    'kepler': Fixture('all', _kepler),
+    'lamost': Fixture('dr10_v20_lrs_catalogue', _lamost),
+    'legacysurvey': Fixture('dr10_south_21', _legacysurvey),
+    'manga': Fixture('manga', _manga, layout='group'),
+    'plasticc': Fixture('train_only', _plasticc),
+    'ps1_sne_ia': Fixture('ps1_sne_ia', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['g', 'r', 'i', 'z'], 40), layout='object'),
+    'sages': Fixture('dr1', _mapping()),
+    'sdss': Fixture('sdss', _sdss),
+    'snls': Fixture('snls', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['g', 'r', 'i', 'z'], 40), layout='object'),
+    'ssl_legacysurvey': Fixture('stein_et_al', _ssl_legacysurvey),
+    'swift_sne_ia': Fixture('swift_sne_ia', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['UVW2', 'UVM2', 'UVW1', 'U', 'B', 'V'], 40), layout='object'),
+    'tess': Fixture('spoc', _tess),
+    'twomass': Fixture('psc', _mapping(id_key='pts_key'), id_dtype='int64'),
+    'vipers': Fixture('vipers_w1', _vipers),
+    'yse': Fixture('yse_dr1', _lightcurves(_SN_FLOAT_FEATURES, _SN_STR_FEATURES, ['g', 'r', 'i', 'z', 'X', 'Y'], 40), layout='object'),
+}
+
+
+def positions(cell: int, n: int):
+    """ Object ids and coordinates of the fixture objects of a healpix cell.
+
+    They only depend on the cell, so that the fixtures of all surveys overlap and can be cross-matched.
+    """
+    rng = np.random.default_rng(cell)
+    ids = cell * 1_000_000 + np.arange(n)
+    ra = rng.uniform(0, 1, n) + cell
+    dec = rng.uniform(0, 1, n)
+    return ids, ra, dec
+
+
+def _write_group(group, data):
+    for k, v in data.items():
+        if isinstance(v, dict):
+            _write_group(group.create_group(k), v)
+        else:
+            group.create_dataset(k, data=v)
+
+
+def _data_path(pattern: str, cell: int, file_name: str):
+    """ Turns a data_files pattern of a builder into the path of a fixture file """
+    directory, base = os.path.split(pattern)
+    directory = directory.lstrip('./').replace('healpix=*', f'healpix={cell}').replace('*', 'fixture')
+    extension = os.path.splitext(base)[1]
+    if file_name is None:
+        file_name = base.replace('*', '001-of-001')
+    return os.path.join(directory, file_name + extension if not file_name.endswith(extension) else file_name)
+
+
+def format_ids(survey: str, ids: np.ndarray) -> np.ndarray:
+    """ Converts integer object ids to the object_id dtype of a survey """
+    id_dtype = FIXTURES[survey].id_dtype
+    return _str([str(i) for i in ids]) if id_dtype == 'S' else ids.astype(id_dtype)
+
+
+def cell_contents(survey: str, module, pattern: str, cell: int, content) -> T.List[T.Tuple[str, T.Any]]:
+    """ Returns the relative path and data of each file holding the content generated for a cell """
+    if FIXTURES[survey].layout == 'object':
+        return [(_data_path(pattern, cell, data['object_id'].decode()), data) for data in content]
+    return [(_data_path(pattern, cell, None), content)]
+
+
+def write_fixture(survey: str, module, pattern: str, output_dir: str,
+                  n_cells: int = 2, n_objects: int = 32, seed: int = 0) -> T.List[str]:
+    """ Writes a synthetic fixture for a survey, following the data_files pattern of its builder.
+
+    Args:
+        survey: Name of the survey, a key of FIXTURES.
+        module: The module of the survey builder, holding the schema constants.
+        pattern: The first data_files pattern of the benchmarked configuration.
+        output_dir: Directory of the dataset, in which the builder script is copied.
+        n_cells: Number of healpix cells.
+        n_objects: Number of objects per healpix cell.
+        seed: Seed of the random content of the fixture.
+
+    Returns:
+        The list of written files.
+    """
+    fixture = FIXTURES[survey]
+    rng = np.random.default_rng(seed)
+    files = []
+    for cell in range(1, n_cells + 1):
+        ids, ra, dec = positions(cell, n_objects)
+        content = fixture.columns(module, format_ids(survey, ids), ra, dec, cell, rng)
+        for path, data in cell_contents(survey, module, pattern, cell, content):
+            path = os.path.join(output_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with h5py.File(path, 'w') as f:
+                _write_group(f, data)
+            files.append(path)
+    return files
+
+
+def load_builder_module(survey: str, scripts_dir: str):
+    """ Imports the builder script of a survey.
+
+    Returns:
+        The module of the builder, and the first data_files pattern of the configuration of its fixture.
+    """
+    import importlib.util
+
+    script = os.path.join(scripts_dir, survey, f'{survey}.py')
+    spec = importlib.util.spec_from_file_location(f'_mmu_bench_{survey}', script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    config = FIXTURES[survey].config
+    builder_class = [c for c in vars(module).values() if isinstance(c, type) and hasattr(c, 'BUILDER_CONFIGS') and c.__module__ == module.__name__][0]
+    builder_config = [c for c in builder_class.BUILDER_CONFIGS if c.name == config][0]
+    return module, builder_config.data_files['train'][0]
+
+
+def copy_builder_script(survey: str, scripts_dir: str, output_dir: str) -> str:
+    """ Copies the builder script of a survey in `output_dir/survey`, and returns that directory """
+    dataset_dir = os.path.join(output_dir, survey)
+    os.makedirs(dataset_dir, exist_ok=True)
+    shutil.copy(os.path.join(scripts_dir, survey, f'{survey}.py'), dataset_dir)
+    return dataset_dir
+
+
+def build_fixture_dataset(survey: str, scripts_dir: str, output_dir: str, **kwargs):
+    """ Copies the builder script of a survey in `output_dir/survey` and writes its fixture there.
+
+    Returns:
+        The path to the dataset directory, and the list of written files.
+    """
+    dataset_dir = copy_builder_script(survey, scripts_dir, output_dir)
+    module, pattern = load_builder_module(survey, scripts_dir)
+    return dataset_dir, write_fixture(survey, module, pattern, dataset_dir, **kwargs)
@@ -0,0 +1,222 @@
+""" Offline throughput benchmark of the survey builders.
+
+For each survey, a small synthetic fixture following the schema of its builder is written to
+a temporary directory, and the following stages are timed in a dedicated process:
+ - fixture: writing the synthetic HDF5 files
+ - load_builder: `load_dataset_builder` on the local copy of the builder script
+ - split_generators: resolving the data files of the train split
+ - generate: iterating over `_generate_examples` of the builder
+ - encode: encoding the generated examples with the builder features
+ - get_catalog: reading the object_id, ra, dec, healpix catalog
+Then `cross_match_datasets` is timed on a pair of surveys. Results are written as JSON and can
+be compared with the results of a previous run.
+
+Usage:
+    python -m mmu.bench --output bench.json [--surveys desi hsc] [--compare old.json]
+"""
+import os
+# The benchmark must never reach the network
+os.environ['HF_DATASETS_OFFLINE'] = '1'
+os.environ['HF_HUB_OFFLINE'] = '1'
+
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+
+from .fixtures import FIXTURES, build_fixture_dataset
+
+_default_scripts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'scripts')
+
+
+@contextmanager
+def _timer(timings, stage):
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+def _load_builder(survey, dataset_dir):
+    from datasets import load_dataset_builder
+    return load_dataset_builder(dataset_dir, FIXTURES[survey].config, trust_remote_code=True,
+                                cache_dir=os.path.join(dataset_dir, '.cache'))
+
+
+def bench_survey(survey, scripts_dir, output_dir, n_cells=2, n_objects=32, repeats=1):
+    """ Benchmarks the builder of a survey on a synthetic fixture.
+
+    Returns:
+        A dictionary with the timings of each stage in seconds, the number of generated
+        examples, the size of the fixture, the throughputs and the peak RSS of the process.
+    """
+    from mmu.benchmark.dataset_utils import builder_files, generate_examples
+    from mmu.utils import get_catalog
+
+    # Most of the memory of the process is taken by imports, reported separately
+    baseline_rss_mb = _peak_rss_mb()
+    timings = {}
+    with _timer(timings, 'fixture'):
+        dataset_dir, files = build_fixture_dataset(survey, scripts_dir, output_dir,
+                                                   n_cells=n_cells, n_objects=n_objects)
+    n_bytes = sum(os.path.getsize(f) for f in files)
+
+    with _timer(timings, 'load_builder'):
+        builder = _load_builder(survey, dataset_dir)
+    with _timer(timings, 'split_generators'):
+        split_files = builder_files(builder)
+
+    # Examples are kept for the encoding stage, fixtures are small enough
+    generate = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        examples = list(generate_examples(builder, split_files))
+        generate.append(time.perf_counter() - start)
+    timings['generate'] = min(generate)
+
+    with _timer(timings, 'encode'):
+        for example in examples:
+            builder.info.features.encode_example(example)
+
+    if FIXTURES[survey].layout == 'catalog':
+        with _timer(timings, 'get_catalog'):
+            get_catalog(builder)
+
+    n_examples = len(examples)
+    return {
+        'config': FIXTURES[survey].config,
+        'n_files': len(files),
+        'n_examples': n_examples,
+        'fixture_mb': n_bytes / 1024**2,
+        'timings': timings,
+        'examples_per_s': n_examples / timings['generate'],
+        'mb_per_s': n_bytes / 1024**2 / timings['generate'],
+        'baseline_rss_mb': baseline_rss_mb,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def bench_cross_match(left, right, scripts_dir, output_dir, n_cells=2, n_objects=32):
+    """ Benchmarks `cross_match_datasets` between the fixtures of two surveys. """
+    from mmu.utils import cross_match_datasets
+
+    timings = {}
+    builders = []
+    for survey in [left, right]:
+        dataset_dir, _ = build_fixture_dataset(survey, scripts_dir, output_dir, n_cells=n_cells, n_objects=n_objects)
+        builders.append(_load_builder(survey, dataset_dir))
+
+    with _timer(timings, 'cross_match'):
+        dataset = cross_match_datasets(*builders, keep_in_memory=True,
+                                       cache_dir=os.path.join(output_dir, 'cross_match'))
+    return {
+        'pair': [left, right],
+        'n_matches': len(dataset),
+        'timings': timings,
+        'examples_per_s': len(dataset) / timings['cross_match'],
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _run(fn, queue, *args, **kwargs):
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        result = {'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+    queue.put(result)
+
+
+def _run_isolated(fn, *args, **kwargs):
+    """ Runs a benchmark in a fresh process, so that the peak RSS is that of the benchmark alone. """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run, args=(fn, queue, *args), kwargs=kwargs)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _versions():
+    import datasets
+    import h5py
+    import numpy
+    return {'python': platform.python_version(), 'datasets': datasets.__version__,
+            'h5py': h5py.__version__, 'numpy': numpy.__version__}
+
+
+def run(surveys=None, cross_match=('desi', 'ssl_legacysurvey'), scripts_dir=_default_scripts_dir,
+        n_cells=2, n_objects=32, repeats=1, work_dir=None):
+    """ Runs the benchmark of the given surveys, by default all of them.
+
+    Failures of a survey are recorded in its results instead of interrupting the benchmark.
+    """
+    surveys = surveys or sorted(FIXTURES)
+    results = {
+        'meta': {'commit': _git_commit(), 'n_cells': n_cells, 'n_objects': n_objects,
+                 'repeats': repeats, 'versions': _versions()},
+        'surveys': {},
+    }
+    with tempfile.TemporaryDirectory(dir=work_dir) as output_dir:
+        for survey in surveys:
+            print(f'Benchmarking {survey}...', flush=True)
+            results['surveys'][survey] = _run_isolated(bench_survey, survey, scripts_dir, output_dir,
+                                                       n_cells=n_cells, n_objects=n_objects, repeats=repeats)
+        if cross_match:
+            print(f'Benchmarking cross-matching of {cross_match[0]} and {cross_match[1]}...', flush=True)
+            results['cross_match'] = _run_isolated(bench_cross_match, *cross_match, scripts_dir,
+                                                   os.path.join(output_dir, 'cross_match'),
+                                                   n_cells=n_cells, n_objects=n_objects)
+    return results
+
+
+def compare(results, reference):
+    """ Prints the ratio of the throughput of each survey to that of a reference run. """
+    print(f"{'survey':<20}{'examples/s':>14}{'reference':>14}{'ratio':>8}")
+    for survey, result in results['surveys'].items():
+        ref = reference['surveys'].get(survey, {})
+        if 'error' in result or 'error' in ref or not ref:
+            print(f"{survey:<20}{'n/a':>14}{'n/a':>14}{'n/a':>8}")
+            continue
+        ratio = result['examples_per_s'] / ref['examples_per_s']
+        print(f"{survey:<20}{result['examples_per_s']:>14.1f}{ref['examples_per_s']:>14.1f}{ratio:>8.2f}")
+
+
+def main(args):
+    results = run(surveys=args.surveys,
+                  cross_match=None if args.no_cross_match else args.cross_match,
+                  scripts_dir=args.scripts_dir,
+                  n_cells=args.n_cells,
+                  n_objects=args.n_objects,
+                  repeats=args.repeats,
+                  work_dir=args.work_dir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    failed = [s for s, r in results['surveys'].items() if 'error' in r]
+    for survey in failed:
+        print(f"{survey} failed: {results['surveys'][survey]['error']}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
@@ -0,0 +1,245 @@
+""" Generator of synthetic parent samples, for scaling tests of the builders and cross-matching utilities.
+
+The generated trees follow the schema of the survey builders, with one `healpix=*/001-of-001.hdf5`
+file per cell (or one file per object for surveys stored that way), so that they can be loaded
+with `load_dataset` and cross-matched with `mmu.utils.cross_match_datasets` like real downloads.
+
+Objects are spread over consecutive healpix cells at a given sky density, and a fraction of the
+objects of each survey sits at positions shared by all surveys, up to a small astrometric offset,
+so that the number of cross-matches is known in advance. The output only depends on the arguments.
+
+Usage:
+    python -m mmu.bench.synthetic output_dir --surveys hsc desi gaia tess --n_objects 1000000 \
+        --density 500 --overlap 0.3 --num_proc 8
+"""
+import argparse
+import os
+import typing as T
+import zlib
+from functools import partial
+from multiprocessing import Pool
+
+import h5py
+import healpy as hp
+import numpy as np
+from tqdm import tqdm
+
+from .fixtures import FIXTURES, _data_path, _write_group, cell_contents, copy_builder_script, format_ids, load_builder_module
+from .runner import _default_scripts_dir
+
+_healpix_nside = 16
+# Positions are drawn at the centers of sub-pixels of the healpix cells, of about 0.2 arcsec
+_subpixel_order = 16
+# Object ids are cell * _id_offset + index of the object in the cell
+_id_offset = 10**9
+
+
+def sky_cells(n_objects: int, density: float, first_cell: T.Optional[int] = None, seed: int = 0):
+    """ Returns the healpix cells covered by a sample, and the number of objects in each of them.
+
+    Args:
+        n_objects: Total number of objects of the sample.
+        density: Number of objects per square degree.
+        first_cell: First of the consecutive (nested) healpix cells, drawn at random if None.
+        seed: Seed used to draw the first cell.
+    """
+    per_cell = max(1, int(round(density * hp.nside2pixarea(_healpix_nside, degrees=True))))
+    n_cells = -(-n_objects // per_cell)
+    npix = hp.nside2npix(_healpix_nside)
+    if n_cells > npix:
+        raise ValueError(f"{n_objects} objects at a density of {density} per square degree do not fit on the sky")
+    if first_cell is None:
+        first_cell = int(np.random.default_rng(seed).integers(0, npix - n_cells + 1))
+    elif first_cell + n_cells > npix:
+        raise ValueError(f"The sample needs {n_cells} cells, but starts at cell {first_cell} out of {npix}")
+    counts = np.full(n_cells, per_cell)
+    counts[-1] = n_objects - per_cell * (n_cells - 1)
+    return np.arange(first_cell, first_cell + n_cells), counts
+
+
+def sample_positions(cell: int, n: int, rng: np.random.Generator):
+    """ Draws uniformly distributed positions within a healpix cell """
+    order = _subpixel_order
+    subpixels = cell * 4**order + rng.integers(0, 4**order, n)
+    return hp.pix2ang(_healpix_nside * 2**order, subpixels, nest=True, lonlat=True)
+
+
+def cell_positions(survey: str, cell: int, n: int, overlap: float, match_offset: float, seed: int):
+    """ Returns the ids and positions of the objects of a survey in a healpix cell.
+
+    The first `round(overlap * n)` objects are at positions shared by all surveys, moved by a random
+    offset of `match_offset` arcsec, the others are specific to the survey.
+    """
+    n_common = int(round(overlap * n))
+    rng = np.random.default_rng([seed, cell, zlib.crc32(survey.encode())])
+    ra_common, dec_common = sample_positions(cell, n_common, np.random.default_rng([seed, cell]))
+    ra_own, dec_own = sample_positions(cell, n - n_common, rng)
+
+    offset = rng.normal(scale=match_offset / 3600, size=(2, n_common))
+    ra_common = (ra_common + offset[0] / np.cos(np.deg2rad(dec_common))) % 360
+    dec_common = np.clip(dec_common + offset[1], -90, 90)
+
+    ids = cell * _id_offset + np.arange(n)
+    return ids, np.concatenate([ra_common, ra_own]), np.concatenate([dec_common, dec_own]), rng
+
+
+def _nbytes(data) -> int:
+    if isinstance(data, dict):
+        return sum(_nbytes(v) for v in data.values())
+    if isinstance(data, list):
+        return sum(_nbytes(v) for v in data)
+    return np.asarray(data).nbytes
+
+
+def _write_ragged_rows(group, data: dict, start: int, n_rows: int):
+    """ Writes a chunk of rows of a group of ragged columns, whose flat values are appended to those of
+    the previous chunks, and whose offsets are shifted by the number of values written so far """
+    offsets = np.asarray(data['offsets'])
+    if 'offsets' not in group:
+        group.create_dataset('offsets', shape=(n_rows + 1,), dtype=np.int64)
+    total = int(group['offsets'][start]) if start > 0 else 0
+    group['offsets'][start:start + len(offsets)] = offsets - offsets[0] + total
+    for k, v in data.items():
+        if k == 'offsets':
+            continue
+        v = np.asarray(v)
+        if k not in group:
+            group.create_dataset(k, shape=(0, *v.shape[1:]), maxshape=(None, *v.shape[1:]), dtype=v.dtype)
+        group[k].resize(total + len(v), axis=0)
+        group[k][total:] = v
+
+
+def _write_rows(f, data: dict, start: int, n_rows: int):
+    """ Writes a chunk of rows of a catalog, creating the datasets of the full catalog on the first chunk """
+    for k, v in data.items():
+        if isinstance(v, dict):
+            _write_ragged_rows(f.require_group(k), v, start, n_rows)
+            continue
+        if k not in f:
+            f.create_dataset(k, shape=(n_rows, *v.shape[1:]), dtype=v.dtype)
+        f[k][start:start + len(v)] = v
+
+
+# Builder modules are imported once per worker process
+_modules = {}
+
+
+def _generate_cell(args, scripts_dir, output_dir, overlap, match_offset, chunk_mb, seed):
+    survey, cell, n = args
+    if survey not in _modules:
+        _modules[survey] = load_builder_module(survey, scripts_dir)
+    module, pattern = _modules[survey]
+    fixture = FIXTURES[survey]
+    dataset_dir = os.path.join(output_dir, survey)
+
+    ids, ra, dec, rng = cell_positions(survey, cell, n, overlap, match_offset, seed)
+    ids = format_ids(survey, ids)
+
+    # Content is generated by chunks of about chunk_mb, estimated from a single object
+    object_size = _nbytes(fixture.columns(module, ids[:1], ra[:1], dec[:1], cell, np.random.default_rng(0)))
+    chunk_size = max(1, int(chunk_mb * 1024**2 // max(object_size, 1)))
+
+    files = set()
+    f = None
+    if fixture.layout != 'object':
+        path = os.path.join(dataset_dir, _data_path(pattern, cell, None))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = h5py.File(path, 'w')
+        files.add(path)
+    try:
+        for start in range(0, n, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            content = fixture.columns(module, ids[chunk], ra[chunk], dec[chunk], cell, rng)
+            if fixture.layout == 'catalog':
+                _write_rows(f, content, start, n)
+            elif fixture.layout == 'group':
+                _write_group(f, content)
+            else:
+                for path, data in cell_contents(survey, module, pattern, cell, content):
+                    path = os.path.join(dataset_dir, path)
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with h5py.File(path, 'w') as g:
+                        _write_group(g, data)
+                    files.add(path)
+    finally:
+        if f is not None:
+            f.close()
+    return survey, n, sum(os.path.getsize(p) for p in files)
+
+
+def generate_parent_samples(surveys: T.List[str],
+                            output_dir: str,
+                            n_objects: int = 10_000,
+                            density: float = 100.,
+                            overlap: float = 0.5,
+                            match_offset: float = 0.2,
+                            first_cell: T.Optional[int] = None,
+                            seed: int = 0,
+                            num_proc: T.Optional[int] = None,
+                            chunk_mb: float = 256.,
+                            scripts_dir: str = _default_scripts_dir) -> T.Dict[str, str]:
+    """ Writes synthetic parent samples of several surveys covering the same area of the sky.
+
+    Args:
+        surveys: Surveys to generate, keys of `mmu.bench.fixtures.FIXTURES`.
+        output_dir: Directory in which the dataset of each survey is written, along with its builder script.
+        n_objects: Number of objects of each survey.
+        density: Number of objects per square degree, which sets the number of healpix cells.
+        overlap: Fraction of the objects of each survey found in all the other surveys.
+        match_offset: Standard deviation in arcsec of the offset between the positions of the same
+            object in two surveys, to be kept well below the cross-matching radius.
+        first_cell: First of the consecutive healpix cells covered by the samples, drawn at random if None.
+        seed: Seed of the positions and content of the samples.
+        num_proc: Number of processes, one healpix cell of one survey being written by each task.
+        chunk_mb: Approximate size of the chunks of objects generated at once by a process.
+        scripts_dir: Directory of the survey builder scripts.
+
+    Returns:
+        The dataset directory of each survey.
+    """
+    if not 0 <= overlap <= 1:
+        raise ValueError(f"overlap must be between 0 and 1, got {overlap}")
+    unknown = set(surveys) - set(FIXTURES)
+    if unknown:
+        raise ValueError(f"No fixture for surveys {sorted(unknown)}, available surveys are {sorted(FIXTURES)}")
+
+    cells, counts = sky_cells(n_objects, density, first_cell=first_cell, seed=seed)
+    dataset_dirs = {survey: copy_builder_script(survey, scripts_dir, output_dir) for survey in surveys}
+
+    # Largest cells first, so that the pool is not left waiting on a single task
+    tasks = sorted([(survey, int(cell), int(n)) for survey in surveys for cell, n in zip(cells, counts)],
+                   key=lambda t: -t[2])
+    fn = partial(_generate_cell, scripts_dir=scripts_dir, output_dir=output_dir, overlap=overlap,
+                 match_offset=match_offset, chunk_mb=chunk_mb, seed=seed)
+
+    n_bytes = {survey: 0 for survey in surveys}
+    with Pool(num_proc) as pool:
+        for survey, n, size in tqdm(pool.imap_unordered(fn, tasks), total=len(tasks)):
+            n_bytes[survey] += size
+
+    print(f"Generated {n_objects} objects per survey over {len(cells)} healpix cells "
+          f"({cells[0]} to {cells[-1]}), with {int(round(overlap * n_objects))} shared objects")
+    for survey in surveys:
+        print(f"{survey}: {n_bytes[survey] / 1024**3:.2f} GB in {dataset_dirs[survey]}")
+    return dataset_dirs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic parent samples following the schema of the survey builders')
+    parser.add_argument('output_dir', type=str, help='Path to the output directory')
+    parser.add_argument('--surveys', type=str, nargs='+', default=['hsc', 'desi', 'gaia', 'tess'], choices=sorted(FIXTURES), help='Surveys to generate')
+    parser.add_argument('--n_objects', type=int, default=10_000, help='Number of objects of each survey')
+    parser.add_argument('--density', type=float, default=100., help='Number of objects per square degree')
+    parser.add_argument('--overlap', type=float, default=0.5, help='Fraction of the objects of each survey shared by all surveys')
+    parser.add_argument('--match_offset', type=float, default=0.2, help='Standard deviation in arcsec of the offset between matching objects')
+    parser.add_argument('--first_cell', type=int, default=None, help='First healpix cell covered by the samples')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--num_proc', type=int, default=None, help='Number of parallel processes to use')
+    parser.add_argument('--chunk_mb', type=float, default=256., help='Approximate size in MB of the chunks generated at once by a process')
+    parser.add_argument('--scripts_dir', type=str, default=_default_scripts_dir, help='Directory of the survey builder scripts')
+    args = parser.parse_args()
+
+    generate_parent_samples(args.surveys, args.output_dir, n_objects=args.n_objects, density=args.density,
+                            overlap=args.overlap, match_offset=args.match_offset, first_cell=args.first_cell,
+                            seed=args.seed, num_proc=args.num_proc, chunk_mb=args.chunk_mb,
+                            scripts_dir=args.scripts_dir)
@@ -2,11 +2,34 @@
 import torch
 import lightning as L
 import datasets 
+from datasets.distributed import split_dataset_by_node
 from torch.utils.data import DataLoader
+import numpy as np
 import typing as T
 import os
 
-from mmu.utils import cross_match_datasets
+from mmu.utils import cross_match_datasets, cross_match_configs
+from mmu.benchmark.dataset_utils import healpix_split_mask, file_healpix, select_mask, builder_files, generate_examples, batch_dataloader
+
+
+def _split_files(files: T.List, test_size: float, split_by: str = 'random', seed: int = 0):
+    """ Splits a list of files into two lists, the second one holding a `test_size`
+    fraction of the files. With `split_by='healpix'`, files are assigned based on a
+    hash of their HEALPix cell, so that all the files of a cell end up in the same list.
+    """
+    files = sorted(files, key=str)
+    if split_by == 'random':
+        perm = np.random.default_rng(seed).permutation(len(files))
+        n_test = int(np.ceil(test_size * len(files)))
+        test_mask = np.zeros(len(files), dtype=bool)
+        test_mask[perm[:n_test]] = True
+    elif split_by == 'healpix':
+        test_mask = healpix_split_mask(file_healpix(files), test_size, seed=seed)
+    else:
+        raise ValueError(f"Split method {split_by} not supported.")
+    return ([f for f, m in zip(files, test_mask) if not m],
+            [f for f, m in zip(files, test_mask) if m])
+
 
 class MMU(L.LightningDataModule):
     def __init__(
@@ -16,8 +39,21 @@ class MMU(L.LightningDataModule):
             num_workers: int = 0, 
             test_size: float = 0.1,
             local_mmu_root: str = None,
-            config_name: T.Optional[str]=None):
+            config_name: T.Optional[str]=None,
+            streaming: bool = False,
+            shuffle_buffer_size: int = 1000,
+            split_by: str = 'random'):
         """ Lightning DataModule for MMU datasets.
+
+        With `split_by='healpix'`, whole HEALPix cells are assigned to the train, val,
+        and test sets based on a hash of the cell id, instead of splitting rows at random.
+        The splits are then reproducible, free of spatial leakage, and each split is
+        read from its own set of files without an indices mapping.
+
+        With `streaming=True`, the dataset is read sequentially from its HEALPix files
+        instead of being loaded in an Arrow cache. Files are split between train, val,
+        and test sets, then between DDP ranks and DataLoader workers, and examples are
+        shuffled within a buffer of `shuffle_buffer_size` examples.
         """
         super().__init__()
         self.save_hyperparameters()
@@ -25,6 +61,14 @@ class MMU(L.LightningDataModule):
     def setup(self, stage=None):
         """ Setup the dataset.
         """
+        if self.hparams.streaming:
+            self._setup_streaming()
+            return
+
+        if self.hparams.split_by == 'healpix':
+            self._setup_healpix_splits()
+            return
+
         if self.hparams.local_mmu_root is not None:
             dataset_path = os.path.join(self.hparams.local_mmu_root, self.hparams.name)
             try:
@@ -45,18 +89,80 @@ class MMU(L.LightningDataModule):
         dset = dset.train_test_split(test_size=self.hparams.test_size)
         self.train_dataset, self.val_dataset = dset['train'], dset['test']
 
+    def _setup_healpix_splits(self):
+        """ Setup the dataset with each split loaded from the files of its HEALPix cells.
+        """
+        if self.hparams.local_mmu_root is not None:
+            dataset_path = os.path.join(self.hparams.local_mmu_root, self.hparams.name)
+        else:
+            dataset_path = self.hparams.name
+        builder = datasets.load_dataset_builder(dataset_path, self.hparams.config_name, trust_remote_code=True)
+
+        # Spliting files into train, val, and test sets
+        files, test_files = _split_files(builder.config.data_files['train'], self.hparams.test_size, split_by='healpix', seed=0)
+        train_files, val_files = _split_files(files, self.hparams.test_size, split_by='healpix', seed=1)
+        if min(len(train_files), len(val_files), len(test_files)) == 0:
+            raise ValueError("Not enough HEALPix cells in the dataset to build non-empty train, val, and test sets.")
+
+        dset = datasets.load_dataset(dataset_path, self.hparams.config_name,
+                                     data_files={'train': train_files, 'validation': val_files, 'test': test_files},
+                                     trust_remote_code=True)
+        dset.set_format("torch")
+        self.train_dataset, self.val_dataset, self.test_dataset = dset['train'], dset['validation'], dset['test']
+
+    def _setup_streaming(self):
+        """ Setup iterable datasets streaming the HEALPix files of the dataset.
+        """
+        if self.hparams.local_mmu_root is None:
+            raise ValueError("Streaming is only supported for local datasets, please provide local_mmu_root.")
+        dataset_path = os.path.join(self.hparams.local_mmu_root, self.hparams.name)
+        builder = datasets.load_dataset_builder(dataset_path, self.hparams.config_name, trust_remote_code=True)
+
+        # Spliting files into train, val, and test sets
+        files, test_files = _split_files(builder_files(builder), self.hparams.test_size, split_by=self.hparams.split_by, seed=0)
+        train_files, val_files = _split_files(files, self.hparams.test_size, split_by=self.hparams.split_by, seed=1)
+
+        rank = self.trainer.global_rank if self.trainer is not None else 0
+        world_size = self.trainer.world_size if self.trainer is not None else 1
+
+        def _build(files):
+            dset = datasets.IterableDataset.from_generator(generate_examples,
+                                                           features=builder.info.features,
+                                                           gen_kwargs={'builder': builder, 'files': files})
+            # Each rank reads its own subset of the files when they can be evenly distributed
+            dset = split_dataset_by_node(dset, rank=rank, world_size=world_size)
+            return dset.with_format("torch")
+
+        # Shuffling happens at the file level, and within a buffer of examples
+        self.train_dataset = _build(train_files).shuffle(seed=42, buffer_size=self.hparams.shuffle_buffer_size)
+        self.val_dataset = _build(val_files)
+        self.test_dataset = _build(test_files)
+
+    def _dataloader(self, dataset, shuffle: bool = False):
+        if self.hparams.streaming:
+            return DataLoader(dataset,
+                              batch_size=self.hparams.batch_size,
+                              num_workers=self.hparams.num_workers,
+                              drop_last=True)
+        # Whole batches are read from the Arrow table, into one pinned tensor per field
+        return batch_dataloader(dataset,
+                                batch_size=self.hparams.batch_size,
+                                shuffle=shuffle,
+                                drop_last=True,
+                                num_workers=self.hparams.num_workers,
+                                pin_memory=torch.cuda.is_available())
+
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, 
-                          batch_size=self.hparams.batch_size, 
-                          num_workers=self.hparams.num_workers, 
-                          shuffle=True,
-                          drop_last=True)
+        if self.hparams.streaming and self.trainer is not None:
+            # Reshuffle the order of the files and the buffer at every epoch
+            self.train_dataset.set_epoch(self.trainer.current_epoch)
+        return self._dataloader(self.train_dataset, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.hparams.batch_size, drop_last=True, num_workers=self.hparams.num_workers)
+        return self._dataloader(self.val_dataset)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
+        return self._dataloader(self.test_dataset)
 
 
 class CrossMatchedMMU(L.LightningDataModule):
@@ -71,9 +177,22 @@ class CrossMatchedMMU(L.LightningDataModule):
             matching_radius: float = 1.0,
             cache_dir: str = None,
             left_config_name: T.Optional[str]=None,
-            right_config_name: T.Optional[str]=None):
+            right_config_name: T.Optional[str]=None,
+            split_by: str = 'random',
+            joint_cross_match: bool = True):
         """ Lightning DataModule for datasets resulting from cross-matching of parent 
         samples.
+
+        With `split_by='healpix'`, whole HEALPix cells are assigned to the train, val,
+        and test sets based on a hash of the cell id, instead of splitting rows at random.
+
+        With `joint_cross_match=True`, the default, the configs of the left dataset are matched
+        together against the right catalog, loaded once, and their examples are generated in a
+        single pass over `num_workers` processes, instead of cross-matching each config in turn
+        as with `joint_cross_match=False`, the behaviour of earlier versions. The matches of a
+        HEALPix cell are ordered by the files holding their objects rather than in catalog order,
+        so when cells are split into several files, the rows of the dataset, and the random splits
+        drawn from them, differ from those of earlier versions.
         """
         super().__init__()
         self.save_hyperparameters()
@@ -96,29 +215,54 @@ class CrossMatchedMMU(L.LightningDataModule):
             configs = left.builder_configs
             configs = [config for config in configs if config != "all"]
 
-        # Let's process each config separately
-        # This is because the cross-matching currently only works if a singe file
-        # exists for a given healpix cell. With the way we store SDSS for instance,
-        # several surveys can overlap on the sky, and that causes problems. So here
-        # as a temporary fix, we process sub-configs one by one.
-        dsets = []
-        for i, config in enumerate(configs):
-            print("Processing config from left dataset: ", config)
-            left = datasets.load_dataset_builder(left_path, config, trust_remote_code=True)
-            dset = cross_match_datasets(
-                left,
+        # Configs are matched separately, because the cross-matching of a whole dataset
+        # only works if a single file exists for a given healpix cell. With the way we
+        # store SDSS for instance, several surveys can overlap on the sky.
+        if self.hparams.joint_cross_match:
+            # The right catalog is loaded once for all configs, which are generated together
+            lefts = [datasets.load_dataset_builder(left_path, config, trust_remote_code=True) for config in configs]
+            catalogs, dset = cross_match_configs(
+                lefts,
                 right,
                 matching_radius=self.hparams.matching_radius,  # In arcsecs
                 cache_dir=self.hparams.cache_dir,
-                num_proc=self.hparams.num_workers
+                num_proc=self.hparams.num_workers or None,
+                return_catalog=True
             )
-            dsets.append(dset)
+            healpix = [np.asarray(catalog['healpix']) for catalog in catalogs]
+        else:
+            # Each config is cross-matched in turn
+            dsets = []
+            healpix = []
+            for i, config in enumerate(configs):
+                print("Processing config from left dataset: ", config)
+                left = datasets.load_dataset_builder(left_path, config, trust_remote_code=True)
+                catalog, dset = cross_match_datasets(
+                    left,
+                    right,
+                    matching_radius=self.hparams.matching_radius,  # In arcsecs
+                    cache_dir=self.hparams.cache_dir,
+                    num_proc=self.hparams.num_workers,
+                    return_catalog=True
+                )
+                dsets.append(dset)
+                healpix.append(np.asarray(catalog['healpix']))
 
-        # Concatenate all the datasets
-        dset = datasets.concatenate_datasets(dsets)
+            # Concatenate all the datasets
+            dset = datasets.concatenate_datasets(dsets)
         
         dset = dset.with_format("torch")
 
+        if self.hparams.split_by == 'healpix':
+            # Rows of each cell are contiguous, so each split is made of slices of the dataset
+            healpix = np.concatenate(healpix)
+            test_mask = healpix_split_mask(healpix, self.hparams.test_size, seed=0)
+            val_mask = ~test_mask & healpix_split_mask(healpix, self.hparams.test_size, seed=1)
+            self.test_dataset = select_mask(dset, test_mask)
+            self.val_dataset = select_mask(dset, val_mask)
+            self.train_dataset = select_mask(dset, ~test_mask & ~val_mask)
+            return
+
         # Apply shuffling at the top level
         dset = dset.shuffle(seed=42)
 
@@ -128,11 +272,16 @@ class CrossMatchedMMU(L.LightningDataModule):
         dset = dset.train_test_split(test_size=self.hparams.test_size)
         self.train_dataset, self.val_dataset = dset['train'], dset['test']
 
+    def _dataloader(self, dataset, shuffle: bool = False):
+        return batch_dataloader(dataset, batch_size=self.hparams.batch_size, shuffle=shuffle, drop_last=True,
+                                num_workers=self.hparams.num_workers, pin_memory=torch.cuda.is_available())
+
     def train_dataloader(self):
-        return DataLoader(self.train_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
+        # Spatial splits are not shuffled at the dataset level
+        return self._dataloader(self.train_dataset, shuffle=self.hparams.split_by == 'healpix')
 
     def val_dataloader(self):
-        return DataLoader(self.val_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
+        return self._dataloader(self.val_dataset)
 
     def test_dataloader(self):
-        return DataLoader(self.test_dataset, batch_size=self.hparams.batch_size, num_workers=self.hparams.num_workers, drop_last=True)
\ No newline at end of file
+        return self._dataloader(self.test_dataset)
\ No newline at end of file
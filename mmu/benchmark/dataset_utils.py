@@ -1,8 +1,18 @@
+import os
+import hashlib
+import re
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 import tqdm
-from torch.utils.data import DataLoader
+from multiprocessing import Pool
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
+import datasets
+from datasets import concatenate_datasets
 from datasets.arrow_dataset import Dataset as HF_Dataset
-from typing import Tuple, Any
+from datasets.features.features import require_decoding
+from typing import Tuple, Any, List, Optional, Callable, Union
 
 def split_dataset(
         dataset: HF_Dataset, 
@@ -13,17 +23,484 @@ def split_dataset(
 
     Parameters:
     - dataset: The dataset to be split.
-    - split: The splitting strategy. Currently, only 'naive' is implemented.
+    - split: The splitting strategy. 'naive' splits rows at random, 'healpix' assigns
+      whole HEALPix cells to a split (requires a 'healpix' column).
 
     Returns:
     - A tuple of (train_dataset, test_dataset).
     """
     if split == 'naive':
         train_test_split = dataset.train_test_split(test_size=0.2)
+    elif split == 'healpix':
+        test_mask = healpix_split_mask(dataset.with_format('numpy')['healpix'], test_size=0.2)
+        return select_mask(dataset, ~test_mask), select_mask(dataset, test_mask)
     else:
         raise ValueError('Split method not implemented yet.')
     return train_test_split['train'], train_test_split['test']
 
+def healpix_split_mask(
+        healpix: np.ndarray,
+        test_size: float,
+        seed: int = 0
+        ) -> np.ndarray:
+    """
+    Assigns whole HEALPix cells to a test set, using a hash of the cell id.
+
+    The assignment only depends on the cell id, the test size and the seed, so it
+    is reproducible across machines and runs, and no cell is shared between sets.
+
+    Parameters:
+    - healpix: The HEALPix cell id of each element.
+    - test_size: The expected fraction of cells assigned to the test set.
+    - seed: Salt of the hash, different seeds give independent assignments.
+
+    Returns:
+    - A boolean array, True for elements in the test set.
+    """
+    cells, inverse = np.unique(np.asarray(healpix), return_inverse=True)
+    fractions = np.array([
+        int.from_bytes(hashlib.sha256(f'{seed}-{int(cell)}'.encode()).digest()[:8], 'little') / 2**64
+        for cell in cells
+    ])
+    return (fractions < test_size)[inverse.reshape(-1)]
+
+def file_healpix(files: List[str]) -> np.ndarray:
+    """
+    Extracts the HEALPix cell ids from paths following the `healpix=<id>/` layout.
+    """
+    return np.array([int(re.search(r'healpix=(\d+)', str(f)).group(1)) for f in files])
+
+def select_mask(
+        dataset: HF_Dataset,
+        mask: np.ndarray
+        ) -> HF_Dataset:
+    """
+    Selects the rows of a dataset where mask is True, without an indices mapping.
+
+    Each run of consecutive selected rows is a zero-copy slice of the underlying
+    Arrow table, so this is efficient when rows of the same cell are contiguous.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], mask, [False]]).astype(int)))
+    runs = [dataset.select(range(start, stop)) for start, stop in zip(edges[::2], edges[1::2])]
+    if len(runs) == 0:
+        return dataset.select([])
+    return concatenate_datasets(runs)
+
+def builder_files(builder: datasets.DatasetBuilder, split: str = 'train') -> List:
+    """
+    Returns the files of a split in the format expected by the `_generate_examples`
+    method of the builder, i.e. one entry per file, either a path or a list of paths.
+    """
+    dl_manager = datasets.DownloadManager(dataset_name=builder.name, base_path=builder.base_path)
+    for split_generator in builder._split_generators(dl_manager):
+        if split_generator.name == split:
+            return [f if isinstance(f, str) else list(f) for f in split_generator.gen_kwargs['files']]
+    raise ValueError(f"Split {split} not found in dataset {builder.name}.")
+
+def generate_examples(builder: datasets.DatasetBuilder, files: List):
+    """
+    Yields the examples of the given files of a dataset builder.
+    """
+    for _, example in builder._generate_examples(files=files):
+        yield example
+
+def _map_leaves(tree, fn):
+    if isinstance(tree, dict):
+        return {k: _map_leaves(v, fn) for k, v in tree.items()}
+    return fn(tree)
+
+def arrow_to_numpy(array):
+    """
+    Converts an Arrow column to NumPy arrays, nested in dictionaries for structs.
+
+    Lists with the same length in every row, including the fixed-shape `Array2D` and
+    `Array3D` features, become one array with an additional dimension per level of
+    nesting, e.g. a sequence of per-band images becomes a (B, C, H, W) array. These
+    arrays are zero-copy views of the Arrow buffers when the column has no nulls and
+    is stored in a single chunk. Lists of different lengths become lists of arrays.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.chunk(0) if array.num_chunks == 1 else array.combine_chunks()
+    if isinstance(array.type, pa.ExtensionType):
+        array = array.storage
+    if pa.types.is_struct(array.type):
+        # Unlike `field`, `flatten` accounts for the offset of sliced arrays
+        return {array.type.field(i).name: arrow_to_numpy(child) for i, child in enumerate(array.flatten())}
+    if pa.types.is_list(array.type) or pa.types.is_large_list(array.type) or pa.types.is_fixed_size_list(array.type):
+        lengths = pc.list_value_length(array).to_numpy(zero_copy_only=False)
+        values = arrow_to_numpy(array.flatten())
+        if array.null_count == 0 and (lengths == (lengths[0] if len(lengths) else 0)).all():
+            length = int(lengths[0]) if len(lengths) else 0
+            return _map_leaves(values, lambda v: v.reshape(len(array), length, *np.shape(v)[1:]))
+        offsets = np.cumsum(np.nan_to_num(lengths).astype(np.int64))[:-1]
+        return _map_leaves(values, lambda v: np.split(v, offsets))
+    return array.to_numpy(zero_copy_only=False)
+
+def _to_tensor(value):
+    """
+    Converts the output of `arrow_to_numpy` to tensors, with the dtypes of the torch format of datasets.
+    """
+    if isinstance(value, dict):
+        return {k: _to_tensor(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_tensor(v) for v in value]
+    if value.dtype == object:
+        # Strings and binary values are returned as lists, with the batch dimension innermost as with `default_collate`
+        return np.moveaxis(value, 0, -1).tolist()
+    if np.issubdtype(value.dtype, np.floating):
+        value = value.astype(np.float32, copy=False)
+    elif np.issubdtype(value.dtype, np.integer):
+        value = value.astype(np.int64, copy=False)
+    # A single copy of the Arrow buffers, which are read-only, into a contiguous tensor
+    value = np.ascontiguousarray(value)
+    if not value.flags.writeable:
+        value = value.copy()
+    return torch.from_numpy(value)
+
+class ArrowBatchDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset returning whole batches of a Hugging Face dataset, indexed by lists of
+    indices, e.g. from a `BatchSampler`, and read directly from its Arrow table.
+
+    Each batch is taken from the table in one call, as a zero-copy slice for a range of
+    consecutive rows, then each field is converted by `arrow_to_numpy` and copied once
+    into a contiguous tensor, instead of building and stacking a tensor per example.
+    Columns that need decoding, e.g. `Image` features, go through the torch formatter.
+    The batches have the same structure and dtypes as with `set_format('torch')`
+    followed by `default_collate`.
+    """
+    def __init__(self, dataset: HF_Dataset, columns: Optional[List[str]] = None):
+        self.dataset = dataset
+        self.columns = columns if columns is not None else (dataset.format['columns'] or dataset.column_names)
+        self.decoded_columns = [c for c in self.columns if require_decoding(dataset.features[c])]
+        self.indices = None if dataset._indices is None else dataset._indices.column(0).to_numpy().astype(np.int64)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        rows = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            rows = self.indices[rows]
+        table = self.dataset.data.table
+        if len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1 and (np.diff(rows) == 1).all():
+            table = table.slice(int(rows[0]), len(rows))
+        else:
+            table = table.take(rows)
+        batch = {c: _to_tensor(arrow_to_numpy(table.column(c))) for c in self.columns if c not in self.decoded_columns}
+        if self.decoded_columns:
+            batch.update(self.dataset.with_format('torch', columns=self.decoded_columns)[list(map(int, indices))])
+        return {c: batch[c] for c in self.columns}
+
+def batch_dataloader(
+        dataset: HF_Dataset,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        collate_fn: Optional[Callable] = None,
+        **kwargs
+        ) -> DataLoader:
+    """
+    Builds a DataLoader reading whole batches of a dataset with an `ArrowBatchDataset`.
+
+    Parameters:
+    - dataset: The Hugging Face dataset to load.
+    - batch_size, shuffle, drop_last: As for a `DataLoader`.
+    - collate_fn: Optional function applied to each batch of tensors, e.g. to select or
+      transform its fields, instead of to a list of examples.
+    - kwargs: Additional arguments of the `DataLoader`, e.g. `num_workers` or `pin_memory`,
+      which then pins a single buffer per field of the batch.
+
+    Returns:
+    - The DataLoader.
+    """
+    batches = ArrowBatchDataset(dataset)
+    sampler = RandomSampler(batches) if shuffle else SequentialSampler(batches)
+    # Batches are built by the dataset, so the automatic batching of the DataLoader is disabled
+    return DataLoader(batches,
+                      sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+                      batch_size=None,
+                      collate_fn=collate_fn,
+                      **kwargs)
+
+class QuantileSketch:
+    """
+    Mergeable streaming quantile sketch, following the compactor scheme of KLL.
+
+    Values are kept in levels, a value at level h standing for 2**h input values.
+    When a level holds more than `k` values, it is sorted and every other value is
+    promoted to the next level, so memory stays in O(k log(n/k)) for n values.
+    """
+    def __init__(self, k: int = 2048, seed: int = 0):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.empty(0)]
+
+    def update(self, values: np.ndarray):
+        values = np.sort(np.ravel(values).astype(np.float64))
+        # Compacting large inputs directly, halving a sorted array keeps it sorted
+        level = 0
+        while len(values) > self.k:
+            if len(values) % 2:
+                self._add(level, values[-1:])
+                values = values[:-1]
+            values = values[self.rng.integers(2)::2]
+            level += 1
+        self._add(level, values)
+        self._compress()
+
+    def merge(self, other: 'QuantileSketch'):
+        for level, values in enumerate(other.levels):
+            self._add(level, values)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Returns the approximate quantiles `q` of the values seen so far.
+        """
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return np.full(np.shape(q), np.nan)
+        weights = np.concatenate([np.full(len(v), 2.**h) for h, v in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        cdf = (np.cumsum(weights) - 0.5 * weights) / np.sum(weights)
+        return np.interp(q, cdf, values)
+
+    def _add(self, level, values):
+        while len(self.levels) <= level:
+            self.levels.append(np.empty(0))
+        self.levels[level] = np.concatenate([self.levels[level], values])
+
+    def _compress(self):
+        for level in range(len(self.levels)):
+            if len(self.levels[level]) > self.k:
+                values = np.sort(self.levels[level])
+                # Keeping the odd value out at this level, to preserve the total weight
+                self.levels[level] = values[len(values) - len(values) % 2:]
+                self._add(level + 1, values[:len(values) - len(values) % 2][self.rng.integers(2)::2])
+
+class RunningStatistics:
+    """
+    Streaming per-channel statistics, with count, mean, variance, min, max and an
+    optional quantile sketch per channel.
+
+    Moments are accumulated with Welford's algorithm within a batch and combined with
+    the parallel formula of Chan et al., so the statistics of several shards can be
+    merged exactly, in any order. Non finite values are ignored.
+
+    Parameters:
+    - channel_axis: Axis of the channels within a sample, negative values counting from the
+      last axis of the sample, or None to pool all values.
+    - sketch_size: Size `k` of the quantile sketch of each channel, 0 to disable it.
+    - seed: Seed of the quantile sketches.
+    """
+    def __init__(self, channel_axis: Optional[int] = None, sketch_size: int = 2048, seed: int = 0):
+        self.channel_axis = channel_axis
+        self.sketch_size = sketch_size
+        self.seed = seed
+        self.count = None
+
+    def _init(self, n_channels):
+        self.count = np.zeros(n_channels, dtype=np.int64)
+        self.mean = np.zeros(n_channels)
+        self.m2 = np.zeros(n_channels)
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+        self.sketches = [QuantileSketch(self.sketch_size, seed=self.seed + c) for c in range(n_channels)] if self.sketch_size > 0 else []
+
+    def update(self, batch):
+        """
+        Adds a batch of samples, of shape (batch, *sample_shape), to the statistics.
+        """
+        batch = batch.numpy() if isinstance(batch, torch.Tensor) else np.asarray(batch)
+        batch = batch.astype(np.float64, copy=False)
+        # Reshaping the batch to (channels, values)
+        if self.channel_axis is None:
+            values = batch.reshape(1, -1)
+        else:
+            # The axis is relative to a sample, whose dimensions follow the batch dimension
+            sample_ndim = batch.ndim - 1
+            if not -sample_ndim <= self.channel_axis < sample_ndim:
+                raise ValueError(f'channel_axis {self.channel_axis} is out of bounds for samples of dimension {sample_ndim}.')
+            axis = self.channel_axis % sample_ndim + 1
+            values = np.moveaxis(batch, axis, 0).reshape(batch.shape[axis], -1)
+        if self.count is None:
+            self._init(len(values))
+
+        finite = np.isfinite(values)
+        count = finite.sum(axis=1)
+        valid = np.where(finite, values, 0.)
+        mean = valid.sum(axis=1) / np.maximum(count, 1)
+        m2 = (np.where(finite, values - mean[:, None], 0.)**2).sum(axis=1)
+        self._merge_moments(count, mean, m2,
+                            np.where(finite, values, np.inf).min(axis=1),
+                            np.where(finite, values, -np.inf).max(axis=1))
+        for sketch, v, f in zip(self.sketches, values, finite):
+            sketch.update(v[f])
+        return self
+
+    def merge(self, other: 'RunningStatistics'):
+        """
+        Merges the statistics of another, disjoint, set of samples.
+        """
+        if other.count is None:
+            return self
+        if self.count is None:
+            self._init(len(other.count))
+        self._merge_moments(other.count, other.mean, other.m2, other.min, other.max)
+        for sketch, other_sketch in zip(self.sketches, other.sketches):
+            sketch.merge(other_sketch)
+        return self
+
+    def _merge_moments(self, count, mean, m2, min, max):
+        total = self.count + count
+        delta = mean - self.mean
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta**2 * self.count * count / total, 0.)
+        self.count = total
+        self.min = np.minimum(self.min, min)
+        self.max = np.maximum(self.max, max)
+
+    @property
+    def var(self):
+        return self.m2 / np.maximum(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def quantile(self, q):
+        """
+        Returns the approximate quantiles `q` of each channel, as a (channels, *q.shape) array.
+        """
+        if len(self.sketches) == 0:
+            raise ValueError('Quantiles are not available when sketch_size is 0.')
+        return np.stack([sketch.quantile(q) for sketch in self.sketches])
+
+    def save(self, filename: str, fingerprint: str = ''):
+        """
+        Saves the statistics in a npz file.
+        """
+        sketches = {f'sketch_{c}_{h}': v for c, sketch in enumerate(self.sketches) for h, v in enumerate(sketch.levels)}
+        tmp_filename = filename + '.tmp.npz'
+        np.savez(tmp_filename, count=self.count, mean=self.mean, m2=self.m2, min=self.min, max=self.max,
+                 pooled=self.channel_axis is None, channel_axis=0 if self.channel_axis is None else self.channel_axis,
+                 sketch_size=self.sketch_size, seed=self.seed, fingerprint=fingerprint, **sketches)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename: str):
+        """
+        Loads statistics saved with `save`, returns them along with their fingerprint.
+        """
+        with np.load(filename) as data:
+            channel_axis = None if bool(data['pooled']) else int(data['channel_axis'])
+            stats = cls(channel_axis, int(data['sketch_size']), int(data['seed']))
+            stats._init(len(data['count']))
+            for key in ['count', 'mean', 'm2', 'min', 'max']:
+                setattr(stats, key, data[key])
+            for c, sketch in enumerate(stats.sketches):
+                n_levels = len([k for k in data.files if k.startswith(f'sketch_{c}_')])
+                sketch.levels = [data[f'sketch_{c}_{h}'] for h in range(n_levels)]
+            return stats, str(data['fingerprint'])
+
+def _default_channel_axis(sample_shape):
+    # Images are C x H x W, other features are pooled in a single channel
+    return 0 if len(sample_shape) == 3 else None
+
+_builders = {}
+
+def _shard_statistics(args):
+    path, config_name, files, flag, channel_axis, sketch_size, seed, batch_size = args
+    # Loading the builder once per worker process
+    if (path, config_name) not in _builders:
+        _builders[(path, config_name)] = datasets.load_dataset_builder(path, config_name, trust_remote_code=True)
+    builder = _builders[(path, config_name)]
+
+    dset = datasets.IterableDataset.from_generator(generate_examples,
+                                                   features=builder.info.features,
+                                                   gen_kwargs={'builder': builder, 'files': [files]})
+    stats = RunningStatistics(channel_axis, sketch_size=sketch_size, seed=seed)
+    for batch in dset.with_format('numpy').iter(batch_size=batch_size):
+        stats.update(get_nested(batch, flag))
+    return stats
+
+def _files_fingerprint(files, *args):
+    """
+    Hash of the paths, sizes and modification times of files, along with extra arguments.
+    """
+    h = hashlib.sha256(repr(args).encode())
+    for f in sorted(str(g) for f in files for g in ([f] if isinstance(f, str) else f)):
+        stat = os.stat(f)
+        h.update(f'{f}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return h.hexdigest()
+
+def compute_statistics(
+        path: str,
+        flag: str,
+        config_name: Optional[str] = None,
+        channel_axis: Union[int, None, str] = 'auto',
+        sketch_size: int = 2048,
+        batch_size: int = 128,
+        num_proc: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        overwrite: bool = False
+        ) -> RunningStatistics:
+    """
+    Computes streaming statistics of a feature over all the files of a local dataset.
+
+    Files are reduced in parallel, each in a single sequential read, and their statistics
+    are merged exactly. Results are cached on disk per (dataset, config, feature), and
+    recomputed when the files of the dataset change.
+
+    Parameters:
+    - path: Path to the local dataset directory, containing the dataset script.
+    - flag: The key in the dataset corresponding to the feature of interest.
+    - config_name: The dataset configuration to use.
+    - channel_axis: Axis of the channels within a sample, negative values counting from the last
+      axis, None to pool all values, or 'auto' to use the first axis of images and pool all values
+      of other features.
+    - sketch_size: Size of the quantile sketch of each channel, 0 to disable quantiles.
+    - batch_size: Number of examples per batch when reading a file.
+    - num_proc: Number of worker processes.
+    - cache_dir: Cache directory, defaults to a `mmu_statistics` folder in the datasets cache.
+    - overwrite: Recompute the statistics even if they are cached.
+
+    Returns:
+    - A RunningStatistics holding the statistics of the feature.
+    """
+    builder = datasets.load_dataset_builder(path, config_name, trust_remote_code=True)
+    files = sorted(builder_files(builder), key=str)
+
+    cache_dir = cache_dir or os.path.join(datasets.config.HF_DATASETS_CACHE, 'mmu_statistics')
+    cache_file = os.path.join(cache_dir, os.path.basename(os.path.normpath(path)), builder.config.name, f'{flag}.npz')
+    fingerprint = _files_fingerprint(files, flag, channel_axis, sketch_size)
+    if os.path.exists(cache_file) and not overwrite:
+        stats, cached_fingerprint = RunningStatistics.load(cache_file)
+        if cached_fingerprint == fingerprint:
+            return stats
+
+    if channel_axis == 'auto':
+        sample = next(iter(datasets.IterableDataset.from_generator(
+            generate_examples, features=builder.info.features,
+            gen_kwargs={'builder': builder, 'files': files[:1]}).with_format('numpy')))
+        channel_axis = _default_channel_axis(np.shape(get_nested(sample, flag)))
+
+    # Each file is reduced with its own sketch seed, and merged in file order for reproducibility
+    map_args = [(path, config_name, f, flag, channel_axis, sketch_size, i, batch_size) for i, f in enumerate(files)]
+    stats = RunningStatistics(channel_axis, sketch_size=sketch_size)
+    with Pool(num_proc) as pool:
+        for shard_stats in tqdm.tqdm(pool.imap(_shard_statistics, map_args), total=len(map_args)):
+            stats.merge(shard_stats)
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    stats.save(cache_file, fingerprint=fingerprint)
+    return stats
+
 def compute_dataset_statistics(
         dataset: HF_Dataset, 
         flag: str, 
@@ -35,7 +512,8 @@ def compute_dataset_statistics(
     Computes mean and standard deviation of a dataset for a specific feature.
 
     Parameters:
-    - dataset: The dataset to compute statistics for. Assumes images are B x C x H x W.
+    - dataset: The dataset to compute statistics for. Images are assumed to be C x H x W
+      and get per-channel statistics, other features are pooled.
     - flag: The key in the dataset corresponding to the feature of interest.
     - loading: Specifies whether to load the dataset 'full' at once or 'iterated' through a DataLoader.
     - batch_size: The batch size to use when 'loading' is set to 'iterated'.
@@ -45,43 +523,24 @@ def compute_dataset_statistics(
     - A tuple of (mean, std) tensors for the specified feature.
     """
     dummy = get_nested(dataset[0], flag)
-
-    if len(dummy.shape) == 3:
-        axis = (0, 2, 3)
-        input_channels = dummy.shape[0]
-
-    elif dummy.shape == ():
-        axis = 0
-        input_channels = 1
-
-    else: 
-        raise ValueError('Invalid shape of the feature tensor, only supports images or scalars.')
+    stats = RunningStatistics(_default_channel_axis(dummy.shape), sketch_size=0)
 
     # Compute statistics either for the entire dataset loaded in memory or iteratively.
     if loading == 'full':
-        # print(get_nested(dataset, flag))
-        # TODO @Liam this breaks for me because I can't do get_nested(dataset, flag) because dataset is an indexable list (HF Dataset), not a dict.
-        # can only key into an element or batch, not the whole dataset
-        # iterated works fine as it uses batches
-        mean, std = torch.mean(get_nested(dataset, flag), dim=axis), torch.std(get_nested(dataset, flag), dim=axis)
+        stats.update(get_nested(dataset[:], flag))
     elif loading == 'iterated':
-        mean, mean_sq = torch.zeros(input_channels), torch.zeros(input_channels)
         dummy_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
-        n_batches = len(dummy_loader)
-
         for batch in dummy_loader:
-            # added .float() as pytorch can't take a mean of Long (i.e. uint8)
-            mean += torch.mean(get_nested(batch, flag).float(), dim=axis)
-            mean_sq += torch.mean(get_nested(batch, flag).float()**2, dim=axis)
-
-        mean /= n_batches
-        std = (mean_sq / n_batches - mean**2).sqrt()
+            stats.update(get_nested(batch, flag))
     else:
         raise ValueError('Invalid loading method specified.')
-    
+
+    mean, std = torch.tensor(stats.mean, dtype=torch.float32), torch.tensor(stats.std, dtype=torch.float32)
     if len(dummy.shape) == 3:
         mean = mean[:,None,None]
         std = std[:,None,None]
+    elif len(dummy.shape) == 0:
+        mean, std = mean[0], std[0]
 
     return mean, std
 
@@ -1 +1,2 @@
-from .photo_z import PhotozEvalCallback
\ No newline at end of file
+from .photo_z import PhotozEvalCallback
+from .metrics import RegressionMetrics
\ No newline at end of file
@@ -0,0 +1,108 @@
+import torch
+import numpy as np
+from typing import Dict
+
+__all__ = ['RegressionMetrics', 'get_predictions']
+
+
+def get_predictions(outputs):
+    """Returns the predictions returned by a validation step, or None if the step
+    only returned a loss."""
+    if isinstance(outputs, dict):
+        return outputs.get('preds', None)
+    return None
+
+
+class RegressionMetrics:
+    """Streaming regression metrics, accumulated over batches in preallocated buffers.
+
+    For each property, keeps running sums for the R^2 score and the mean and outlier
+    fraction of the residuals, as well as a fixed-bin histogram of the residuals from
+    which the NMAD is computed, so memory does not grow with the number of samples.
+    With `relative=True`, residuals are normalized as (y_hat - y) / (1 + y), as is
+    customary for redshifts.
+
+    Args:
+        n_properties: Number of predicted properties.
+        relative: Whether to normalize the residuals by (1 + y).
+        outlier_threshold: Absolute residual above which a sample is an outlier.
+        hist_range: Residuals are histogrammed in [-hist_range, hist_range].
+        hist_bins: Number of bins of the residual histogram.
+    """
+    def __init__(self,
+                 n_properties: int = 1,
+                 relative: bool = False,
+                 outlier_threshold: float = 0.15,
+                 hist_range: float = 1.,
+                 hist_bins: int = 20000):
+        self.n_properties = n_properties
+        self.relative = relative
+        self.outlier_threshold = outlier_threshold
+        self.hist_range = hist_range
+        self.hist_bins = hist_bins
+        self.sums = None
+        self.hist = None
+
+    def reset(self):
+        if self.sums is not None:
+            self.sums.zero_()
+            self.hist.zero_()
+
+    def update(self, preds: torch.Tensor, targets: torch.Tensor):
+        """Adds a batch of predictions and targets, of shape (batch, n_properties)."""
+        preds = preds.detach().reshape(-1, self.n_properties).double()
+        targets = targets.detach().reshape(-1, self.n_properties).double()
+        if self.sums is None or self.sums.device != preds.device:
+            self.sums = torch.zeros(6, self.n_properties, dtype=torch.float64, device=preds.device)
+            self.hist = torch.zeros(self.n_properties, self.hist_bins, dtype=torch.float64, device=preds.device)
+
+        delta = preds - targets
+        if self.relative:
+            delta = delta / (1 + targets)
+
+        self.sums += torch.stack([
+            torch.full_like(targets[0], len(targets)),
+            targets.sum(0),
+            (targets**2).sum(0),
+            ((preds - targets)**2).sum(0),
+            delta.sum(0),
+            (delta.abs() > self.outlier_threshold).double().sum(0),
+        ])
+
+        # Residuals outside of the histogram range end up in the edge bins
+        bins = ((delta + self.hist_range) / (2 * self.hist_range) * self.hist_bins).long().clamp(0, self.hist_bins - 1)
+        bins = bins + torch.arange(self.n_properties, device=bins.device) * self.hist_bins
+        self.hist += torch.bincount(bins.flatten(), minlength=self.n_properties * self.hist_bins).reshape(self.hist.shape)
+
+    def reduce(self, strategy):
+        """Sums the buffers across processes with the given Lightning strategy."""
+        if self.sums is not None:
+            self.sums = strategy.reduce(self.sums, reduce_op='sum')
+            self.hist = strategy.reduce(self.hist, reduce_op='sum')
+
+    def compute(self) -> Dict[str, np.ndarray]:
+        """Returns the R^2 score, bias, NMAD and outlier fraction of each property."""
+        n, sum_y, sum_y2, ss_res, sum_delta, n_outliers = self.sums.cpu().numpy()
+        ss_tot = sum_y2 - sum_y**2 / n
+
+        # Median and median absolute deviation of the residuals, from the histogram
+        hist = self.hist.cpu().numpy()
+        width = 2 * self.hist_range / self.hist_bins
+        centers = -self.hist_range + (np.arange(self.hist_bins) + 0.5) * width
+        nmad = np.zeros(self.n_properties)
+        for i in range(self.n_properties):
+            median = _weighted_median(centers, hist[i])
+            nmad[i] = 1.4826 * _weighted_median(np.abs(centers - median), hist[i])
+
+        return {
+            'r2': 1 - ss_res / ss_tot,
+            'bias': sum_delta / n,
+            'nmad': nmad,
+            'outlier_fraction': n_outliers / n,
+        }
+
+
+def _weighted_median(values, weights):
+    order = np.argsort(values, kind='stable')
+    cdf = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cdf, 0.5 * cdf[-1])]
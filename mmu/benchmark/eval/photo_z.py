@@ -4,32 +4,39 @@ from sklearn.metrics import r2_score
 import lightning as L
 import numpy as np
 
+from .metrics import RegressionMetrics, get_predictions
+
 __all__ = ['PhotozEvalCallback']
 
 class PhotozEvalCallback(L.Callback):
-    """Callback to calculate the R^2 score on the validation set."""
-    def __init__(self):
+    """Callback to calculate the R^2 score, bias, NMAD and outlier fraction on the validation set.
+
+    Uses the predictions returned by the validation step when available, and only runs
+    the model again for modules whose validation step returns the loss alone.
+    """
+    def __init__(self, outlier_threshold: float = 0.15):
         super().__init__()
-        self.predictions = []
-        self.targets = []
+        self.metrics = RegressionMetrics(n_properties=1, relative=True, outlier_threshold=outlier_threshold)
 
-    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
-        preds = pl_module(batch)
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        preds = get_predictions(outputs)
+        if preds is None:
+            preds = pl_module(batch)
         targets = batch[pl_module.hparams.target]
-        self.predictions.extend(preds.cpu().numpy())
-        self.targets.extend(targets.cpu().numpy())
+        self.metrics.update(preds, targets)
 
     def on_validation_epoch_end(self, trainer, pl_module):
-        predictions = np.array(self.predictions)
-        targets = np.array(self.targets)
-        r2 = r2_score(targets, predictions)
+        self.metrics.reduce(trainer.strategy)
+        metrics = self.metrics.compute()
 
-        # Log the R^2 score
-        pl_module.log('val_r2', r2, on_epoch=True, prog_bar=True, logger=True)
+        # Log the R^2 score and redshift metrics
+        pl_module.log('val_r2', float(metrics['r2'][0]), on_epoch=True, prog_bar=True, logger=True)
+        pl_module.log('val_bias', float(metrics['bias'][0]), on_epoch=True, logger=True)
+        pl_module.log('val_nmad', float(metrics['nmad'][0]), on_epoch=True, logger=True)
+        pl_module.log('val_outlier_fraction', float(metrics['outlier_fraction'][0]), on_epoch=True, logger=True)
 
-        # Clear the lists for the next epoch
-        self.predictions = []
-        self.targets = []
+        # Clear the buffers for the next epoch
+        self.metrics.reset()
 
 
 def plot_redshift(
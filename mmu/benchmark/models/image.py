@@ -3,9 +3,47 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 from typing import Union, List, Optional
-import torchvision.transforms as transforms
 
-__all__ = ['ConvolutionalModel']
+__all__ = ['ConvolutionalModel', 'RandomDihedral']
+
+
+class RandomDihedral(nn.Module):
+    """Applies a random element of the dihedral group D4, i.e. one of the 8 combinations of a flip and a
+    rotation by a multiple of 90 degrees, drawn independently for each image of a batch.
+
+    The transformations only permute pixels, so they are exact and applied by a single gather over the
+    batch, without interpolation. Works on tensors of shape (..., C, H, W) with square images, on any
+    device, e.g. in the collate function of the DataLoader workers or on the batches in the model.
+    A tensor of shape (C, H, W) is treated as a single image.
+    """
+    def __init__(self, generator: Optional[torch.Generator] = None):
+        super().__init__()
+        self.generator = generator
+        self._permutations = {}
+
+    def permutations(self, size: int, device: torch.device) -> torch.Tensor:
+        """Flattened pixel indices of the 8 transformations of a size x size image, of shape (8, size * size)"""
+        key = (size, device)
+        if key not in self._permutations:
+            index = torch.arange(size * size).view(size, size)
+            self._permutations[key] = torch.stack([
+                torch.rot90(index.flip(-1) if flip else index, k, dims=(-2, -1)).reshape(-1)
+                for flip in (False, True) for k in range(4)
+            ]).to(device)
+        return self._permutations[key]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if x.ndim == 3:
+            return self(x.unsqueeze(0)).squeeze(0)
+        if x.ndim < 3 or x.shape[-1] != x.shape[-2]:
+            raise ValueError(f"Expected a batch of square images, got a tensor of shape {tuple(x.shape)}.")
+        batch_size, size = x.shape[0], x.shape[-1]
+        # Drawn on the CPU, so that a generator can be shared between devices
+        elements = torch.randint(8, (batch_size,), generator=self.generator)
+        index = self.permutations(size, x.device)[elements.to(x.device)]
+        index = index.view(batch_size, *([1] * (x.ndim - 3)), size * size).expand(*x.shape[:-2], size * size)
+        return torch.gather(x.reshape(*x.shape[:-2], size * size), -1, index).view(x.shape)
+
 
 class _ImageModel(L.LightningModule):
     """This is the base model class for image classification. Note that it does not contain the model architecture itself"""
@@ -23,12 +61,8 @@ class _ImageModel(L.LightningModule):
         else:
             raise ValueError(f"Loss {loss} not supported.")
 
-        # Standard image augmentation
-        self.transform = transforms.Compose([
-            transforms.RandomHorizontalFlip(),
-            transforms.RandomVerticalFlip(),
-            transforms.RandomRotation(90)
-        ])
+        # Standard image augmentation, drawing a flip and rotation for each image of the batch
+        self.transform = RandomDihedral()
 
     def forward(self, batch):
         x = batch['image']['array']
@@ -52,7 +86,8 @@ class _ImageModel(L.LightningModule):
         y_hat = self(batch)
         loss = self.loss(y_hat.squeeze(), y.squeeze())
         self.log('val_loss', loss, on_epoch=True, prog_bar=True)
-        return loss
+        # Returning the predictions so that evaluation callbacks don't run the model again
+        return {'loss': loss, 'preds': y_hat}
     
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(self.parameters(), lr=self.hparams.lr)
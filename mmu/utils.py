@@ -44,13 +44,52 @@ def get_catalog(dset: DatasetBuilder,
             catalogs.append(_file_to_catalog(filename, keys=keys))
     return vstack(catalogs)
 
+def _matched_catalog(cat_left: Table,
+                     cat_right: Table,
+                     idx: np.ndarray,
+                     sep2d,
+                     left_name: str,
+                     right_name: str,
+                     matching_radius: float = 1.):
+    """Builds the catalog of the matches between two catalogs, from the index in the right catalog
+    of the nearest neighbour of each object of the left catalog and their separation."""
+    mask = sep2d < matching_radius*u.arcsec
+    cat_left = cat_left[mask]
+    cat_right = cat_right[idx[mask]]
+    assert len(cat_left) == len(cat_right), "There was an error in the cross-matching."
+    print("Initial number of matches: ", len(cat_left))
+    matched_catalog = hstack([cat_left, cat_right], 
+                             table_names=[left_name, right_name],
+                             uniq_col_name='{table_name}_{col_name}')
+    # Remove objects that were matched between the two catalogs but fall under different healpix indices
+    mask = matched_catalog[f'{left_name}_healpix'] == matched_catalog[f'{right_name}_healpix']
+    matched_catalog = matched_catalog[mask]
+    print("Number of matches lost at healpix region borders: ", len(cat_left) - len(matched_catalog))
+    print("Final size of cross-matched catalog: ", len(matched_catalog))
+
+    # Adding default columns to respect format
+    matched_catalog['object_id'] = matched_catalog[left_name+'_object_id']
+    matched_catalog['ra'] = 0.5*(matched_catalog[left_name+'_ra'] +
+                                 matched_catalog[right_name+'_ra'])
+    matched_catalog['dec'] = 0.5*(matched_catalog[left_name+'_dec'] +
+                                 matched_catalog[right_name+'_dec'])
+    
+    # Check that all matches have the same healpix index
+    assert np.all(matched_catalog[left_name+'_healpix'] == matched_catalog[right_name+'_healpix']), "There was an error in the cross-matching."
+    matched_catalog['healpix'] = matched_catalog[left_name+'_healpix']
+    # Within a cell split into several files, matches are sorted by the files holding their objects,
+    # so that the matches read from the same pair of files are contiguous
+    keys = ['healpix'] + [name+'_file_index' for name in [left_name, right_name] if name+'_file_index' in matched_catalog.colnames]
+    return matched_catalog.group_by(keys)
+
 def cross_match_datasets(left : DatasetBuilder, 
                          right : DatasetBuilder,
                          cache_dir : str = None,
                          keep_in_memory : bool = False,
                          matching_radius : float = 1., 
                          return_catalog_only : bool = False,
-                         num_proc : int = None):
+                         num_proc : int = None,
+                         return_catalog : bool = False):
     """ Utility function to generate a new cross-matched dataset from two Multimodal Universe 
     datasets.
 
@@ -61,9 +100,13 @@ def cross_match_datasets(left : DatasetBuilder,
         keep_in_memory (bool, optional): If True, the cross-matched dataset will be kept in memory. Defaults to False.
         matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
         return_catalog_only (bool, optional): If True, only the cross-matched catalog will be returned. Defaults to False.
+        num_proc (int, optional): Number of processes used to read the catalogs and generate the new dataset. Defaults to None.
+        return_catalog (bool, optional): If True, the cross-matched catalog is returned along with the new dataset. 
+            The rows of the dataset follow the order of the catalog, which is sorted by healpix index, and by the
+            files of their objects within cells split into several files. Defaults to False.
 
     Returns:
-        tuple: A tuple containing the cross-matched catalog and the new dataset.
+        Dataset, or a tuple containing the cross-matched catalog and the new dataset if return_catalog is True.
 
     Raises:
         AssertionError: If the number of matches in the cross-matched catalog is not equal for both datasets.
@@ -71,44 +114,23 @@ def cross_match_datasets(left : DatasetBuilder,
     Example:
         left_dataset = ...
         right_dataset = ...
-        matched_catalog, new_dataset = cross_match_datasets(left_dataset, right_dataset)
+        matched_catalog, new_dataset = cross_match_datasets(left_dataset, right_dataset, return_catalog=True)
     """
-    # Access the catalogs for both datasets
-    cat_left = get_catalog(left)
+    # Access the catalogs for both datasets, with the index of the file of each object
+    for builder in [left, right]:
+        if not builder.config.data_files:
+            raise ValueError(f"At least one data file must be specified, but got data_files={builder.config.data_files}")
+    cat_left, cat_right = _indexed_catalogs([left, right], num_proc=num_proc or 1)
     cat_left['sc'] = SkyCoord(cat_left['ra'], 
                               cat_left['dec'], unit='deg')
     
-    cat_right = get_catalog(right)
     cat_right['sc'] = SkyCoord(cat_right['ra'],
                                cat_right['dec'], unit='deg')
 
     # Cross match the catalogs and restricting them to matches
     idx, sep2d, _ = cat_left['sc'].match_to_catalog_sky(cat_right['sc'])
-    mask = sep2d < matching_radius*u.arcsec
-    cat_left = cat_left[mask]
-    cat_right = cat_right[idx[mask]]
-    assert len(cat_left) == len(cat_right), "There was an error in the cross-matching."
-    print("Initial number of matches: ", len(cat_left))
-    matched_catalog = hstack([cat_left, cat_right], 
-                             table_names=[left.config.name, right.config.name],
-                             uniq_col_name='{table_name}_{col_name}')
-    # Remove objects that were matched between the two catalogs but fall under different healpix indices
-    mask = matched_catalog[f'{left.config.name}_healpix'] == matched_catalog[f'{right.config.name}_healpix']
-    matched_catalog = matched_catalog[mask]
-    print("Number of matches lost at healpix region borders: ", len(cat_left) - len(matched_catalog))
-    print("Final size of cross-matched catalog: ", len(matched_catalog))
-
-    # Adding default columns to respect format
-    matched_catalog['object_id'] = matched_catalog[left.config.name+'_object_id']
-    matched_catalog['ra'] = 0.5*(matched_catalog[left.config.name+'_ra'] +
-                                 matched_catalog[right.config.name+'_ra'])
-    matched_catalog['dec'] = 0.5*(matched_catalog[left.config.name+'_dec'] +
-                                 matched_catalog[right.config.name+'_dec'])
-    
-    # Check that all matches have the same healpix index
-    assert np.all(matched_catalog[left.config.name+'_healpix'] == matched_catalog[right.config.name+'_healpix']), "There was an error in the cross-matching."
-    matched_catalog['healpix'] = matched_catalog[left.config.name+'_healpix']
-    matched_catalog = matched_catalog.group_by(['healpix'])
+    matched_catalog = _matched_catalog(cat_left, cat_right, idx, sep2d, left.config.name, right.config.name,
+                                       matching_radius=matching_radius)
 
     if return_catalog_only:
         return matched_catalog
@@ -116,18 +138,18 @@ def cross_match_datasets(left : DatasetBuilder,
     # Retrieve the list of files of both datasets
     files_left = left.config.data_files['train']
     files_right = right.config.data_files['train']
+    # The catalog is grouped by healpix index and by the files of the matched objects
     catalog_groups = [group for group in matched_catalog.groups]
     # Create a generator function that merges the two generators
     def _generate_examples(groups):
         for group in groups:
-            healpix = group['healpix'][0]
             generators = [
-                        # Build generators that only reads the files corresponding to the current healpix index
+                        # Build generators that only read the pair of files holding the objects of the current group
                         left._generate_examples(
-                                        files=[files_left[[i for i in range(len(files_left)) if f'healpix={healpix}'in files_left[i]][0]]],
+                                        files=[files_left[group[left.config.name+'_file_index'][0]]],
                                         object_ids=[group[left.config.name+'_object_id']]),
                         right._generate_examples(
-                                        files=[files_right[[i for i in range(len(files_right)) if f'healpix={healpix}'in files_right[i]][0]]],
+                                        files=[files_right[group[right.config.name+'_file_index'][0]]],
                                         object_ids=[group[right.config.name+'_object_id']])
                     ]
             # Retrieve the generators for both datasets
@@ -148,13 +170,132 @@ def cross_match_datasets(left : DatasetBuilder,
                    f"{left.info.description}\n\n{right.info.description}")
     
     # Create the new dataset
-    return Dataset.from_generator(_generate_examples,
-                                                   features,
-                                                   cache_dir=cache_dir,
-                                                   gen_kwargs={'groups':catalog_groups},
-                                                   num_proc=num_proc,
-                                                   keep_in_memory=keep_in_memory,
-                                                   description=description)
+    dataset = Dataset.from_generator(_generate_examples,
+                                     features,
+                                     cache_dir=cache_dir,
+                                     gen_kwargs={'groups':catalog_groups},
+                                     num_proc=num_proc,
+                                     keep_in_memory=keep_in_memory,
+                                     description=description)
+    if return_catalog:
+        return matched_catalog, dataset
+    return dataset
+
+
+def _indexed_file_to_catalog(args):
+    file_index, filename, keys = args
+    catalog = _file_to_catalog(filename, keys)
+    catalog['file_index'] = np.full(len(catalog), file_index)
+    return catalog
+
+def _indexed_catalogs(builders: List[DatasetBuilder],
+                      keys: List[str] = ['object_id', 'ra', 'dec', 'healpix'],
+                      num_proc: int = 1):
+    """Returns the catalogs of several datasets, with the index of the file of each object in the
+    `file_index` column, reading the files of all the datasets in a single pool of processes."""
+    tasks = [(i, j, filename) for i, builder in enumerate(builders)
+             for j, filename in enumerate(builder.config.data_files['train'])]
+    args = [(j, filename, keys) for _, j, filename in tasks]
+    if num_proc > 1:
+        with Pool(num_proc) as pool:
+            tables = pool.map(_indexed_file_to_catalog, args)
+    else:
+        tables = [_indexed_file_to_catalog(a) for a in args]
+    return [vstack([table for (i, _, _), table in zip(tasks, tables) if i == k]) for k in range(len(builders))]
+
+def cross_match_configs(lefts: List[DatasetBuilder],
+                        right: DatasetBuilder,
+                        cache_dir: str = None,
+                        keep_in_memory: bool = False,
+                        matching_radius: float = 1.,
+                        num_proc: int = None,
+                        return_catalog: bool = False):
+    """ Cross-matches several configurations of a Multimodal Universe dataset, e.g. the sub-surveys of
+    SDSS, with another dataset, in a single pass.
+
+    The catalog of the right dataset is loaded and indexed once, the catalogs of all the left configurations
+    are matched against it in a single query, and the examples of all the configurations are generated by a
+    single `Dataset.from_generator` call, distributed over `num_proc` processes.
+
+    Args:
+        lefts (List[GeneratorBasedBuilder]): The builders of the configurations of the left dataset.
+        right (GeneratorBasedBuilder): The right dataset to be cross-matched.
+        cache_dir (str, optional): The directory to cache the cross-matched dataset. Defaults to None.
+        keep_in_memory (bool, optional): If True, the cross-matched dataset will be kept in memory. Defaults to False.
+        matching_radius (float, optional): The maximum separation in arcseconds for a match to be considered. Defaults to 1.
+        num_proc (int, optional): Number of processes used to read the catalogs and generate the new dataset. Defaults to None.
+        return_catalog (bool, optional): If True, the list of the cross-matched catalogs of the configurations is
+            returned along with the new dataset. Defaults to False.
+
+    Returns:
+        Dataset, holding the matches of each configuration in turn, sorted by healpix index and then by the
+        files of their objects, or a tuple containing the list of cross-matched catalogs and the new dataset
+        if return_catalog is True.
+    """
+    for left in lefts:
+        if not left.config.data_files:
+            raise ValueError(f"At least one data file must be specified, but got data_files={left.config.data_files}")
+    if not right.config.data_files:
+        raise ValueError(f"At least one data file must be specified, but got data_files={right.config.data_files}")
+    *cat_lefts, cat_right = _indexed_catalogs(list(lefts) + [right], num_proc=num_proc or 1)
+
+    # All the configurations are matched at once, building the search tree of the right catalog once
+    config_index = np.concatenate([np.full(len(cat), i) for i, cat in enumerate(cat_lefts)])
+    sc_left = SkyCoord(np.concatenate([np.asarray(cat['ra']) for cat in cat_lefts]),
+                       np.concatenate([np.asarray(cat['dec']) for cat in cat_lefts]), unit='deg')
+    sc_right = SkyCoord(cat_right['ra'], cat_right['dec'], unit='deg')
+    idx, sep2d, _ = sc_left.match_to_catalog_sky(sc_right)
+
+    catalogs = []
+    groups = []
+    for i, (left, cat_left) in enumerate(zip(lefts, cat_lefts)):
+        print("Matching config from left dataset: ", left.config.name)
+        matched_catalog = _matched_catalog(cat_left, cat_right, idx[config_index == i], sep2d[config_index == i],
+                                           left.config.name, right.config.name, matching_radius=matching_radius)
+        catalogs.append(matched_catalog)
+        # Examples are generated for each pair of files holding matched objects, which are contiguous in the catalog
+        left_files = np.asarray(matched_catalog[left.config.name+'_file_index'])
+        right_files = np.asarray(matched_catalog[right.config.name+'_file_index'])
+        starts = np.flatnonzero(np.concatenate([[True], (left_files[1:] != left_files[:-1]) | (right_files[1:] != right_files[:-1])]))
+        for start, stop in zip(starts, np.append(starts[1:], len(matched_catalog))):
+            groups.append((i, int(left_files[start]), int(right_files[start]),
+                           matched_catalog[left.config.name+'_object_id'][start:stop],
+                           matched_catalog[right.config.name+'_object_id'][start:stop]))
+
+    files_lefts = [left.config.data_files['train'] for left in lefts]
+    files_right = right.config.data_files['train']
+    def _generate_examples(groups):
+        for i, left_file, right_file, left_ids, right_ids in groups:
+            generators = [
+                lefts[i]._generate_examples(files=[files_lefts[i][left_file]], object_ids=[left_ids]),
+                right._generate_examples(files=[files_right[right_file]], object_ids=[right_ids])
+            ]
+            for j, ((left_id, example_left), (right_id, example_right)) in enumerate(zip(*generators)):
+                assert str(left_ids[j]) in left_id, "There was an error in the cross-matching generation."
+                assert str(right_ids[j]) in right_id, "There was an error in the cross-matching generation."
+                example_left.update(example_right)
+                yield example_left
+
+    # Merging the features of all datasets
+    features = lefts[0].info.features.copy()
+    for left in lefts[1:]:
+        features.update(left.info.features)
+    features.update(right.info.features)
+
+    description = (f"Cross-matched dataset between {lefts[0].info.builder_name}:{','.join(left.info.config_name for left in lefts)} "
+                   f"and {right.info.builder_name}:{right.info.config_name}.\nBelow are the original descriptions\n\n"
+                   f"{lefts[0].info.description}\n\n{right.info.description}")
+
+    dataset = Dataset.from_generator(_generate_examples,
+                                     features,
+                                     cache_dir=cache_dir,
+                                     gen_kwargs={'groups': groups},
+                                     num_proc=num_proc,
+                                     keep_in_memory=keep_in_memory,
+                                     description=description)
+    if return_catalog:
+        return catalogs, dataset
+    return dataset
 
 
 def extract_cat_params(cat: DatasetBuilder):
@@ -1,5 +1,6 @@
 import argparse
 import os
+import sys
 import urllib
 from functools import partial
 from multiprocessing import Pool
@@ -12,6 +13,10 @@ from astropy.table import Table, hstack, join
 from tqdm import tqdm
 from tqdm.contrib.concurrent import process_map
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prefetch import DEFAULT_DEPTH, DEFAULT_MB, file_size, prefetch
+from scheduler import plan_cells, print_plan, remove_stale_shards
+
 _healpix_nside = 16
 
 # APOGEE shares a global wavelength grid
@@ -207,7 +212,7 @@ def processing_fn(raw_filename, continuum_filename):
         print(f"Error in processing_fn for file {raw_filename}")
 
 
-def save_in_standard_format(args):
+def save_in_standard_format(args, prefetch_depth=DEFAULT_DEPTH, prefetch_mb=DEFAULT_MB):
     """
     This function takes care of iterating through the different input files
     corresponding to this healpix index, and exporting the data in standard format.
@@ -226,18 +231,28 @@ def save_in_standard_format(args):
 
         # Preparing the arguments for the parallel processing
         # Process all files
-        results = []
+        files = []
         for i in catalog:
             telescope = i["TELESCOPE"]
             field = i["FIELD"]
             filename = i["FILE"]
             apogee_id = i["APOGEE_ID"]
-            results.append(
-                processing_fn(
+            files.append(
+                (
                     visit_spectra(apogee_data_path, field, telescope, filename),
                     combined_spectra(apogee_data_path, field, apogee_id, telescope),
                 )
             )
+        # Files are read ahead in threads while the previous ones are processed
+        results = list(
+            prefetch(
+                files,
+                lambda f: processing_fn(*f),
+                depth=prefetch_depth,
+                max_bytes=prefetch_mb * 1024**2,
+                size=lambda f: file_size(*f),
+            )
+        )
 
         # Aggregate all spectra into an astropy table
         spectra = Table(
@@ -311,24 +326,27 @@ def main(args):
         lonlat=True,
         nest=True,
     )
-    catalog = catalog.group_by(["healpix"])
+
+    # Largest cells first, dense cells being split into shards with --oversubscription
+    tasks = plan_cells(catalog["healpix"], num_workers=args.num_processes, oversubscription=args.oversubscription)
+    cell_dir = lambda healpix: os.path.join(args.output_dir, "apogee/healpix={}".format(healpix))
+    remove_stale_shards(tasks, cell_dir)
+    print_plan(tasks, args.num_processes)
 
     # Preparing the arguments for the parallel processing
     map_args = []
 
-    for group in catalog.groups:
-        # Create a filename for the group
-        group_filename = os.path.join(
-            args.output_dir,
-            "apogee/healpix={}/001-of-001.hdf5".format(group["healpix"][0]),
-        )
-        map_args.append((group, group_filename, args.apogee_data_path))
+    for task in tasks:
+        map_args.append((catalog[task.rows], task.filename(cell_dir(task.healpix)), args.apogee_data_path))
 
     print("Processing data...")
     # Run the parallel processing
     with Pool(args.num_processes) as pool:
         results = list(
-            tqdm(pool.imap(save_in_standard_format, map_args), total=len(map_args))
+            tqdm(pool.imap_unordered(
+                partial(save_in_standard_format, prefetch_depth=args.prefetch_depth, prefetch_mb=args.prefetch_mb),
+                map_args,
+            ), total=len(map_args))
         )
 
     if sum(results) != len(map_args):
@@ -361,6 +379,24 @@ if __name__ == "__main__":
         action="store_true",
         help="Use a tiny subset of the data for testing",
     )
+    parser.add_argument(
+        "--oversubscription",
+        type=float,
+        default=None,
+        help="Split dense healpix cells into shards, so that each task costs at most the total divided by oversubscription times the number of processes. Cells are not split by default",
+    )
+    parser.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=DEFAULT_DEPTH,
+        help="Number of spectrum files read ahead in threads by each process, 0 to read them one at a time",
+    )
+    parser.add_argument(
+        "--prefetch_mb",
+        type=float,
+        default=DEFAULT_MB,
+        help="Maximum size in MB of the spectrum files read ahead by each process",
+    )
     args = parser.parse_args()
 
     main(args)
@@ -4,11 +4,12 @@
 # https://sherpa.readthedocs.io/en/latest/install.html
 
 import os
+import sys
 import shutil
 import logging
 import numpy as np
 import pyvo as vo
-from astropy.table import Table, Column, join, vstack
+from astropy.table import Table, Column, vstack
 import glob
 from sherpa.astro import ui # CIAO/Sherpa imports
 import h5py
@@ -16,50 +17,70 @@ import argparse
 import healpy as hp
 import tqdm
 from multiprocessing import Pool
-from functools import partial
-from tqdm.contrib.concurrent import process_map 
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ragged import write_ragged
 
 _healpix_nside = 16
 
+# Columns of the binned spectra, stored as ragged columns of the `spectrum` group of the output files
+_SPECTRUM_COLUMNS = ["ene_lo", "ene_hi", "ene", "flux", "flux_err"]
+
+# Index of the catalog, mapping the (obsid, obi, region_id) of each source to its row, set in each
+# worker by `init_worker` so that it is sent once per process rather than with every file
+_source_index = None
+
+
+def parse_pha_filename(file):
+    """ Returns the (obsid, obi, region_id) of a PHA file, e.g. acisf01575_001N021_r0001_pha3.fits,
+    or acisf01575_001N021_e2_r0001_pha3.fits for the second extraction of a region """
+    basename = os.path.basename(file.strip())
+    fields = basename[0:24].strip().split('_')
+    if fields[2][-4:] == 'e2':
+        region = basename[0:27].strip().split('_')[3]
+    else:
+        region = fields[2]
+    return int(fields[0][-5:]), int(fields[1][0:3]), int(region[-4:])
+
+
+def build_source_index(catalog):
+    """ Maps the (obsid, obi, region_id) of the sources of the catalog to their row, keeping the first one """
+    keys = zip(np.asarray(catalog['obsid']).tolist(),
+               np.asarray(catalog['obi']).tolist(),
+               np.asarray(catalog['region_id']).tolist())
+    index = {}
+    for row, key in enumerate(keys):
+        index.setdefault(key, row)
+    return index
+
+
+def init_worker(source_index):
+    global _source_index
+    _source_index = source_index
 
-def processing_fn(catalog, file):
-    
-    output = {
-        "name": [],        # Target ID
-        "obsid": [],       # Observation ID
-        "obi": [],         # Observation interval
-        "spectrum_ene_lo": [],  # Low end of the energy bin
-        "spectrum_ene_hi": [],  # High end of the energy bin
-        "spectrum_ene": [],     # Mid point of the energy bin
-        "spectrum_flux": [],    # Counts/sec/keV
-        "spectrum_flux_err": [] # Error in count value
-    }
 
-    # for file in files:
+def processing_fn(file):
+    """ Returns the row of the source of a PHA file in the catalog and its binned spectrum,
+    or None if the source is not in the catalog """
+    row = _source_index.get(parse_pha_filename(file))
+    if row is None:
+        return None
+
     ui.load_pha(file)               # Load file
     ui.ignore('0.:0.5,8.0:')        # Set energy range
     ui.subtract()                   # Subtract background
     ui.group_counts(5)              # Bin counts in energy axis
     pdata = ui.get_data_plot()      # Get the object with the spectral bins
-    output["spectrum_ene_lo"].append(pdata.xlo)   
-    output["spectrum_ene_hi"].append(pdata.xhi)
-    output["spectrum_ene"].append(pdata.x)
-    output["spectrum_flux"].append(pdata.y)
-    output["spectrum_flux_err"].append(pdata.yerr)
-    if (file.strip().split('/')[-1][0:24].strip().split('_')[2][-4:] == 'e2'):
-        src_name = catalog['name'][(catalog['obsid'] == int(file.strip().split('/')[-1][0:27].strip().split('_')[0][-5:])) &
-            (catalog['obi'] == int(file.strip().split('/')[-1][0:27].strip().split('_')[1][0:3])) &
-            (catalog['region_id'] == int(file.strip().split('/')[-1][0:27].strip().split('_')[3][-4:]))]
-    else:
-        src_name = catalog['name'][(catalog['obsid'] == int(file.strip().split('/')[-1][0:24].strip().split('_')[0][-5:])) &
-            (catalog['obi'] == int(file.strip().split('/')[-1][0:24].strip().split('_')[1][0:3])) &
-            (catalog['region_id'] == int(file.strip().split('/')[-1][0:24].strip().split('_')[2][-4:]))]
-    output["name"].append(src_name.data[0])
-    output["obsid"].append(int(file.strip().split('/')[-1][0:24].strip().split('_')[0][-5:]))
-    output["obi"].append(int(file.strip().split('/')[-1][0:24].strip().split('_')[1][0:3]))
-        
+    spectrum = {
+        "ene_lo": pdata.xlo,        # Low end of the energy bin
+        "ene_hi": pdata.xhi,        # High end of the energy bin
+        "ene": pdata.x,             # Mid point of the energy bin
+        "flux": pdata.y,            # Counts/sec/keV
+        "flux_err": pdata.yerr,     # Error in count value
+    }
+
     # Return the results
-    return output
+    return row, spectrum
 
 def save_in_standard_format(catalog, output_path=".", chandra_data_path="./output_data/", num_workers=1):
     """ Save the spectra in standard HDF5 format
@@ -69,25 +90,28 @@ def save_in_standard_format(catalog, output_path=".", chandra_data_path="./outpu
     logger = logging.getLogger('sherpa')
     logger.setLevel(logging.ERROR)
 
+    catalog = Table(catalog)
+    source_index = build_source_index(catalog)
+
     # Find all files in the directory
     files = glob.glob(chandra_data_path+'/*/*pha*')
     print("Loading {} files...".format(len(files)))
-    results = process_map(partial(processing_fn, catalog), files, max_workers=num_workers, chunksize=10)
+    with Pool(num_workers, initializer=init_worker, initargs=(source_index,)) as pool:
+        results = list(tqdm.tqdm(pool.imap(processing_fn, files, chunksize=10), total=len(files)))
     print("Finished processing files")
-    spectra = {k: [results[i][k][0] for i in range(len(results))] for k in results[0].keys()}
+    n_missing = sum(result is None for result in results)
+    if n_missing > 0:
+        print(f"Skipped {n_missing} files whose source is not in the catalog")
+    results = sorted((result for result in results if result is not None), key=lambda result: result[0])
+
+    # Sources of the spectra, in the order of the catalog
+    rows = np.array([row for row, _ in results], dtype=np.int64)
+    spectra = [spectrum for _, spectrum in results]
+    catalog = catalog[rows]
 
-    spectra = Table(spectra)
-    catalog = Table(catalog)
-    
     catalog['name'] = catalog['name'].astype(str)
     catalog['obsid'] = catalog['obsid'].astype(int)
     catalog['obi'] = catalog['obi'].astype(int)
-    spectra['name'] = spectra['name'].astype(str)
-    spectra['obsid'] = spectra['obsid'].astype(int)
-    spectra['obi'] = spectra['obi'].astype(int)
-
-    # Join on target id with the input catalog
-    catalog = join(catalog, spectra, keys=['name','obsid','obi'], join_type='inner')
 
     # Add an object id
     catalog['object_id'] = np.arange(len(catalog))
@@ -96,26 +120,27 @@ def save_in_standard_format(catalog, output_path=".", chandra_data_path="./outpu
     catalog['healpix'] = hp.ang2pix(_healpix_nside, catalog['ra'], catalog['dec'], lonlat=True, nest=True)
 
     # Group objects by healpix index
-    groups = catalog.group_by('healpix')
+    order = np.argsort(catalog['healpix'], kind='stable')
+    cells, starts = np.unique(catalog['healpix'][order], return_index=True)
     print("Outputting data in hdf5")
-    for catalog in tqdm.tqdm(groups.groups):
-        group_filename = os.path.join(output_path, 'healpix={}/001-of-001.hdf5'.format(catalog['healpix'][0]))
+    for healpix, group in tqdm.tqdm(zip(cells, np.split(order, starts[1:])), total=len(cells)):
+        group_filename = os.path.join(output_path, 'healpix={}/001-of-001.hdf5'.format(healpix))
         os.makedirs(os.path.dirname(group_filename), exist_ok=True)
+        cell = catalog[group]
         with h5py.File(group_filename, 'w') as hdf5_file:
-            for key in catalog.colnames:
+            for key in cell.colnames:
                 # Check if the column data type is a string
-                if catalog[key].dtype.kind in ['U', 'S']:
+                if cell[key].dtype.kind in ['U', 'S']:
                     # Encode Unicode string to byte string
-                    encoded_strings = np.char.encode(catalog[key], 'utf-8')
+                    encoded_strings = np.char.encode(cell[key], 'utf-8')
                     hdf5_file.create_dataset(key, data=encoded_strings)
-                elif catalog[key].dtype == 'O':  # Column with object dtype, potentially variable-length arrays
-                    dt = h5py.special_dtype(vlen=np.dtype('float64'))  # or float32 if more appropriate
-                    dataset = hdf5_file.create_dataset(key, (len(catalog[key]),), dtype=dt)
-                    for i, item in enumerate(catalog[key]):
-                        dataset[i] = item  # Assign the variable-length array directly
                 else:
                     # Directly save the column as a dataset for non-string types
-                    hdf5_file.create_dataset(key, data=catalog[key])                
+                    hdf5_file.create_dataset(key, data=cell[key])
+            # Variable-length spectra are written as flat values and offsets, one call per column
+            write_ragged(hdf5_file, 'spectrum',
+                         {k: [spectra[i][k] for i in group] for k in _SPECTRUM_COLUMNS},
+                         dtype=np.float64)
 
 def main(args):
     # Load the catalog from the catalog file, process the spectra, and save
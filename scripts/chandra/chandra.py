@@ -76,6 +76,15 @@ _FLOAT_FEATURES = [
     "var_prob_b",
 ]
 
+# Features of the spectra, and the columns from which they are read
+_SPECTRUM_COLUMNS = {
+    "ene_center_bin": "ene",
+    "ene_high_bin": "ene_hi",
+    "ene_low_bin": "ene_lo",
+    "flux": "flux",
+    "flux_error": "flux_err",
+}
+
 class CHANDRA(datasets.GeneratorBasedBuilder):
     """Chandra Source Catalog 2.1 dataset for X-ray spectral data."""
 
@@ -145,20 +154,22 @@ class CHANDRA(datasets.GeneratorBasedBuilder):
                 sort_index = np.argsort(data["object_id"])
                 sorted_ids = data["object_id"][:][sort_index]
 
+                # Spectra are stored either as ragged columns of the `spectrum` group, with the
+                # offsets of the rows in the flat values of each column, or one row per object
+                if isinstance(data.get("spectrum"), h5py.Group):
+                    offsets = data["spectrum"]["offsets"][:]
+                    spectrum = {k: data["spectrum"][v][:] for k, v in _SPECTRUM_COLUMNS.items()}
+                    get_spectrum = lambda i: {k: v[offsets[i]:offsets[i + 1]] for k, v in spectrum.items()}
+                else:
+                    get_spectrum = lambda i: {k: data[f"spectrum_{v}"][i] for k, v in _SPECTRUM_COLUMNS.items()}
+
                 for k in keys:
                     # Extract the indices of requested ids in the catalog 
                     i = sort_index[np.searchsorted(sorted_ids, k)]
                     
                     # Parse spectrum data
                     example = {
-                        "spectrum": 
-                            {
-                                "ene_center_bin": data['spectrum_ene'][i], 
-                                "ene_high_bin": data['spectrum_ene_hi'][i],
-                                "ene_low_bin": data['spectrum_ene_lo'][i],
-                                "flux": data['spectrum_flux'][i],
-                                "flux_error": data['spectrum_flux_err'][i],
-                            }
+                        "spectrum": get_spectrum(i)
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
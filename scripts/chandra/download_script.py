@@ -24,14 +24,27 @@
 # Imports
 import pyvo as vo
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 import h5py
 import numpy as np
 import os
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 
 # CSC 2.1 TAP service
 tap = vo.dal.TAPService('http://cda.cfa.harvard.edu/csc21tap') # For CSC 2.1
 
+# This is the url for retrieval to data at the CfA
+RETRIEVE_URL = 'http://cda.cfa.harvard.edu/csccli/retrieve'
+
+# Data products downloaded for each detection, the PHA spectrum and its ARF and RMF responses,
+# which Sherpa loads along with the PHA file
+DATATYPES = ['spectrum', 'rmf', 'arf']
+
 
 def get_source_detections_ids(min_cnts=40, min_sig=4, max_theta=10, output_file="file_ids.txt", file_path="./output_data/"):
 
@@ -81,18 +94,147 @@ def get_source_detections_ids(min_cnts=40, min_sig=4, max_theta=10, output_file=
     return 1
 
 
-def retrieve(url, packageset, idx, file_path):
-    if os.path.exists(file_path+f'package.{idx}.tar'):
-        print(f'File {file_path}package.{idx}.tar already exists. Skipping download.')
-    else:
-        # This function retreives the data and saves them in tarballs
-        response = requests.get(url, params={
-            'version': 'cur',  # Current version of the CSC
-            'packageset': packageset
-        })
-        with open(file_path+f'package.{idx}.tar', 'wb') as output:
-            output.write(response.content)
-    return 1
+def package_requests(ids_file, number_of_identifiers_per_request=50, datatypes=DATATYPES):
+    """ Returns the (index, packageset) of the packages of detections listed in a file of ids,
+    with `number_of_identifiers_per_request` detections per package, the last one included even if smaller """
+    with open(ids_file, 'r') as input:
+        ids = [line.strip() for line in input if line.strip()]
+    packages = []
+    for start in range(0, len(ids), number_of_identifiers_per_request):
+        packageset = ','.join(f'{detection}/{datatype}/b'
+                              for detection in ids[start:start + number_of_identifiers_per_request]
+                              for datatype in datatypes)
+        packages.append((start // number_of_identifiers_per_request + 1, packageset))
+    return packages
+
+
+def make_session(num_workers=4, retries=3):
+    """ Session reusing up to `num_workers` connections, retrying failed requests with backoff """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _TeeReader:
+    """ File-like reader of the chunks of a response, which writes them to a file as they are read """
+
+    def __init__(self, chunks, output):
+        self.chunks = chunks
+        self.output = output
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.output.write(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self):
+        """ Writes the rest of the response, e.g. the padding after the end of the archive """
+        for chunk in self.chunks:
+            self.output.write(chunk)
+
+
+def _safe_members(members, extract_path):
+    """ Regular files and directories of an archive which are extracted inside `extract_path` """
+    root = os.path.realpath(extract_path)
+    for member in members:
+        target = os.path.realpath(os.path.join(root, member.name))
+        if (member.isfile() or member.isdir()) and os.path.commonpath([root, target]) == root:
+            yield member
+
+
+def _extract(tar, extract_path):
+    for member in _safe_members(tar, extract_path):
+        tar.extract(member, extract_path)
+
+
+def download_package(session, url, packageset, idx, file_path, extract_path=None, chunk_size=1024**2, timeout=600):
+    """ Downloads a package of detections to `package.{idx}.tar` and extracts its files.
+
+    The tarball is streamed to `package.{idx}.tar.part`, and its files are extracted as it is
+    downloaded. An interrupted download is resumed from the size of its partial tarball with a range
+    request, and extracted once complete. The tarball is only renamed once downloaded and extracted,
+    so that existing tarballs are skipped.
+    """
+    extract_path = file_path if extract_path is None else extract_path
+    tar_path = os.path.join(file_path, f'package.{idx}.tar')
+    part_path = tar_path + '.part'
+    if os.path.exists(tar_path):
+        return 'skipped'
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+    params = {
+        'version': 'cur',  # Current version of the CSC
+        'packageset': packageset
+    }
+    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # The partial tarball is already complete
+            resumed = True
+        else:
+            response.raise_for_status()
+            # Servers ignoring the range send the whole tarball again
+            resumed = offset > 0 and response.status_code == 206
+            chunks = (chunk for chunk in response.iter_content(chunk_size=chunk_size) if chunk)
+            with open(part_path, 'ab' if resumed else 'wb') as output:
+                if resumed:
+                    for chunk in chunks:
+                        output.write(chunk)
+                else:
+                    reader = _TeeReader(chunks, output)
+                    try:
+                        with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                            _extract(tar, extract_path)
+                    except tarfile.TarError:
+                        # Not a tarball, e.g. an error page, which must not be resumed
+                        output.close()
+                        os.remove(part_path)
+                        raise
+                    reader.drain()
+
+    if resumed:
+        with tarfile.open(part_path) as tar:
+            _extract(tar, extract_path)
+    os.replace(part_path, tar_path)
+    return 'resumed' if resumed else 'downloaded'
+
+
+def download_packages(packages, file_path, url=RETRIEVE_URL, num_workers=4, extract_path=None):
+    """ Downloads packages of detections with up to `num_workers` concurrent requests over a shared session.
+
+    Returns:
+        The list of (index, error) of the packages which failed to download.
+    """
+    session = make_session(num_workers)
+    failed = []
+    counts = {'downloaded': 0, 'resumed': 0, 'skipped': 0}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(download_package, session, url, packageset, idx, file_path, extract_path): idx
+                   for idx, packageset in packages}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Downloading packages'):
+            try:
+                counts[future.result()] += 1
+            except Exception as e:
+                failed.append((futures[future], f'{type(e).__name__}: {e}'))
+    session.close()
+    print(f"{counts['downloaded']} packages downloaded, {counts['resumed']} resumed, "
+          f"{counts['skipped']} already downloaded, {len(failed)} failed")
+    for idx, error in sorted(failed):
+        print(f'Failed package {idx}: {error}')
+    return failed
 
 
 def main(args):
@@ -100,54 +242,12 @@ def main(args):
     # Generate file of ids
     get_source_detections_ids(args.min_cnts, args.min_sig, args.max_theta, args.output_file, args.file_path)
 
-    # This is the url for retrieval to data at the CfA
-    url = 'http://cda.cfa.harvard.edu/csccli/retrieve'
+    # We will download the data in packages of 50 detections each, the file below
+    # contains the list of detection IDs
+    packages = package_requests(args.file_path+args.output_file+'_ids.txt', number_of_identifiers_per_request=50)
+    failed = download_packages(packages, args.file_path, num_workers=args.num_workers)
 
-    # We will download the data in packages of 50 detections each
-    number_of_identifiers_per_request = 50
-
-    packageset = ''
-    number_of_identifiers = 0
-
-    # The file below contains the list of detection IDs
-    separator = ''
-    with open(args.file_path+args.output_file+'_ids.txt', 'r') as input:
-        # read header line and ignore it
-        input.readline()
-    
-        while True:
-            line = input.readline()
-            if '' == line:
-                break
-            line = line.rstrip()
-
-            number_of_identifiers += 1
-        
-            # Here we specify which datatypes to download
-            #packageset += separator + line + '/lightcurve/b'
-            #separator = ','
-            packageset += separator + line + '/spectrum/b'
-            separator = ','
-            packageset += separator + line + '/rmf/b'
-            separator = ','
-            packageset += separator + line + '/arf/b'
-            separator = ','
-        
-            if 0 == number_of_identifiers % number_of_identifiers_per_request:
-                retrieve(url, packageset, int(number_of_identifiers / number_of_identifiers_per_request),args.file_path)
-
-                packageset = ''
-                separator = ''
-            
-                # Print progress with
-                # the current set thresholds of S/N, etc.
-                print(number_of_identifiers)
-        
-
-                if 0 != number_of_identifiers % number_of_identifiers_per_request:
-                    retrieve(url, packageset, int(number_of_identifiers / number_of_identifiers_per_request)+1,args.file_pat)
-
-        return 1
+    return 0 if not failed else 1
 
 
 if __name__ == '__main__':
@@ -157,7 +257,8 @@ if __name__ == '__main__':
     parser.add_argument('--max_theta', type=float, default=10, help='Maximum off-axis angle')
     parser.add_argument('--output_file', type=str, default='file_ids.txt', help='Name of file')
     parser.add_argument('--file_path', type=str, default='./output_data/', help='Path to files. Must be default to work with the Chandra HF dataset class.')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of packages downloaded concurrently')
     args = parser.parse_args()
 
-    main(args)
+    sys.exit(main(args))
 
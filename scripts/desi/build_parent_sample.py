@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 import numpy as np
 from astropy.table import Table, join
@@ -9,6 +10,10 @@ import h5py
 import healpy as hp
 from tqdm.contrib.concurrent import process_map
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from scheduler import plan_cells, print_plan, remove_stale_shards
+
 # Set the log level to warning to avoid too much output
 os.environ["DESI_LOGLEVEL"] = "WARNING"
 
@@ -72,6 +77,8 @@ def processing_fn(args):
 
     # Load and select the requested targets
     spectra = desispec.io.read_spectra(filename).select(targets=target_ids)
+    record_input(filename)
+    mark("read")
 
     # Coadd the cameras
     combined_spectra = coaddition.coadd_cameras(spectra)
@@ -104,6 +111,7 @@ def processing_fn(args):
         target_ids[:10],
         tgt_ids[:10],
     )
+    mark("transform")
 
     # Return the results
     return {
@@ -122,11 +130,13 @@ def processing_fn(args):
     }
 
 
+@traced
 def save_in_standard_format(args):
     """This function takes care of iterating through the different input files
     corresponding to this healpix index, and exporting the data in standard format.
     """
     catalog, output_filename, desi_data_path = args
+    annotate(healpix=int(catalog["healpix"][0]))
     # Create the output directory if it does not exist
     if not os.path.exists(os.path.dirname(output_filename)):
         os.makedirs(os.path.dirname(output_filename))
@@ -172,18 +182,25 @@ def save_in_standard_format(args):
     assert len(catalog) == len(spectra), \
         "There was an error in the join operation " \
         f"(len(catalog)={len(catalog)}, len(spectra)={len(spectra)})"
+    mark("transform")
 
     # Save all columns to disk in HDF5 format
     with h5py.File(output_filename, "w") as hdf5_file:
         for key in catalog.colnames:
             hdf5_file.create_dataset(key, data=catalog[key])
+    mark("write")
+    record_output(output_filename)
+    record_objects(len(catalog))
     return 1
 
 
 def main(args):
+    tracer = BuildTracer(args.trace_file, name="desi")
+
     # Load the catalog file and apply main cuts
-    catalog = Table.read(os.path.join(args.desi_data_path, "zall-pix-iron.fits"))
-    catalog = catalog[selection_fn(catalog)]
+    with tracer.stage("catalog"):
+        catalog = Table.read(os.path.join(args.desi_data_path, "zall-pix-iron.fits"))
+        catalog = catalog[selection_fn(catalog)]
     print(f"Catalog contains {len(catalog)} examples after applying selection_fn.")
 
     # Compute the healpix index
@@ -195,18 +212,18 @@ def main(args):
         nest=True,
     )
 
-    # Extract the spectra by looping over all files
-    catalog = catalog.group_by(["healpix"])
+    # Largest cells first, dense cells being split with --oversubscription into shards which keep the objects
+    # of a coadd file together
+    tasks = plan_cells(catalog["healpix"], num_workers=args.num_processes, order=catalog["HEALPIX"],
+                       oversubscription=args.oversubscription)
+    cell_dir = lambda healpix: os.path.join(args.output_dir, "dr1_main/healpix={}".format(healpix))
+    remove_stale_shards(tasks, cell_dir)
+    print_plan(tasks, args.num_processes)
 
     # Preparing the arguments for the parallel processing
     map_args = []
-    for group in catalog.groups:
-        # Create a filename for the group
-        group_filename = os.path.join(
-            args.output_dir,
-            "dr1_main/healpix={}/001-of-001.hdf5".format(group["healpix"][0]),
-        )
-        map_args.append((group, group_filename, args.desi_data_path))
+    for task in tasks:
+        map_args.append((catalog[task.rows], task.filename(cell_dir(task.healpix)), args.desi_data_path))
 
     # Run the parallel processing
     results = process_map(
@@ -215,6 +232,8 @@ def main(args):
         max_workers=args.num_processes,
         chunksize=args.chunksize,
     )
+    results = list(tracer.collect(results))
+    tracer.close()
 
     if sum(results) != len(map_args):
         print(
@@ -244,6 +263,18 @@ if __name__ == "__main__":
         type=int,
         default=1,
     )
+    parser.add_argument(
+        "--oversubscription",
+        type=float,
+        default=None,
+        help="Split dense healpix cells into shards, so that each task costs at most the total divided by oversubscription times the number of processes. Cells are not split by default",
+    )
+    parser.add_argument(
+        "--trace_file",
+        type=str,
+        default=None,
+        help="JSON-lines file to which per-healpix stage timings are appended",
+    )
     args = parser.parse_args()
 
     main(args)
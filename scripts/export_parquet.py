@@ -0,0 +1,305 @@
+""" Parallel exporter of a parent sample to size-bounded Parquet shards, for publishing on the hub.
+
+Each configuration of the builder of the sample is written to `<output_dir>/<config>/train-*.parquet`,
+with the Arrow schema of the builder features, so that the shards load with the same features as
+the builder. Files are converted in a pool of processes, and shards are closed once they reach
+the requested size.
+
+Catalog files are converted straight from their columns when the builder reads them unchanged,
+i.e. when each feature `k` is stored in the dataset `k` of the file, or in the datasets `k_field`
+for sequences of dictionaries. This is checked on the first rows of the first file of each configuration,
+by comparing their columnar conversion with the examples generated by the builder; configurations that
+transform their columns are converted through the builder's `_generate_examples` instead.
+
+The exact size and number of rows of every shard are written to `<output_dir>/manifest.json`,
+from which `select_shards` picks the shards fitting in an upload budget.
+
+Usage:
+    python export_parquet.py /mnt/ceph/users/polymathic/MultimodalUniverse/desi /tmp/parquet/desi --n_proc 16
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+from glob import glob
+
+import h5py
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import Dataset, Sequence, Value, load_dataset_builder
+from tqdm import tqdm
+
+from sanity_check import config_files, entry_paths, load_builder
+
+
+class ColumnarUnsupported(Exception):
+    """ Raised when a file cannot be converted straight from its columns """
+
+
+def _values(data: np.ndarray, feature: Value) -> pa.Array:
+    if data.dtype.kind == "S":
+        return pa.array(data, type=pa.binary()).cast(feature.pa_type)
+    return pa.array(data).cast(feature.pa_type)
+
+
+def _column(group, name: str, feature, rows: slice) -> pa.Array:
+    """ Reads the Arrow column of a feature from the datasets of a file """
+    if isinstance(feature, Value):
+        if not isinstance(group.get(name), h5py.Dataset) or group[name].ndim != 1:
+            raise ColumnarUnsupported(f"{name} is not a column of the file")
+        return _values(group[name][rows], feature)
+
+    if isinstance(feature, Sequence) and isinstance(feature.feature, dict):
+        # Sequences of dictionaries are stored by Arrow as structs of sequences
+        fields = [_column(group, f"{name}_{k}", Sequence(v, length=feature.length), rows)
+                  for k, v in feature.feature.items()]
+        return pa.StructArray.from_arrays(fields, names=list(feature.feature))
+
+    if isinstance(feature, Sequence) and isinstance(feature.feature, Value):
+        if not isinstance(group.get(name), h5py.Dataset) or group[name].ndim != 2:
+            raise ColumnarUnsupported(f"{name} is not a two dimensional dataset of the file")
+        data = group[name][rows]
+        n_rows, length = data.shape
+        if feature.length not in (-1, length):
+            raise ColumnarUnsupported(f"{name} has {length} elements per row, expected {feature.length}")
+        values = _values(data.reshape(-1), feature.feature)
+        if feature.length == -1:
+            return pa.ListArray.from_arrays(pa.array(np.arange(n_rows + 1, dtype=np.int32) * length), values)
+        return pa.FixedSizeListArray.from_arrays(values, length)
+
+    raise ColumnarUnsupported(f"{name}: {type(feature).__name__} features are only converted by the builder")
+
+
+def columnar_batches(filename: str, features, batch_bytes: int):
+    """ Yields the content of a catalog file as Arrow tables with the schema of the features """
+    schema = features.arrow_schema
+    with h5py.File(filename, "r") as f:
+        if not isinstance(f.get("object_id"), h5py.Dataset) or f["object_id"].ndim != 1:
+            raise ColumnarUnsupported("the file is not a catalog with an object_id column")
+        n_rows = f["object_id"].shape[0]
+        row_bytes = max(1, os.path.getsize(filename) // max(n_rows, 1))
+        batch_size = max(1, batch_bytes // row_bytes)
+        for start in range(0, n_rows, batch_size):
+            rows = slice(start, min(start + batch_size, n_rows))
+            columns = [_column(f, name, feature, rows) for name, feature in features.items()]
+            yield pa.Table.from_arrays(columns, schema=schema)
+
+
+def generated_batches(builder, entry, batch_bytes: int):
+    """ Yields the examples generated by the builder from an entry of its split, as Arrow tables """
+    features = builder.info.features
+    examples = []
+    batch_size = None
+    for _, example in builder._generate_examples(files=[entry]):
+        # Keys not declared in the features are dropped, as when the builder prepares the dataset
+        examples.append({k: example.get(k) for k in features})
+        if batch_size is None or len(examples) >= batch_size:
+            table = Dataset.from_list(examples, features=features).data.table
+            if batch_size is None:
+                # The size of the batches is set from that of the first example
+                batch_size = max(1, batch_bytes // max(table.nbytes, 1))
+            examples = []
+            yield table
+    if examples:
+        yield Dataset.from_list(examples, features=features).data.table
+
+
+def _parquet_bytes(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+
+def columnar_matches(builder, entry, max_bytes: int) -> bool:
+    """ Whether the columnar conversion of the first rows of a file, up to about max_bytes, is identical to
+    the examples generated by the builder """
+    features = builder.info.features
+    try:
+        columnar = next((table for path in entry_paths(entry)
+                         for table in columnar_batches(path, features, max_bytes)), None)
+    except ColumnarUnsupported:
+        return False
+    generated = generated_batches(builder, entry, max_bytes)
+    if columnar is None:
+        return next(generated, None) is None
+    # The generated examples are compared batch by batch with the same rows of the columnar conversion
+    start = 0
+    for table in generated:
+        table = table.slice(0, columnar.num_rows - start)
+        # Comparing the Parquet serializations treats identical NaNs as equal
+        if _parquet_bytes(columnar.slice(start, table.num_rows)) != _parquet_bytes(table):
+            return False
+        start += table.num_rows
+        if start == columnar.num_rows:
+            return True
+    return False
+
+
+class ShardWriter:
+    """ Writes tables to Parquet shards of bounded size, named after a prefix and their index """
+
+    def __init__(self, prefix: str, schema: pa.Schema, shard_bytes: int, row_group_bytes: int):
+        self.prefix = prefix
+        self.schema = schema
+        self.shard_bytes = shard_bytes
+        self.row_group_bytes = row_group_bytes
+        self.shards = []
+        self._sink = None
+        self._writer = None
+
+    def _close_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._sink.close()
+            self._writer = None
+
+    def write(self, table: pa.Table):
+        rows = max(1, int(self.row_group_bytes * table.num_rows // max(table.nbytes, 1)))
+        for start in range(0, table.num_rows, rows):
+            if self._writer is None:
+                path = f"{self.prefix}-{len(self.shards):04d}.parquet"
+                self._sink = open(path, "wb")
+                self._writer = pq.ParquetWriter(self._sink, self.schema)
+                self.shards.append([path, 0])
+            row_group = table.slice(start, rows)
+            self._writer.write_table(row_group, row_group_size=row_group.num_rows)
+            self.shards[-1][1] += row_group.num_rows
+            # Row groups are flushed as they are written, so the position of the sink is the size of the shard
+            if self._sink.tell() >= self.shard_bytes:
+                self._close_shard()
+
+    def close(self):
+        self._close_shard()
+        return self.shards
+
+
+def export_task(args):
+    """ Converts a group of entries of the split of a configuration to temporary Parquet shards """
+    sample_path, config, columnar, entries, prefix, shard_bytes, row_group_bytes = args
+    builder = load_builder(sample_path, config)
+    features = builder.info.features
+    writer = ShardWriter(prefix, features.arrow_schema, shard_bytes, row_group_bytes)
+    try:
+        for entry in entries:
+            if columnar:
+                batches = (table for path in entry_paths(entry)
+                           for table in columnar_batches(path, features, row_group_bytes))
+            else:
+                batches = generated_batches(builder, entry, row_group_bytes)
+            for table in batches:
+                writer.write(table)
+    finally:
+        shards = writer.close()
+    return config, prefix, shards
+
+
+def _group_entries(entries, shard_bytes: int):
+    """ Groups consecutive entries into tasks of about the size of a shard """
+    tasks, task, size = [], [], 0
+    for entry in entries:
+        task.append(entry)
+        size += sum(os.path.getsize(p) for p in entry_paths(entry))
+        if size >= shard_bytes:
+            tasks.append(task)
+            task, size = [], 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+
+def export_sample(sample_path: str,
+                  output_dir: str,
+                  configs=None,
+                  shard_mb: float = 500.,
+                  row_group_mb: float = 64.,
+                  n_proc: int = 1,
+                  columnar: bool = True):
+    """ Exports the configurations of a parent sample to Parquet shards.
+
+    Returns:
+        The manifest of the export, with the path, number of rows and size in bytes of each shard.
+    """
+    sample_path = os.path.abspath(sample_path)
+    shard_bytes = int(shard_mb * 1024**2)
+    row_group_bytes = int(row_group_mb * 1024**2)
+    builder = load_dataset_builder(sample_path, trust_remote_code=True)
+    configs = configs or [config.name for config in builder.BUILDER_CONFIGS]
+
+    manifest = {"sample_path": sample_path, "configs": {}}
+    tasks = []
+    for config in configs:
+        builder = load_builder(sample_path, config)
+        try:
+            entries = config_files(builder)
+        except Exception as e:
+            print(f"Skipping configuration {config}, whose files cannot be resolved: {e}")
+            continue
+        if not entries:
+            continue
+        mode = "columnar" if columnar and columnar_matches(builder, entries[0], row_group_bytes) else "generator"
+        print(f"Exporting {len(entries)} files of {config} ({mode})")
+        manifest["configs"][config] = {"mode": mode, "n_files": len(entries)}
+
+        config_dir = os.path.join(output_dir, config)
+        os.makedirs(config_dir, exist_ok=True)
+        # Shards of a previous export would be mixed with the new ones
+        for path in glob(os.path.join(config_dir, "*.parquet")):
+            os.remove(path)
+        for i, task in enumerate(_group_entries(entries, shard_bytes)):
+            prefix = os.path.join(config_dir, f"part-{i:05d}")
+            tasks.append((sample_path, config, mode == "columnar", task, prefix, shard_bytes, row_group_bytes))
+
+    parts = {config: [] for config in manifest["configs"]}
+    with multiprocessing.Pool(n_proc) as pool:
+        for config, prefix, shards in tqdm(pool.imap_unordered(export_task, tasks), total=len(tasks)):
+            parts[config] += shards
+
+    # Shards are renamed in the order of the files of the split
+    for config, shards in parts.items():
+        shards = sorted(shards)
+        records = []
+        for i, (path, n_rows) in enumerate(shards):
+            name = f"train-{i:05d}-of-{len(shards):05d}.parquet"
+            os.replace(path, os.path.join(output_dir, config, name))
+            records.append({"path": f"{config}/{name}", "n_rows": n_rows,
+                            "n_bytes": os.path.getsize(os.path.join(output_dir, config, name))})
+        manifest["configs"][config].update({
+            "n_rows": sum(r["n_rows"] for r in records),
+            "n_bytes": sum(r["n_bytes"] for r in records),
+            "shards": records,
+        })
+    manifest["n_bytes"] = sum(c["n_bytes"] for c in manifest["configs"].values())
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    print(f"Exported {manifest['n_bytes'] / 1024**3:.2f} GB to {output_dir}")
+    return manifest
+
+
+def select_shards(manifest, max_bytes: float):
+    """ Returns the shards of an export fitting in a budget, taking them in order within each configuration """
+    selected, total = [], 0
+    for config in manifest["configs"].values():
+        for shard in config["shards"]:
+            if total + shard["n_bytes"] > max_bytes:
+                break
+            selected.append(shard)
+            total += shard["n_bytes"]
+    return selected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the hdf5 files of a sample to Parquet shards with the features of its builder")
+    parser.add_argument("sample_path", type=str, help="Path of the sample, containing its builder script")
+    parser.add_argument("output_dir", type=str, help="Output directory of the shards")
+    parser.add_argument("--configs", type=str, nargs="+", default=None, help="Configurations to export, all of them by default")
+    parser.add_argument("--shard_mb", type=float, default=500., help="Maximum size of a shard in MB")
+    parser.add_argument("--row_group_mb", type=float, default=64., help="Approximate size of the row groups in MB")
+    parser.add_argument("--n_proc", type=int, default=1, help="Number of processes")
+    parser.add_argument("--no_columnar", action="store_true", help="Always convert the files through the builder")
+    args = parser.parse_args()
+
+    export_sample(args.sample_path, args.output_dir, configs=args.configs, shard_mb=args.shard_mb,
+                  row_group_mb=args.row_group_mb, n_proc=args.n_proc, columnar=not args.no_columnar)
@@ -1,6 +1,7 @@
 import argparse
 import multiprocessing as mp
 import os
+import sys
 from functools import partial
 
 import h5py
@@ -10,6 +11,11 @@ from astropy.io import fits
 from scipy.optimize import curve_fit
 from tqdm.auto import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from prefetch import DEFAULT_DEPTH, DEFAULT_MB, file_size, prefetch
+from scheduler import largest_first
+
 BANDS = ["BLUE", "GREEN", "RED", "NIR"]
 
 GLOBAL_CATALOG = None
@@ -48,6 +54,7 @@ def process_band_fits(filename):
         spectrum = {}
 
         hdu = fits.open(filename)
+        record_input(filename)
 
         # Unnormalized, sky-substracted spectrum
         flux = hdu[0].data
@@ -89,6 +96,12 @@ def process_band_fits(filename):
         return None
 
 
+def band_files(data_dir, sobject_id):
+    return [
+        os.path.join(data_dir, f"{sobject_id}{band}.fits") for band in [1, 2, 3, 4]
+    ]
+
+
 def process_object(
     cat_idx,
     data_dir,
@@ -98,9 +111,7 @@ def process_object(
 
     sobject_id = cat_row["sobject_id"]
 
-    fits_files = [
-        os.path.join(data_dir, f"{sobject_id}{band}.fits") for band in [1, 2, 3, 4]
-    ]
+    fits_files = band_files(data_dir, sobject_id)
     spectra = {b: process_band_fits(f) for b, f in zip(BANDS, fits_files)}
 
     for s in spectra.values():
@@ -440,6 +451,7 @@ def join_batched_spectra(spectra, output_dir, max_rows_per_file):
     num_chunks = int(np.ceil(num_processed / max_rows_per_file))
 
     spectra_chunked = collate_and_chunk(spectra, num_chunks)
+    mark("transform")
 
     for i in range(num_chunks):
         with h5py.File(
@@ -447,31 +459,53 @@ def join_batched_spectra(spectra, output_dir, max_rows_per_file):
         ) as f:
             for k in spectra_chunked.keys():
                 f.create_dataset(k, data=spectra_chunked[k][i])
+        record_output(os.path.join(output_dir, f"{i+1:03d}-of-{num_chunks:03d}.hdf5"))
+    mark("write")
 
     return num_processed
 
 
+@traced
 def process_and_write_batched_spectra(
-    cat_idxs_and_output_dir, data_dir, verbose, max_rows_per_file
+    cat_idxs_and_output_dir,
+    data_dir,
+    verbose,
+    max_rows_per_file,
+    prefetch_depth=DEFAULT_DEPTH,
+    prefetch_mb=DEFAULT_MB,
 ):
     cat_idxs, output_dir = cat_idxs_and_output_dir
+    annotate(healpix=int(output_dir.split("healpix=")[-1]))
     if verbose:
         print(f"worker {mp.current_process().pid} processing {len(cat_idxs)} objects")
-    spectra = [process_object(i, data_dir) for i in cat_idxs]
+    # The band files of the next objects are read in threads while an object is processed
+    spectra = list(
+        prefetch(
+            cat_idxs,
+            lambda i: process_object(i, data_dir),
+            depth=prefetch_depth,
+            max_bytes=prefetch_mb * 1024**2,
+            size=lambda i: file_size(*band_files(data_dir, GLOBAL_CATALOG[i]["sobject_id"])),
+        )
+    )
     spectra = list(filter(lambda x: x is not None, spectra))
+    mark("read")
     if verbose:
         print(f"worker {mp.current_process().pid} writing {len(cat_idxs)} objects")
     num_proc = join_batched_spectra(spectra, output_dir, max_rows_per_file)
+    record_objects(num_proc)
     return num_proc
 
 
 def main(args):
-    # get catalog
+    tracer = BuildTracer(args.trace_file, name="galah")
 
-    with fits.open(args.allstar_file) as hdul:
-        catalog = hdul[1].data.copy()
-    with fits.open(args.vac_file) as hdul:
-        vac = hdul[1].data.copy()
+    # get catalog
+    with tracer.stage("catalog"):
+        with fits.open(args.allstar_file) as hdul:
+            catalog = hdul[1].data.copy()
+        with fits.open(args.vac_file) as hdul:
+            vac = hdul[1].data.copy()
 
     # # make cuts
     # catalog = catalog[
@@ -529,23 +563,27 @@ def main(args):
         (idxs, os.path.join(args.output_dir, f"healpix={hp}"))
         for hp, idxs in healpix_row_mappings.items()
     ]
-    map_args = sorted(map_args, key=lambda x: len(x[0]))
+    # Largest cells first, so that the pool is not left waiting on a dense cell at the end
+    map_args = largest_first(map_args, cost=lambda x: len(x[0]))
 
     pbar = tqdm(total=total_to_process)
 
     with mp.Pool(args.num_workers) as pool:
-        for num_proc in pool.imap_unordered(
+        for num_proc in tracer.collect(pool.imap_unordered(
             # split into chunks
             partial(
                 process_and_write_batched_spectra,
                 data_dir=args.data_dir,
                 verbose=args.verbose,
                 max_rows_per_file=args.max_rows_per_file,
+                prefetch_depth=args.prefetch_depth,
+                prefetch_mb=args.prefetch_mb,
             ),
             map_args,
-        ):
+        )):
             pbar.update(num_proc)
 
+    tracer.close()
     print("done")
 
 
@@ -562,5 +600,8 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", type=str, required=True)
     parser.add_argument("--verbose", action="store_true", default=False)
     parser.add_argument("--max_rows_per_file", type=int, default=999_999_999)
+    parser.add_argument("--prefetch_depth", type=int, default=DEFAULT_DEPTH, help="Number of objects whose spectra are read ahead in threads by each worker, 0 to read them one at a time")
+    parser.add_argument("--prefetch_mb", type=float, default=DEFAULT_MB, help="Maximum size in MB of the spectra read ahead by each worker")
+    parser.add_argument("--trace_file", type=str, default=None, help="JSON-lines file to which per-healpix stage timings are appended")
     args = parser.parse_args()
     main(args)
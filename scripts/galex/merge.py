@@ -1,35 +1,51 @@
 import argparse
 import h5py
 import os
+from functools import partial
 from tqdm.contrib.concurrent import process_map
-import numpy as np
 
-def merge_one_dir(dir):
+def merge_one_dir(dir, chunk_size=1_000_000):
     out_path = os.path.join(dir, "001-of-001.hdf5")
+    fnames = sorted(os.path.join(dir, f) for f in os.listdir(dir) if f.endswith(".hdf5") and f != "001-of-001.hdf5")
+    if len(fnames) == 0:
+        return
     if os.path.exists(out_path):
         os.remove(out_path)
-    fnames = [os.path.join(dir, f) for f in os.listdir(dir)]
     if len(fnames) == 1:
         os.rename(fnames[0], out_path)
-    else:
-        with h5py.File(fnames[0], "r") as f2:
-            all_keys = list(f2.keys())
-        with h5py.File(out_path, "w") as fout:
-            for k in all_keys:
-                temp_arr = []
-                for i, fname in enumerate(fnames):
-                    with h5py.File(fname, "r") as f:
-                        temp_arr.append(f[k][:])
-                temp_arr = np.concatenate(temp_arr, axis=0)
-                fout.create_dataset(k, data=temp_arr)
-        
+        return
+
+    # Read the schema and the length of every fragment to preallocate the output
+    lengths = []
+    for fname in fnames:
+        with h5py.File(fname, "r") as f:
+            if len(lengths) == 0:
+                schema = {k: (f[k].shape[1:], f[k].dtype) for k in f.keys()}
+            lengths.append(len(f["object_id"]))
+
+    with h5py.File(out_path + ".tmp", "w") as fout:
+        for k, (shape, dtype) in schema.items():
+            fout.create_dataset(k, shape=(sum(lengths), *shape), dtype=dtype)
+        # Stream every fragment into the output, opening each one once
+        offset = 0
+        for fname, length in zip(fnames, lengths):
+            with h5py.File(fname, "r") as f:
+                for k in schema:
+                    for start in range(0, length, chunk_size):
+                        stop = min(start + chunk_size, length)
+                        fout[k][offset + start:offset + stop] = f[k][start:stop]
+            offset += length
+    os.replace(out_path + ".tmp", out_path)
+
 
 def main(args):
     dirs = [os.path.join(args.input_dir, d) for d in os.listdir(args.input_dir) if os.path.isdir(os.path.join(args.input_dir, d)) and "healpix" in d]
-    process_map(merge_one_dir, dirs, max_workers=os.cpu_count())
+    process_map(partial(merge_one_dir, chunk_size=args.chunk_size), dirs, max_workers=args.num_workers)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge multiple HDF5 files into one.")
     parser.add_argument("--input_dir", type=str, help="Path to directory containing HDF5 files.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--chunk_size", type=int, default=1_000_000, help="Number of rows copied at a time.")
     args = parser.parse_args()
     main(args)
@@ -5,20 +5,21 @@ import healpy as hp
 import h5py
 import os
 import multiprocessing
+from functools import partial
 from tqdm.auto import tqdm
-import uuid
 
 REMAP = dict(
     objid="object_id",
 )
 
-def ang2pix(ra, dec):
-    return hp.ang2pix(nside=args.nside, theta=ra, phi=dec, lonlat=True, nest=True)
+def ang2pix(ra, dec, nside):
+    return hp.ang2pix(nside=nside, theta=ra, phi=dec, lonlat=True, nest=True)
 
-def process_one_group(group, subset, output_dir):
+def process_one_group(group, subset, output_dir, fname):
     write_dir = os.path.join(output_dir, f"healpix={group}")
     os.makedirs(write_dir, exist_ok=True)
-    write_path = os.path.join(write_dir, f"{uuid.uuid4()}.hdf5")
+    # One fragment per input file, so that reprocessing a file overwrites its previous fragments
+    write_path = os.path.join(write_dir, f"{os.path.basename(fname).split('.')[0]}.hdf5")
     with h5py.File(write_path, 'w') as f:
         for col in subset.colnames:
             if col in REMAP:
@@ -27,16 +28,18 @@ def process_one_group(group, subset, output_dir):
                 f.create_dataset(col, data=subset[col])
 
 
-def process_one_file(fname):
+def process_one_file(fname, output_dir, nside):
     t = Table.read(fname)
     t.rename_columns(t.colnames, list(map(lambda x: x.lower(), t.colnames)))
-    healpix = ang2pix(t['ra'], t['dec'])
+    healpix = ang2pix(t['ra'], t['dec'], nside)
     t['healpix'] = healpix
     t_grouped = t.group_by("healpix")
     groups = t_grouped.groups.keys['healpix'].data
 
-    with multiprocessing.Pool(os.cpu_count()) as pool:
-        pool.starmap(process_one_group, tqdm([(g, t, args.output_dir) for (g, t) in zip(groups, t_grouped.groups)], total=len(groups), desc=f'{fname} | {len(t)} rows', leave=False))
+    # Groups are written by the worker that read the file, to avoid sending sub-tables between processes
+    for g, subset in zip(groups, t_grouped.groups):
+        process_one_group(g, subset, output_dir, fname)
+    return len(t)
 
 
 def main(args):
@@ -44,8 +47,10 @@ def main(args):
     if args.tiny:
         files = files[:1]
 
-    for f in tqdm(files):
-        process_one_file(f)
+    # A single pool processes all the input files
+    with multiprocessing.Pool(args.num_workers) as pool:
+        for _ in tqdm(pool.imap_unordered(partial(process_one_file, output_dir=args.output_dir, nside=args.nside), files), total=len(files)):
+            pass
 
 
 if __name__ == "__main__":
@@ -53,6 +58,7 @@ if __name__ == "__main__":
     parser.add_argument("--input_dir", type=str, help="Directory containing input files")
     parser.add_argument("--output_dir", type=str, help="Directory to write output files")
     parser.add_argument("--nside", type=int, help="Healpix nside", default=16)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=os.cpu_count())
     parser.add_argument("--tiny", action="store_true", help="Use a tiny subset of the data")
     args = parser.parse_args()
     main(args)
@@ -1,32 +1,13 @@
 import argparse
-import os
-from pathlib import Path
-from typing import List
-from datasets import load_dataset_builder
+from typing import List, Optional
 import sys
+from metadata import get_metadata, list_datasets
 
 INFO_KEYS = ['citation', 'description', 'homepage', 'license', 'version', 'acknowledgements']
 
 def get_all_datasets() -> List[str]:
-    # Collect all unique dataset names from the scripts directory
-    all_datasets = set()
-    # only consider directories in the scripts directory
-    for file in os.listdir('scripts'):
-        if os.path.isdir(os.path.join('scripts', file)):
-            all_datasets.add(file)
-    return sorted(list(all_datasets))
-
-def load_dataset_builder_safely(script_path: Path):
-    """Safely load a dataset builder from a script path."""
-    if not script_path.exists():
-        raise FileNotFoundError(f"Dataset script not found: {script_path}")
-        
-    sys.path.insert(0, str(script_path.parent))
-    try:
-        builder = load_dataset_builder(str(script_path), trust_remote_code=True)
-    finally:
-        sys.path.pop(0)
-    return builder
+    # Collect all datasets with a builder script in the scripts directory
+    return list_datasets('scripts')
 
 def extract_acknowledgements(citation: str) -> str:
     """Extract acknowledgements from citation text if present."""
@@ -34,24 +15,24 @@ def extract_acknowledgements(citation: str) -> str:
         return "\n".join([line.lstrip("% ") for line in citation.split("% CITATION\n")[0].split("\n")])
     return "Not available"
 
-def get_info(dataset: str, info_keys: List[str] = ['citation']) -> dict:
+def get_info(dataset: str, info_keys: List[str] = ['citation'], metadata: Optional[dict] = None) -> dict:
     """
     Get information for datasets handling errors, missing information, and acknowledgements.
+    The information is read statically from the dataset script, see `metadata.py`.
     Args:
         dataset (str): The name of the dataset.
         info_keys (List[str]): The keys to retrieve from the dataset info.
+        metadata (dict): The metadata of the dataset, if already retrieved.
     Returns:
         A dictionary with the requested information.
     """
-    script_path = Path('scripts') / f"{dataset}/{dataset}.py"
-    
     try:
-        builder = load_dataset_builder_safely(script_path)
+        if metadata is None:
+            metadata = get_metadata([dataset], scripts_dir='scripts')[dataset]
     except Exception as e:
         print(f"Error loading dataset {dataset}: {str(e)}", file=sys.stderr)
         return {key: "Error: Unable to load dataset information" for key in info_keys}
 
-    info = builder.info
     dataset_info = {}
 
     # Handle acknowledgements separately
@@ -59,11 +40,13 @@ def get_info(dataset: str, info_keys: List[str] = ['citation']) -> dict:
         if info_keys == INFO_KEYS:
             info_keys.remove("acknowledgements")
         else:
-            dataset_info["acknowledgements"] = extract_acknowledgements(info.citation)
+            dataset_info["acknowledgements"] = extract_acknowledgements(metadata["citation"] or "")
 
     # Get remaining information
     for key in info_keys:
-        value = getattr(info, key, "Not available")
+        if key in dataset_info:
+            continue
+        value = metadata.get(key, "Not available")
         dataset_info[key] = value if value else "Not available"
 
     return dataset_info
@@ -81,8 +64,14 @@ def format_info(datasets: List[str], info_keys: List[str] = ['citation'], check_
     formatted_info = []
     missing_info = {key: [] for key in info_keys}
     
+    # Metadata of all datasets is read at once, to only load the cache once
+    try:
+        all_metadata = get_metadata(datasets, scripts_dir='scripts')
+    except FileNotFoundError:
+        all_metadata = {}
+
     for dataset in datasets:
-        info = get_info(dataset, info_keys)
+        info = get_info(dataset, info_keys, all_metadata.get(dataset))
         if info:
             # Track missing information
             for key in info_keys:
@@ -0,0 +1,282 @@
+""" Lightweight instrumentation shared by the build_parent_sample pipelines.
+
+Functions processing one healpix cell in a worker process are decorated with `traced`, and
+time their stages with `mark`, which attributes the time elapsed since the previous mark to a
+stage, or with the `stage` context manager:
+
+    @traced
+    def save_in_standard_format(args):
+        catalog, output_filename = args
+        annotate(healpix=int(catalog['healpix'][0]))
+        ...
+        record_input(filename)
+        mark('read')
+        ...
+        mark('transform')
+        ...
+        mark('write')
+        record_output(output_filename)
+        record_objects(len(catalog))
+        return 1
+
+A decorated function returns a trace record instead of its result. The main process passes
+the records of the pool through a `BuildTracer`, which appends them as JSON lines to a trace
+file and prints a summary of the slowest cells and stages at the end of the build:
+
+    tracer = BuildTracer(args.trace_file, name='sdss')
+    with Pool(args.num_processes) as pool:
+        results = list(tqdm(tracer.collect(pool.imap(save_in_standard_format, map_args)), total=len(map_args)))
+    tracer.close()
+
+`collect` yields the original results, and 0 for the cells that raised an exception, which are
+recorded with their traceback instead of interrupting the pool, so that the usual
+`sum(results) != len(map_args)` checks keep working.
+
+The summary of an existing trace, e.g. written by several jobs of a multi-day build, is printed by:
+
+    python instrumentation.py build_trace.jsonl
+"""
+import argparse
+import functools
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Trace of the cell being processed by the current process, if any
+_current = None
+# Input files may be recorded by the threads prefetching them
+_lock = threading.Lock()
+
+
+class CellTrace:
+    """ Stage timings, data volumes and object counts of the processing of one healpix cell. """
+
+    def __init__(self):
+        self.info = {}
+        self.stages = defaultdict(float)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.n_objects = 0
+        self.start = time.time()
+        self.last_mark = time.perf_counter()
+
+    def record(self, result=None, error=None):
+        return {
+            'type': 'cell',
+            **self.info,
+            'status': 'ok' if error is None else 'failed',
+            'error': error,
+            'start': self.start,
+            'wall_time': time.time() - self.start,
+            'stages': dict(self.stages),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'n_objects': self.n_objects,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'result': result,
+        }
+
+
+def traced(fn):
+    """ Decorates a worker function so that it returns the trace record of its call.
+
+    Exceptions are caught, printed and stored in the record, whose result is then 0.
+    Nested calls of traced functions are recorded in the trace of the outermost one.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        global _current
+        if _current is not None:
+            return fn(*args, **kwargs)
+        _current = trace = CellTrace()
+        try:
+            return trace.record(result=fn(*args, **kwargs))
+        except Exception as e:
+            traceback.print_exc()
+            return trace.record(result=0, error=f'{type(e).__name__}: {e}')
+        finally:
+            _current = None
+    return wrapper
+
+
+def annotate(**info):
+    """ Adds identifying information, like the healpix index, to the trace of the current cell """
+    if _current is not None:
+        _current.info.update(info)
+
+
+@contextmanager
+def stage(name: str):
+    """ Times a stage of the processing of the current cell. Repeated stages are summed. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _current is not None:
+            now = time.perf_counter()
+            _current.stages[name] += now - start
+            # The next mark only counts the time elapsed since the end of this stage
+            _current.last_mark = now
+
+
+def mark(name: str):
+    """ Attributes the time elapsed since the previous mark, or the start of the cell, to a stage """
+    if _current is not None:
+        now = time.perf_counter()
+        _current.stages[name] += now - _current.last_mark
+        _current.last_mark = now
+
+
+def _size(paths):
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def record_input(*paths):
+    """ Adds the size of input files to the trace of the current cell """
+    if _current is not None:
+        size = _size(paths)
+        with _lock:
+            _current.bytes_in += size
+
+
+def record_output(*paths):
+    """ Adds the size of output files to the trace of the current cell """
+    if _current is not None:
+        _current.bytes_out += _size(paths)
+
+
+def record_objects(n: int):
+    """ Adds to the number of objects processed for the current cell """
+    if _current is not None:
+        _current.n_objects += int(n)
+
+
+def _default(o):
+    # Numpy scalars and the like, which are not JSON serializable
+    return o.item() if hasattr(o, 'item') else str(o)
+
+
+class BuildTracer:
+    """ Collects the trace records of a build in the main process.
+
+    Args:
+        trace_file: JSON-lines file to which records are appended, or None to only print the summary.
+        name: Name of the build, added to each record.
+    """
+
+    def __init__(self, trace_file=None, name=None):
+        self.name = name
+        self.records = []
+        self.stages = defaultdict(float)
+        self.start = time.time()
+        self._file = None
+        if trace_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+            self._file = open(trace_file, 'a')
+
+    def _write(self, record):
+        if self.name is not None:
+            record = {'build': self.name, **record}
+        if self._file is not None:
+            self._file.write(json.dumps(record, default=_default) + '\n')
+            self._file.flush()
+
+    def add(self, record):
+        """ Stores and writes the trace record of a cell, and returns the result of the traced function """
+        self.records.append(record)
+        self._write(record)
+        return record['result']
+
+    def collect(self, records):
+        """ Stores and writes trace records as they are produced, yielding the results of the traced function """
+        for record in records:
+            yield self.add(record)
+
+    @contextmanager
+    def stage(self, name: str):
+        """ Times a stage of the main process, such as building the catalog """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.stages[name] += duration
+            self._write({'type': 'stage', 'stage': name, 'wall_time': duration})
+
+    def summary(self, n_slowest: int = 10):
+        return summarize(self.records, self.stages, wall_time=time.time() - self.start, n_slowest=n_slowest)
+
+    def close(self, n_slowest: int = 10):
+        """ Prints the summary of the build and appends it to the trace file """
+        summary = self.summary(n_slowest=n_slowest)
+        print_summary(summary)
+        self._write({'type': 'summary', **summary})
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return summary
+
+
+def summarize(records, main_stages=None, wall_time=None, n_slowest: int = 10):
+    """ Aggregates the trace records of cells into totals per stage, failures and slowest cells """
+    stages = defaultdict(float)
+    for record in records:
+        for name, duration in record['stages'].items():
+            stages[name] += duration
+    failed = [r for r in records if r['status'] == 'failed']
+    slowest = sorted(records, key=lambda r: -r['wall_time'])[:n_slowest]
+    keys = ['type', 'status', 'result', 'start', 'host', 'pid', 'build']
+    return {
+        'wall_time': wall_time,
+        'n_cells': len(records),
+        'n_failed': len(failed),
+        'n_objects': sum(r['n_objects'] for r in records),
+        'bytes_in': sum(r['bytes_in'] for r in records),
+        'bytes_out': sum(r['bytes_out'] for r in records),
+        'cell_time': sum(r['wall_time'] for r in records),
+        'stages': dict(stages),
+        'main_stages': dict(main_stages or {}),
+        'failed': [{k: v for k, v in r.items() if k not in keys + ['stages']} for r in failed],
+        'slowest': [{k: v for k, v in r.items() if k not in keys + ['error']} for r in slowest],
+    }
+
+
+def print_summary(summary):
+    print(f"Processed {summary['n_cells']} cells, {summary['n_objects']} objects, "
+          f"{summary['bytes_in'] / 1024**3:.2f} GB in, {summary['bytes_out'] / 1024**3:.2f} GB out, "
+          f"{summary['n_failed']} failed")
+    total = sum(summary['stages'].values())
+    for name, duration in {**summary['main_stages'], **summary['stages']}.items():
+        share = f" ({100 * duration / total:.0f}% of cell time)" if name in summary['stages'] and total > 0 else ''
+        print(f"  {name}: {duration:.1f}s{share}")
+    counters = ['wall_time', 'bytes_in', 'bytes_out', 'n_objects', 'stages', 'error']
+    if summary['slowest']:
+        print("Slowest cells:")
+        for record in summary['slowest']:
+            info = ', '.join(f'{k}={v}' for k, v in record.items() if k not in counters)
+            stages = ', '.join(f'{k} {v:.1f}s' for k, v in record['stages'].items())
+            print(f"  {info}: {record['wall_time']:.1f}s, {record['n_objects']} objects ({stages})")
+    for record in summary['failed']:
+        info = ', '.join(f'{k}={v}' for k, v in record.items() if k not in counters)
+        print(f"Failed: {info}: {record['error']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarizes the trace of a parent sample build')
+    parser.add_argument('trace_file', type=str, help='Path to the JSON-lines trace file')
+    parser.add_argument('--n_slowest', type=int, default=10, help='Number of slowest cells to report')
+    args = parser.parse_args()
+
+    with open(args.trace_file) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    main_stages = defaultdict(float)
+    for line in lines:
+        if line['type'] == 'stage':
+            main_stages[line['stage']] += line['wall_time']
+    print_summary(summarize([line for line in lines if line['type'] == 'cell'], main_stages, n_slowest=args.n_slowest))
@@ -1,7 +1,7 @@
 import argparse
 import os
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tqdm import tqdm
 
 
@@ -84,7 +84,68 @@ def selection_function(cat, mag_cut, min_filters=4):
     sel = sel & (cat['mag_auto'] < mag_cut)
     return sel
 
-def process_mosaic(mosaic, local_dir, output_dir):
+def mosaic_filters(mosaic):
+    """ Returns the list of filters used for a given mosaic """
+    # For ngdeep, we only use 6 filters instead of 7
+    if 'ngdeep' in mosaic:
+        return _filters[1:]
+    return _filters
+
+def cache_mosaic(mosaic, filter, local_dir, cache_dir):
+    """ Decompresses the science and weight images of a mosaic once into uncompressed
+        FITS files, which can then be memory-mapped by the cutout workers.
+
+    :param mosaic: str
+        Name of the mosaic
+    :param filter: str
+        Name of the filter
+    :param local_dir: str
+        Local directory where the mosaic files are stored
+    :param cache_dir: str
+        Directory where the uncompressed images are stored
+    """
+    for ext in ["sci", "wht_full"]:
+        cache_file = f"{cache_dir}/{mosaic}-{filter}-clear_drc_{ext}.fits"
+        if os.path.exists(cache_file):
+            continue
+        with fits.open(f"{local_dir}/{mosaic}-{filter}-clear_drc_{ext}.fits.gz") as hdul:
+            hdul[0].writeto(cache_file + ".tmp", overwrite=True)
+        # Only expose complete files to the cutout workers
+        os.replace(cache_file + ".tmp", cache_file)
+
+
+# Memory-mapped images opened by the current worker process
+_open_images = {}
+
+def _get_image(filename):
+    if filename not in _open_images:
+        _open_images[filename] = fits.open(filename, memmap=True)[0].data
+    return _open_images[filename]
+
+
+def extract_cutouts(image_files, positions):
+    """ Extracts the cutouts of a batch of objects from memory-mapped mosaics.
+
+    :param image_files: list of (str, str)
+        Science and weight cache files for each filter
+    :param positions: np.ndarray
+        Pixel positions of the objects in each filter, of shape (n_filters, n_objects, 2)
+    """
+    size = (_cutout_size, _cutout_size)
+    images, invvar = [], []
+    for (sci_file, wht_file), filter_positions in zip(image_files, positions):
+        sci, wht = _get_image(sci_file), _get_image(wht_file)
+        images.append(np.stack([Cutout2D(sci, position, size, mode='partial', fill_value=0).data
+                                for position in filter_positions]))
+        invvar.append(np.stack([Cutout2D(wht, position, size, mode='partial', fill_value=0).data
+                                for position in filter_positions]))
+    # Convert all nans to zeros in images and invvar with np.nan_to_num
+    images = np.nan_to_num(np.stack(images, axis=1))
+    invvar = np.nan_to_num(np.stack(invvar, axis=1))
+    return images, invvar
+
+
+def process_mosaic(mosaic, local_dir, output_dir, cache_dir, executor, batch_size=256):
     """ Function that will process a single mosaic and return a catalog with 
         cutouts for all objects in the mosaic.
     
@@ -94,6 +155,12 @@ def process_mosaic(mosaic, local_dir, output_dir):
         Local directory where the mosaic files are stored
     :param output_dir: str
         Output directory where the HDF5 files will be stored
+    :param cache_dir: str
+        Directory where the uncompressed mosaics are cached, see `cache_mosaic`
+    :param executor: concurrent.futures.Executor
+        Process pool in which the cutouts are extracted
+    :param batch_size: int
+        Number of objects extracted per task
     """
     # Opening catalog file
     catalog = Table.read(f"{local_dir}/{mosaic}-fix_phot_apcorr.fits")
@@ -109,68 +176,46 @@ def process_mosaic(mosaic, local_dir, output_dir):
     catalog = catalog[sel]
     print('Keeping', len(catalog), 'objects in the catalog for mosaic', mosaic)
 
-    # For ngdeep, we only use 6 filters instead of 7
-    if 'ngdeep' in mosaic:
-        filters = _filters[1:]
-    else:
-        filters = _filters
-
-    # Opening all filters files
-    img = {
-        filter: {
-            ext: fits.open(f"{local_dir}/{mosaic}-{filter}-clear_drc_{ext}.fits.gz")[0]
-            for ext in ["sci", "wht_full"]
-        } for filter in filters
-    }
+    filters = mosaic_filters(mosaic)
+    image_files = [(f"{cache_dir}/{mosaic}-{filter}-clear_drc_sci.fits",
+                    f"{cache_dir}/{mosaic}-{filter}-clear_drc_wht_full.fits") for filter in filters]
 
-    # Computing pixel scale for all bands from the header
-    for filter in filters:
-        wcs = WCS(img[filter]['sci'].header)
+    # Computing pixel scale and object positions for all bands from the header
+    pix_scales = []
+    positions = []
+    for sci_file, _ in image_files:
+        wcs = WCS(fits.getheader(sci_file))
         pix_scale = np.sqrt(np.linalg.det(abs(wcs.pixel_scale_matrix))) * 3600
-        pix_scale = round(pix_scale, 4)
-        img[filter]['pix_scale'] = pix_scale
-        img[filter]['wcs'] = wcs
-    
-    # Getting cutouts for all objects in the catalog
-    out_images = []
-    for row in catalog:
-        ra, dec = row["ra"], row["dec"]
-
-        images = []
-        invvar = []
-        for filter in filters:
-            wcs = img[filter]['wcs']
-            x, y = wcs.all_world2pix(ra, dec, 0)
-            position = (x, y)
-            size = (_cutout_size, _cutout_size)
-            images.append(Cutout2D(img[filter]['sci'].data, position, size, wcs=wcs, mode='partial',fill_value=0).data)
-            invvar.append(Cutout2D(img[filter]['wht_full'].data, position, size, wcs=wcs, mode='partial',fill_value=0).data)
-        images = np.stack(images, axis=0)
-        invvar = np.stack(invvar, axis=0)
-
-        # Convert all nans to zeros in images and invvar with np.nan_to_num
-        images = np.nan_to_num(images)
-        invvar = np.nan_to_num(invvar)
+        pix_scales.append(round(pix_scale, 4))
+        x, y = wcs.all_world2pix(catalog["ra"], catalog["dec"], 0)
+        positions.append(np.stack([x, y], axis=-1))
+    positions = np.stack(positions)
 
-        # Computing a mask
-        mask = invvar > 0
-        
-        obj_data = {
-                "object_id": row["object_id"],
-                "image_band": np.array(
-                    [f.lower().encode("utf-8") for f in filters],
-                    dtype=_utf8_filter_type,
-                ),
-                "image_ivar": invvar,
-                "image_flux": images,
-                "image_mask": mask.astype("bool"),
-                "image_psf_fwhm": np.array([_empirical_psf_fwhm[f] for f in filters]).astype(np.float32),
-                "image_scale": np.array([img[f]['pix_scale'] for f in filters]).astype(np.float32),
-            }
-        out_images.append(obj_data)
+    # Sort the objects by tiles of the mosaic so that each batch reads a compact region
+    x, y = positions[0].T
+    order = np.lexsort((x, np.floor(y / (4 * _cutout_size))))
+    catalog = catalog[order]
+    positions = positions[:, order]
+
+    # Getting cutouts for all objects in the catalog
+    futures = [executor.submit(extract_cutouts, image_files, positions[:, i:i + batch_size])
+               for i in range(0, len(catalog), batch_size)]
+    results = [future.result() for future in futures]
+    images = np.concatenate([r[0] for r in results])
+    invvar = np.concatenate([r[1] for r in results])
 
     # Aggregate all images into an astropy table
-    out_images = Table({k: [d[k] for d in out_images] for k in out_images[0].keys()})
+    n_objects = len(catalog)
+    out_images = Table({
+        "object_id": catalog["object_id"],
+        "image_band": np.tile(np.array([f.lower().encode("utf-8") for f in filters], dtype=_utf8_filter_type), (n_objects, 1)),
+        "image_ivar": invvar,
+        "image_flux": images,
+        # Computing a mask
+        "image_mask": (invvar > 0).astype("bool"),
+        "image_psf_fwhm": np.tile(np.array([_empirical_psf_fwhm[f] for f in filters]).astype(np.float32), (n_objects, 1)),
+        "image_scale": np.tile(np.array(pix_scales).astype(np.float32), (n_objects, 1)),
+    })
 
     # Join on object_id with the input catalog
     catalog = join(catalog, out_images, 'object_id', join_type='inner')
@@ -213,7 +258,7 @@ def process_mosaic(mosaic, local_dir, output_dir):
                         else:
                             hdf5_file.create_dataset(key, data=catalog[key], compression="gzip", chunks=True, maxshape=(None, *shape[1:]))
     
-    del img, catalog
+    del images, invvar, out_images, catalog
 
 def build_total_inverse_variance(mosaic, filter, local_dir):
     """
@@ -351,9 +396,19 @@ def main(args):
         list(tqdm(executor.map(lambda x: build_total_inverse_variance(*x, local_dir), maps_to_generate), total=len(maps_to_generate), desc="Building inverse variance maps"))
     print("All inverse variance maps generated.")
 
-    # Building catalog for all mosaics
-    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
-        list(tqdm(executor.map(lambda mosaic: process_mosaic(mosaic, local_dir, args.output_dir), _mosaics), total=len(_mosaics), desc="Processing mosaics"))
+    # Decompressing all mosaics once so that they can be memory-mapped
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.join(local_dir, "cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    to_cache = [(mosaic, filter) for mosaic in _mosaics for filter in mosaic_filters(mosaic)]
+    with ProcessPoolExecutor(max_workers=args.num_processes) as pool:
+        list(tqdm(pool.map(cache_mosaic, *zip(*to_cache), [local_dir] * len(to_cache), [cache_dir] * len(to_cache)),
+                  total=len(to_cache), desc="Decompressing mosaics"))
+
+        # Building catalog for all mosaics, the cutouts of all mosaics share the same process pool
+        with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+            list(tqdm(executor.map(lambda mosaic: process_mosaic(mosaic, local_dir, args.output_dir, cache_dir, pool, batch_size=args.batch_size), _mosaics),
+                      total=len(_mosaics), desc="Processing mosaics"))
 
     print("All done!")
 
@@ -377,6 +432,24 @@ if __name__ == "__main__":
         default=1,
         help="Number of threads for parallel downloads and processing",
     )
+    parser.add_argument(
+        "--num_processes",
+        type=int,
+        default=1,
+        help="Number of processes for decompressing mosaics and extracting cutouts",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="Number of cutouts extracted per task",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="Directory for the uncompressed mosaics, defaults to a cache folder in local_dir",
+    )
     parser.add_argument(
         "--tiny",
         action="store_true",
@@ -1,17 +1,20 @@
 import os
+import sys
 import argparse
 import numpy as np
 from astropy.io import fits
-from astropy.table import Table, join
 from multiprocessing import Pool
 from tqdm import tqdm
-import h5py
 import healpy as hp
 import re
 import pandas as pd
 from pathlib import Path
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scheduler import plan_cells, print_plan, remove_stale_shards
+from build_parent_sample_worker import write_standard_format
+
 _healpix_nside = 16
 
 # Breakdown of the different Kepler pipelines
@@ -187,87 +190,7 @@ def save_in_standard_format(args):
     with Pool(os.cpu_count() // 2) as pool:
         results = list(tqdm(pool.imap_unordered(processing_fn, map_args), total=len(map_args), desc=f"healpix {healpix}"))
 
-    # Pad all light curves to the same length
-    max_length = max([len(d['time']) for d in results])
-    for i in range(len(results)):
-        results[i]['time'] = np.pad(results[i]['time'], (0, max_length - len(results[i]['time'])), mode='constant',
-                                    constant_values=np.nan)
-        results[i]['sap_flux'] = np.pad(results[i]['sap_flux'], (0, max_length - len(results[i]['sap_flux'])), mode='constant',
-                                    constant_values=np.nan)
-        results[i]['sap_flux_err'] = np.pad(results[i]['sap_flux_err'], (0, max_length - len(results[i]['sap_flux_err'])),
-                                        mode='constant', constant_values=np.nan)
-        results[i]['pdcsap_flux'] = np.pad(results[i]['pdcsap_flux'], (0, max_length - len(results[i]['pdcsap_flux'])),
-                                        mode='constant',
-                                        constant_values=np.nan)
-        results[i]['pdcsap_flux_err'] = np.pad(results[i]['pdcsap_flux_err'],
-                                            (0, max_length - len(results[i]['pdcsap_flux_err'])),
-                                            mode='constant', constant_values=np.nan)
-
-    # Aggregate all light curves into an astropy table
-    lightcurves = Table({k: [d[k] for d in results]
-                         for k in results[0].keys()})
-    # Convert list columns to strings before joining
-    for key in catalog.colnames:
-        if isinstance(catalog[key][0], list):
-            catalog[key] = [','.join(map(str, item)) for item in catalog[key]]
-
-    # Join on target id with the input catalog
-    catalog = join(catalog, lightcurves, keys='object_id', join_type='inner')
-    catalog.convert_unicode_to_bytestring()
-    catalog.remove_columns(['ra_2', 'dec_2'])
-    catalog.rename_column('ra_1', 'ra')
-    catalog.rename_column('dec_1', 'dec')
-
-    # Making sure we didn't lose anyone
-    assert len(catalog) == len(lightcurves), "There was an error in the join operation, probably some light curve files are missing"
-
-    # Calculate good chunk sizes
-    def get_chunk_size(shape):
-        if len(shape) == 1:
-            return min(1000, shape[0])  # For 1D arrays
-        else:
-            return (min(100, shape[0]), min(1000, shape[1]))  # For 2D arrays
-
-    # Save all columns to disk in HDF5 format with chunking and compression
-    with h5py.File(output_filename, 'w') as hdf5_file:
-        for key in catalog.colnames:
-            data = catalog[key]
-            # Convert object dtype to string if necessary
-            if data.dtype == object:
-                # Convert to fixed-length string
-                max_length = max(len(str(item)) for item in data)
-                string_dtype = h5py.string_dtype(encoding='ascii', length=max_length)
-                data = np.array([str(item) for item in data], dtype=string_dtype)
-            # Convert other special types if needed
-            elif isinstance(data, Table.Column):
-                data = np.array(data)
-
-            try:
-                # Get the shape of the data
-                shape = data.shape
-
-                # Calculate chunk size based on data shape
-                chunks = get_chunk_size(shape)
-
-                # Create the dataset with chunking and compression
-                hdf5_file.create_dataset(
-                    key,
-                    data=data,
-                    chunks=chunks,
-                    compression="gzip",
-                    compression_opts=5  # Compression level (1-9, higher = better compression but slower)
-                )
-            except TypeError as e:
-                print(f"Failed to save column {key} with dtype {data.dtype}: {str(e)}")
-                continue
-            except ValueError as e:
-                print(f"Failed to save column {key} with shape {shape}: {str(e)}")
-                continue
-            except Exception as e:
-                print(f"worker failed: {str(e)}")
-                continue
-            if healpix == 910:
-                print(f"healpix {healpix}: processed key {key}", flush=True)
+    write_standard_format(catalog, results, output_filename, healpix)
     print(f"healpix {healpix} complete", flush=True)
     return 1
 
@@ -335,9 +258,19 @@ def main(args):
     catalog['healpix'] = hp.ang2pix(_healpix_nside, catalog['ra'], catalog['dec'], lonlat=True, nest=True)
     catalog.to_csv(args.kepler_catalog_path, index=False)
 
+    # All the tasks append the timings of their healpix to the same trace file
+    trace_args = f" --trace_file {args.trace_file}" if args.trace_file is not None else ""
+    # The cost of an object is the number of light curve files to read, dense cells are split with --oversubscription into
+    # shards processed by separate tasks, and tasks are listed largest first so that disBatch starts them first
+    costs = catalog['data_file_path'].apply(len).to_numpy()
+    tasks = plan_cells(catalog['healpix'].to_numpy(), costs=costs, num_workers=args.num_processes,
+                       oversubscription=args.oversubscription)
+    remove_stale_shards(tasks, lambda healpix: os.path.join(args.output_dir, f"healpix={healpix}"))
+    print_plan(tasks, args.num_processes)
     with open("disbatch_tasks.sh", "w+") as f:
-        for healpix in pd.unique(catalog['healpix']):
-            f.write(f"python build_parent_sample_worker.py {healpix} --kepler_catalog_path {args.kepler_catalog_path}\n")
+        for task in tasks:
+            shard_args = f" --shard {task.shard} --n_shards {task.n_shards}" if task.n_shards > 1 else ""
+            f.write(f"python build_parent_sample_worker.py {task.healpix} --kepler_catalog_path {args.kepler_catalog_path} --output_dir {args.output_dir}{shard_args}{trace_args}\n")
 
     print("All done!")
 
@@ -349,7 +282,9 @@ if __name__ == '__main__':
     parser.add_argument('--kepler_catalog_path', type=str, help='Path to the local copy of the Kepler catalog')
     parser.add_argument('-nproc', '--num_processes', type=int, default=10,
                         help='The number of processes to use for parallel processing')
+    parser.add_argument('--oversubscription', type=float, default=None, help='Split dense healpix cells into shards, so that each task costs at most the total divided by oversubscription times the number of processes. Cells are not split by default')
     parser.add_argument('--tiny', action='store_true', help='Use a tiny subset of the data for testing')
+    parser.add_argument('--trace_file', type=str, default=None, help='JSON-lines file to which the worker tasks append per-healpix stage timings')
     args = parser.parse_args()
 
     main(args)
@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 import numpy as np
 from astropy.io import fits
@@ -13,8 +14,16 @@ import pdb
 from pathlib import Path
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from ragged import write_ragged
+from scheduler import shard_filename, split_cell
+
 _healpix_nside = 16
 
+# Time series returned by `processing_fn` for each object
+_LIGHTCURVE_COLUMNS = ['time', 'sap_flux', 'sap_flux_err', 'pdcsap_flux', 'pdcsap_flux_err']
+
 # Breakdown of the different Kepler pipelines
 
 def convert_to_list(string_list:str):
@@ -170,72 +179,18 @@ def normalize_lightcurve(lc):
         return normalized_lc
 
 
-def save_in_standard_format(args):
-    """ Process Kepler light curves and save in standard format with chunking and compression.
-    """
-    healpix = args.healpix
-    catalog = pd.read_csv(args.kepler_catalog_path)
-    # catalog.columns = ['kepid', 'ra', 'dec', 'data_file_paths', 'healpix']
-    # catalog['healpix'] =
-    catalog = catalog[catalog['healpix'] == healpix]
-    catalog['data_file_path'] = catalog['data_file_path'].apply(convert_to_list)
-    out_path = "/mnt/ceph/users/polymathic/MultimodalUniverse/kepler"
-    output_filename = os.path.join(out_path, f"healpix={healpix}/001-of-001.hdf5")
-
-    if os.path.exists(output_filename):
-        print(f"healpix {healpix} already done")
-        return 1
-
-    print(f"processing healpix {healpix}")
-
-    # Create the output directory if it does not exist
-    if not os.path.exists(os.path.dirname(output_filename)):
-        os.makedirs(os.path.dirname(output_filename))
+def write_standard_format(catalog, results, output_filename, healpix):
+    """ Joins the light curves returned by `processing_fn` with the catalog of their healpix cell,
+    and saves them in standard format with chunking and compression.
 
-    # Rename columns to match the standard format
-    if 'KID' in catalog.columns:
-        catalog['object_id'] = catalog['KID']
-    elif 'KIC' in catalog.columns:
-        catalog['object_id'] = catalog['KIC']
-    elif 'kepid' in catalog.columns:
-        catalog['object_id'] = catalog['kepid']
-    else:
-        raise ValueError("Unknown target ID column")
-
-    # Process all files
-    if healpix==910:
-        print("processing lightcurve files", flush=True)
-    # results = []
-    map_args = [(x.data_file_path, x.object_id) for x in catalog.itertuples()]
-    print(f"num objects in healpix {healpix}: {len(map_args)}")
-    with Pool(os.cpu_count() // 2) as pool:
-        results = list(tqdm(pool.imap_unordered(processing_fn, map_args), total=len(map_args), desc=f"healpix {healpix}"))
-    # for i, args in enumerate():
-    #     results.append(processing_fn(args))
-
-        # if healpix == 910 and i % 100 == 0:
-        #     print(f"processed {i} objects", flush=True)
-
-    # Pad all light curves to the same length
-    max_length = max([len(d['time']) for d in results])
-    for i in range(len(results)):
-        results[i]['time'] = np.pad(results[i]['time'], (0, max_length - len(results[i]['time'])), mode='constant',
-                                    constant_values=np.nan)
-        results[i]['sap_flux'] = np.pad(results[i]['sap_flux'], (0, max_length - len(results[i]['sap_flux'])), mode='constant',
-                                    constant_values=np.nan)
-        results[i]['sap_flux_err'] = np.pad(results[i]['sap_flux_err'], (0, max_length - len(results[i]['sap_flux_err'])),
-                                        mode='constant', constant_values=np.nan)
-        results[i]['pdcsap_flux'] = np.pad(results[i]['pdcsap_flux'], (0, max_length - len(results[i]['pdcsap_flux'])),
-                                        mode='constant',
-                                        constant_values=np.nan)
-        results[i]['pdcsap_flux_err'] = np.pad(results[i]['pdcsap_flux_err'],
-                                            (0, max_length - len(results[i]['pdcsap_flux_err'])),
-                                            mode='constant', constant_values=np.nan)
-
-
-    # Aggregate all light curves into an astropy table
+    Returns:
+        The number of objects written.
+    """
+    # Light curves are stored as ragged columns of the `lightcurve` group rather than padded to the
+    # longest light curve of the cell, and the other results are joined with the catalog
     lightcurves = Table({k: [d[k] for d in results]
-                         for k in results[0].keys()})
+                         for k in results[0].keys() if k not in _LIGHTCURVE_COLUMNS})
+    series = {d['object_id']: d for d in results}
     catalog = Table.from_pandas(catalog)
 
     if healpix == 910:
@@ -260,6 +215,7 @@ def save_in_standard_format(args):
 
     # Making sure we didn't lose anyone
     assert len(catalog) == len(lightcurves), "There was an error in the join operation, probably some light curve files are missing"
+    mark('transform')
 
     # Calculate good chunk sizes
     def get_chunk_size(shape):
@@ -311,6 +267,70 @@ def save_in_standard_format(args):
                 continue
             if healpix == 910:
                 print(f"healpix {healpix}: processed key {key}", flush=True)
+        # Light curves in the order of the joined catalog, each column written at once
+        rows = [series[object_id] for object_id in catalog['object_id']]
+        write_ragged(hdf5_file, 'lightcurve', {k: [d[k] for d in rows] for k in _LIGHTCURVE_COLUMNS},
+                     chunks=(min(65536, sum(len(d['time']) for d in rows)),), compression="gzip", compression_opts=5)
+    mark('write')
+    return len(catalog)
+
+
+@traced
+def save_in_standard_format(args):
+    """ Process Kepler light curves and save in standard format with chunking and compression.
+    """
+    healpix = args.healpix
+    annotate(healpix=healpix, shard=args.shard)
+    catalog = pd.read_csv(args.kepler_catalog_path)
+    # catalog.columns = ['kepid', 'ra', 'dec', 'data_file_paths', 'healpix']
+    # catalog['healpix'] =
+    catalog = catalog[catalog['healpix'] == healpix]
+    catalog['data_file_path'] = catalog['data_file_path'].apply(convert_to_list)
+    # Same split of the cell as planned by build_parent_sample.py, from the number of files of each object
+    shard_rows = split_cell(catalog['data_file_path'].apply(len).to_numpy(), args.n_shards)[args.shard]
+    catalog = catalog.iloc[shard_rows]
+    output_filename = shard_filename(os.path.join(args.output_dir, f"healpix={healpix}"), args.shard, args.n_shards)
+
+    if os.path.exists(output_filename):
+        print(f"healpix {healpix} already done")
+        annotate(skipped=True)
+        return 1
+
+    print(f"processing healpix {healpix}")
+
+    # Create the output directory if it does not exist
+    if not os.path.exists(os.path.dirname(output_filename)):
+        os.makedirs(os.path.dirname(output_filename))
+
+    # Rename columns to match the standard format
+    if 'KID' in catalog.columns:
+        catalog['object_id'] = catalog['KID']
+    elif 'KIC' in catalog.columns:
+        catalog['object_id'] = catalog['KIC']
+    elif 'kepid' in catalog.columns:
+        catalog['object_id'] = catalog['kepid']
+    else:
+        raise ValueError("Unknown target ID column")
+
+    # Process all files
+    if healpix==910:
+        print("processing lightcurve files", flush=True)
+    # results = []
+    map_args = [(x.data_file_path, x.object_id) for x in catalog.itertuples()]
+    print(f"num objects in healpix {healpix}: {len(map_args)}")
+    with Pool(os.cpu_count() // 2) as pool:
+        results = list(tqdm(pool.imap_unordered(processing_fn, map_args), total=len(map_args), desc=f"healpix {healpix}"))
+    record_input(*[f for files, _ in map_args for f in files])
+    mark('read')
+    # for i, args in enumerate():
+    #     results.append(processing_fn(args))
+
+        # if healpix == 910 and i % 100 == 0:
+        #     print(f"processed {i} objects", flush=True)
+
+    n_objects = write_standard_format(catalog, results, output_filename, healpix)
+    record_output(output_filename)
+    record_objects(n_objects)
     print(f"healpix {healpix} complete", flush=True)
     return 1
 
@@ -318,6 +338,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Extracts light curves from Kepler data downloaded from MAST')
     parser.add_argument('healpix', type=int, help='Path to the data directory')
     parser.add_argument('--kepler_catalog_path', type=str, help='Path to the local copy of the Kepler catalog')
+    parser.add_argument('--output_dir', type=str, default='/mnt/ceph/users/polymathic/MultimodalUniverse/kepler', help='Path to the output directory')
+    parser.add_argument('--shard', type=int, default=0, help='Index of the shard of the healpix cell to process')
+    parser.add_argument('--n_shards', type=int, default=1, help='Number of shards in which the healpix cell is split')
+    parser.add_argument('--trace_file', type=str, default=None, help='JSON-lines file to which the stage timings of this healpix are appended')
     args = parser.parse_args()
 
-    save_in_standard_format(args)
+    tracer = BuildTracer(args.trace_file, name='kepler')
+    tracer.add(save_in_standard_format(args))
+    tracer.close()
@@ -1,15 +1,29 @@
 import lightkurve as lk
 from multiprocessing import Pool
 import os
+import json
+import time
 import numpy as np
 import pandas as pd
+import healpy as hp
 import logging
 import shutil
 import argparse
 import warnings
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 from astropy.time import Time
 from collections import defaultdict
+from tqdm import tqdm
+
+from build_parent_sample_worker import processing_fn, write_standard_format
+
+_healpix_nside = 16
+
+MAST_URL = 'https://mast.stsci.edu'
 
 # Configure logging
 logging.basicConfig(
@@ -161,6 +175,146 @@ def download_data(args):
     output_dir = os.path.dirname(args.catalog_path)
     res_df.to_csv(f'{output_dir}/kepler_catalog_with_paths.csv', index=False)
 
+def make_session(num_workers=8, retries=5):
+    """ Session reusing up to `num_workers` connections, retrying failed requests with backoff """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET', 'POST'])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_workers, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def mast_query(session, service, params, mast_url=MAST_URL, page_size=50000):
+    """ Runs a request of the MAST API, returning the rows of all its pages """
+    rows, page = [], 1
+    while True:
+        request = {'service': service, 'params': params, 'format': 'json', 'pagesize': page_size, 'page': page}
+        response = session.post(f'{mast_url}/api/v0/invoke', data={'request': json.dumps(request)}, timeout=600)
+        response.raise_for_status()
+        result = response.json()
+        if result.get('status') == 'EXECUTING':
+            # Long queries are resubmitted until their results are ready
+            time.sleep(5)
+            continue
+        if result.get('status') == 'ERROR':
+            raise RuntimeError(f"MAST {service} request failed: {result.get('msg')}")
+        rows += result['data']
+        if page >= result.get('paging', {}).get('pagesFiltered', 1):
+            return rows
+        page += 1
+
+
+def resolve_products(session, kics, batch_size=1000, mast_url=MAST_URL):
+    """ Resolves the long cadence light curve files of Kepler targets, with one observation query and
+    one product query per batch of targets.
+
+    Returns:
+        A dictionary with the ra, dec and light curve products (data URI and filename) of each target found.
+    """
+    targets = {}
+    for start in tqdm(range(0, len(kics), batch_size), desc='Resolving products'):
+        names = [f'kplr{int(kic):09d}' for kic in kics[start:start + batch_size]]
+        observations = mast_query(session, 'Mast.Caom.Filtered', {
+            'columns': 'obsid,target_name,s_ra,s_dec',
+            'filters': [
+                {'paramName': 'obs_collection', 'values': ['Kepler']},
+                {'paramName': 'dataproduct_type', 'values': ['timeseries']},
+                {'paramName': 'target_name', 'values': names},
+            ]}, mast_url=mast_url)
+        obsids = {}
+        for observation in observations:
+            kic = int(observation['target_name'][4:])
+            obsids[str(observation['obsid'])] = kic
+            targets.setdefault(kic, {'ra': observation['s_ra'], 'dec': observation['s_dec'], 'products': {}})
+        if not obsids:
+            continue
+
+        products = mast_query(session, 'Mast.Caom.Products', {'obsid': ','.join(obsids)}, mast_url=mast_url)
+        for product in products:
+            kic = obsids.get(str(product.get('parent_obsid', product.get('obsID'))))
+            # Long cadence light curves, one file per quarter, listed once per target
+            if kic is not None and product['productFilename'].endswith('_llc.fits'):
+                targets[kic]['products'][product['productFilename']] = product['dataURI']
+    return {kic: target for kic, target in targets.items() if target['products']}
+
+
+def download_product(session, uri, path, mast_url=MAST_URL, chunk_size=1024**2):
+    """ Streams a MAST product to a file, unless it is already downloaded """
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with session.get(f'{mast_url}/api/v0.1/Download/file', params={'uri': uri}, stream=True, timeout=600) as response:
+        response.raise_for_status()
+        with open(path + '.part', 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    os.replace(path + '.part', path)
+    return path
+
+
+def bulk_download(args):
+    """ Downloads the light curves of the targets of the catalog and writes them in the healpix layout.
+
+    Products of all targets are resolved in batched MAST queries, quarters are downloaded concurrently
+    over a shared session to `output_path/<kic>/`, which is kept as a cache for later runs, and each
+    healpix cell is written to `hdf5_path/healpix=<healpix>/001-of-001.hdf5` as soon as its files are
+    downloaded, skipping the cells already written.
+    """
+    all_samples = pd.read_csv(args.catalog_path)
+    kics = pd.unique(all_samples['KID'].astype(int))
+    if args.tiny:
+        kics = kics[:10]
+
+    session = make_session(args.num_workers)
+    targets = resolve_products(session, kics, batch_size=args.batch_size, mast_url=args.mast_url)
+    print(f'Resolved {sum(len(t["products"]) for t in targets.values())} light curves of {len(targets)} targets', flush=True)
+
+    catalog = pd.DataFrame({
+        'kepid': list(targets),
+        'ra': [t['ra'] for t in targets.values()],
+        'dec': [t['dec'] for t in targets.values()],
+        'data_file_path': [[os.path.join(args.output_path, f'{kic:09d}', name) for name in sorted(t['products'])]
+                           for kic, t in targets.items()],
+    })
+    catalog['healpix'] = hp.ang2pix(_healpix_nside, catalog['ra'], catalog['dec'], lonlat=True, nest=True)
+    catalog.to_csv(os.path.join(os.path.dirname(args.catalog_path), 'kepler_catalog_with_paths.csv'), index=False)
+
+    # Cells with the most files first, the downloads of all cells being queued at once so that
+    # the following cells are downloaded while a cell is written
+    cells = sorted(catalog.groupby('healpix'), key=lambda cell: -cell[1]['data_file_path'].apply(len).sum())
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor, Pool(args.num_processes) as pool:
+        downloads = {}
+        for healpix, cell in cells:
+            output_filename = os.path.join(args.hdf5_path, f'healpix={healpix}', '001-of-001.hdf5')
+            if os.path.exists(output_filename):
+                continue
+            downloads[healpix] = [executor.submit(download_product, session, targets[kic]['products'][os.path.basename(path)],
+                                                  path, args.mast_url)
+                                  for kic, paths in zip(cell['kepid'], cell['data_file_path']) for path in paths]
+
+        for healpix, cell in tqdm(cells, desc='Writing healpix cells'):
+            if healpix not in downloads:
+                continue
+            for future in downloads.pop(healpix):
+                try:
+                    future.result()
+                except Exception as e:
+                    # Missing quarters are skipped when reading the light curves
+                    logging.error(f"Error downloading a light curve of healpix {healpix}: {e}")
+                    failed += 1
+            cell = cell.assign(object_id=cell['kepid'])
+            results = pool.map(processing_fn, list(zip(cell['data_file_path'], cell['kepid'])), chunksize=16)
+            output_filename = os.path.join(args.hdf5_path, f'healpix={healpix}', '001-of-001.hdf5')
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+            write_standard_format(cell, results, output_filename + '.tmp', healpix)
+            os.replace(output_filename + '.tmp', output_filename)
+    session.close()
+    print(f'Wrote {len(cells)} healpix cells, {failed} light curves failed to download', flush=True)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Downloads Kepler data to a user-provided endpoint.")
 
@@ -168,6 +322,16 @@ if __name__ == '__main__':
     parser.add_argument('output_path', type=str, help='Path to the output directory')
     parser.add_argument('--tiny', action='store_true', help='Use a tiny subset of the data for testing')
     parser.add_argument('-nproc', '--num_processes', type=int, default=8, help="number of processes.")
+    parser.add_argument('--bulk', action='store_true', help='Resolve the products of all targets in batched MAST queries and write the healpix HDF5 files directly')
+    parser.add_argument('--hdf5_path', type=str, default=None, help='Output directory of the healpix HDF5 files in bulk mode')
+    parser.add_argument('--num_workers', type=int, default=16, help='Number of concurrent downloads in bulk mode')
+    parser.add_argument('--batch_size', type=int, default=1000, help='Number of targets per MAST query in bulk mode')
+    parser.add_argument('--mast_url', type=str, default=MAST_URL, help='Base URL of the MAST API')
     args = parser.parse_args()
 
-    download_data(args)
\ No newline at end of file
+    if args.bulk:
+        if args.hdf5_path is None:
+            parser.error('--hdf5_path is required in bulk mode')
+        bulk_download(args)
+    else:
+        download_data(args)
\ No newline at end of file
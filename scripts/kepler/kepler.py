@@ -44,6 +44,9 @@ _VERSION = "1.0.0"
 
 _FLOAT_FEATURES = ["ra", "dec"]
 
+# Time series of the light curves
+_LIGHTCURVE_COLUMNS = ["time", "pdcsap_flux", "pdcsap_flux_err", "sap_flux", "sap_flux_err"]
+
 _DATA_DIR = "data"
 
 
@@ -144,19 +147,22 @@ class Kepler(datasets.GeneratorBasedBuilder):
                 sort_index = np.argsort(data["object_id"][:])
                 sorted_ids = data["object_id"][:][sort_index]
 
+                # Light curves are stored either as ragged columns of the `lightcurve` group, with the
+                # offsets of each light curve in the flat values, or padded with NaNs to the longest one
+                if isinstance(data.get("lightcurve"), h5py.Group):
+                    offsets = data["lightcurve"]["offsets"][:]
+                    columns = data["lightcurve"]
+                    get_lightcurve = lambda i: {k: columns[k][offsets[i]:offsets[i + 1]] for k in _LIGHTCURVE_COLUMNS}
+                else:
+                    get_lightcurve = lambda i: {k: data[k][i] for k in _LIGHTCURVE_COLUMNS}
+
                 for k in keys:
                     # Extract the indices of requested ids in the catalog
                     i = sort_index[np.searchsorted(sorted_ids, k)]
 
                     # Parse light curve data
                     example = {
-                        "lightcurve": {
-                            "time": data["time"][i],
-                            "pdcsap_flux": data["pdcsap_flux"][i],
-                            "pdcsap_flux_err": data["pdcsap_flux_err"][i],
-                            "sap_flux": data["sap_flux"][i],
-                            "sap_flux_err": data["sap_flux_err"][i],
-                        }
+                        "lightcurve": get_lightcurve(i)
                     }
                     # Add all other requested features
                     for f in _FLOAT_FEATURES:
@@ -1,5 +1,7 @@
 import argparse
 import os
+import sys
+from functools import partial
 from multiprocessing import Pool
 
 import h5py
@@ -9,6 +11,10 @@ from astropy.io import fits
 from astropy.table import Table, hstack
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prefetch import DEFAULT_DEPTH, DEFAULT_MB, file_size, prefetch
+from scheduler import plan_cells, print_plan, remove_stale_shards
+
 _healpix_nside = 16
 
 # LAMOST wavelength coverage: 3700-9000 Å
@@ -61,7 +67,7 @@ def processing_fn(obsid, base_path):
     }
 
 
-def save_in_standard_format(args):
+def save_in_standard_format(args, prefetch_depth=DEFAULT_DEPTH, prefetch_mb=DEFAULT_MB):
     """Save processed spectra in standard HDF5 format"""
     catalog, output_filename, base_path = args
 
@@ -82,13 +88,21 @@ def save_in_standard_format(args):
         catalog["restframe"] = np.ones(len(catalog), dtype=bool)
 
         # Process all files
+        # Files are read ahead in threads while the previous ones are processed
         results = []
-        for row in catalog:  # This iterates over Row objects
-            result = processing_fn(row["obsid"], base_path)
+        obsids = list(catalog["obsid"])
+        spectra = prefetch(
+            obsids,
+            lambda obsid: processing_fn(obsid, base_path),
+            depth=prefetch_depth,
+            max_bytes=prefetch_mb * 1024**2,
+            size=lambda obsid: file_size(f"{base_path}/{obsid}.fits"),
+        )
+        for obsid, result in zip(obsids, spectra):
             if result is not None:
                 results.append(result)
             else:
-                print(f"Failed to process spectrum for {row['obsid']}")
+                print(f"Failed to process spectrum for {obsid}")
 
         if not results:
             print(f"No valid spectra found for {output_filename}")
@@ -172,24 +186,27 @@ def main(args):
         _healpix_nside, catalog["ra"], catalog["dec"], lonlat=True, nest=True
     )
 
-    # Group by healpix
-    catalog_grouped = catalog.group_by("healpix")
+    # Plan the healpix groups, largest first, dense cells being split into shards with --oversubscription
+    tasks = plan_cells(catalog["healpix"], num_workers=args.num_processes, oversubscription=args.oversubscription)
+    cell_dir = lambda healpix: os.path.join(args.output_dir, f"{catalog_name}/healpix={healpix}")
+    remove_stale_shards(tasks, cell_dir)
+    print_plan(tasks, args.num_processes)
 
     # Prepare arguments for parallel processing
     map_args = []
-    for group in catalog_grouped.groups:
-        output_filename = os.path.join(
-            args.output_dir,
-            f"{catalog_name}/healpix={group['healpix'][0]}/001-of-001.hdf5",
-        )
-        map_args.append((group, output_filename, args.lamost_data_path))
+    for task in tasks:
+        output_filename = task.filename(cell_dir(task.healpix))
+        map_args.append((catalog[task.rows], output_filename, args.lamost_data_path))
 
     print(f"Processing {len(map_args)} healpix groups...")
 
     # Process in parallel
     with Pool(args.num_processes) as pool:
         results = list(
-            tqdm(pool.imap(save_in_standard_format, map_args), total=len(map_args))
+            tqdm(pool.imap_unordered(
+                partial(save_in_standard_format, prefetch_depth=args.prefetch_depth, prefetch_mb=args.prefetch_mb),
+                map_args,
+            ), total=len(map_args))
         )
 
     successful = sum(results)
@@ -228,5 +245,24 @@ if __name__ == "__main__":
         help="Skip checking if spectrum files exist",
     )
 
+    parser.add_argument(
+        "--oversubscription",
+        type=float,
+        default=None,
+        help="Split dense healpix cells into shards, so that each task costs at most the total divided by oversubscription times the number of processes. Cells are not split by default",
+    )
+    parser.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=DEFAULT_DEPTH,
+        help="Number of spectrum files read ahead in threads by each process, 0 to read them one at a time",
+    )
+    parser.add_argument(
+        "--prefetch_mb",
+        type=float,
+        default=DEFAULT_MB,
+        help="Maximum size in MB of the spectrum files read ahead by each process",
+    )
+
     args = parser.parse_args()
     main(args)
@@ -1,24 +1,28 @@
 import argparse
 import glob
 import os
+import shutil
+import sys
 from functools import partial
 from multiprocessing import Pool
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-import astropy.units as u
 import h5py
 import healpy as hp
 import numpy as np
-import skimage
-from astropy.coordinates import SkyCoord
 from astropy.io import fits
 from astropy.nddata import Cutout2D
 from astropy.table import Table, join, vstack
 from astropy.wcs import WCS
 from filelock import FileLock
 from PIL import Image, ImageOps
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from scheduler import largest_first
+
 ARCSEC_PER_PIXEL = 0.262
 _healpix_nside = 16
 _cutout_size = 160
@@ -45,106 +49,105 @@ NEARBY_CATALOG_INFORMATION = [
 ]
 
 
-class CatalogSelector:
-    def __init__(self, catalog: Table, cutout: Cutout2D):
-        self.cutout = cutout
-        center_coordinates = cutout.wcs.wcs_pix2world(*cutout.input_position_cutout, 1)
-        self.center_coordinates = SkyCoord(
-            ra=center_coordinates[0] * u.deg, dec=center_coordinates[1] * u.deg
+class BrickCatalogIndex:
+    """Spatial index over the catalog of a single brick.
+
+    Pixel coordinates of all the objects of the brick are computed once from the
+    brick WCS and stored in a KD-tree, so that the neighbours of every cutout can
+    be queried without recomputing sky separations against the whole brick.
+    """
+    def __init__(self, catalog: Table, wcs: WCS):
+        self.catalog = catalog
+        x, y = wcs.all_world2pix(np.asarray(catalog["RA"]), np.asarray(catalog["DEC"]), 0)
+        self.pixel_coordinates = np.stack([x, y], axis=-1)
+        self.tree = cKDTree(self.pixel_coordinates)
+        self.object_types = np.array(
+            [OBJECT_TYPE_COLOR[t] for t in np.asarray(catalog["TYPE"]).astype(str)],
+            dtype=np.int64,
         )
-        self.original_catalog = catalog
-        # Retrieve the objects in the catalog that lie in the cutout
-        self.catalog = self.select()
 
-    def get_pixel_separation(self, catalog_coordinates: SkyCoord) -> np.ndarray:
-        separations = self.center_coordinates.separation(catalog_coordinates)
-        pixel_separations = separations / u.deg * u.deg.to(u.arcsec) / ARCSEC_PER_PIXEL
-        return pixel_separations
+    def query(self, cutout: Cutout2D) -> np.ndarray:
+        """Returns the sorted indices of the objects within a radius of the cutout
+        center equal to its diagonal."""
+        radius = np.sqrt(2) * np.linalg.norm(cutout.shape) / 2
+        indices = self.tree.query_ball_point(cutout.input_position_original, radius)
+        return np.sort(np.asarray(indices, dtype=np.int64))
+
 
-    def get_within_cutout(self, catalog_coordinates: SkyCoord):
-        i, j = self.cutout.wcs.world_to_array_index(catalog_coordinates)
-        object_pixel_coordinates = np.array([j, i])
+class CatalogSelector:
+    def __init__(self, brick_index: BrickCatalogIndex, cutout: Cutout2D):
+        self.cutout = cutout
+        self.brick_index = brick_index
+        # Retrieve the objects in the catalog that lie in the cutout
+        self.indices, self.i, self.j = self.select()
+        self.catalog = brick_index.catalog[self.indices]
+
+    def select(self):
+        close_object_indices = self.brick_index.query(self.cutout)
+        # Array indices of the objects in the cutout frame
+        pixel_coordinates = self.brick_index.pixel_coordinates[close_object_indices]
+        pixel_coordinates = pixel_coordinates - np.asarray(self.cutout.origin_original)
+        j, i = np.floor(pixel_coordinates + 0.5).astype(int).T
         # Bbox is ((ymin, ymax), (xmin, xmax))
         cutout_bbox = self.cutout.bbox_cutout
-        lower = np.logical_and(
-            object_pixel_coordinates[0] >= cutout_bbox[1][0],
-            object_pixel_coordinates[1] >= cutout_bbox[0][0],
-        )
-        upper = np.logical_and(
-            object_pixel_coordinates[0] < cutout_bbox[1][1],
-            object_pixel_coordinates[1] < cutout_bbox[0][1],
-        )
-        within_cutout = np.logical_and(lower, upper)
-        return within_cutout
-
-    def select(self) -> Table:
-        catalog_coordinates = SkyCoord(
-            ra=self.original_catalog["RA"], dec=self.original_catalog["DEC"]
-        )
-        # First select coordinates within the circle
-        # centered in the cutout and whose raidus equals its diagonal
-        pixel_separations = self.get_pixel_separation(catalog_coordinates)
-        close_object_indices = pixel_separations < (
-            np.sqrt(2) * np.linalg.norm(self.cutout.shape) / 2
+        within_cutout = (
+            (j >= cutout_bbox[1][0])
+            & (i >= cutout_bbox[0][0])
+            & (j < cutout_bbox[1][1])
+            & (i < cutout_bbox[0][1])
         )
-        close_object_coordinates = catalog_coordinates[close_object_indices]
-        # Then retrieve objects that actually lie in the cutout
-        in_cutout_indices = self.get_within_cutout(close_object_coordinates)
-        close_object_catalog = self.original_catalog[close_object_indices]
-        in_cutout_object_catalog = close_object_catalog[in_cutout_indices]
-        return in_cutout_object_catalog
+        return close_object_indices[within_cutout], i[within_cutout], j[within_cutout]
 
     def get_object_mask(self) -> np.ndarray:
-        mask = np.zeros(self.cutout.shape).astype(np.uint8)
-        # Get catalob object pixel coordinates in cutout
-        object_coordinates = SkyCoord(ra=self.catalog["RA"], dec=self.catalog["DEC"])
-        i, j = self.cutout.wcs.world_to_array_index(object_coordinates)
-        centers = np.stack([j, i]).T
-        radii = self.catalog["SHAPE_R"].value / ARCSEC_PER_PIXEL
-        object_types = self.catalog["TYPE"].value.astype(str)
-        e1 = self.catalog["SHAPE_E1"].value
-        e2 = self.catalog["SHAPE_E2"].value
-        angle = 0.5 * np.arctan2(e2, e1)
+        radii = np.asarray(self.catalog["SHAPE_R"], dtype=np.float64) / ARCSEC_PER_PIXEL
+        e1 = np.asarray(self.catalog["SHAPE_E1"], dtype=np.float64)
+        e2 = np.asarray(self.catalog["SHAPE_E2"], dtype=np.float64)
+        angle = (0.5 * np.arctan2(e2, e1)) % np.pi
         q = (1 - np.sqrt(e1**2 + e2**2)) / (1 + np.sqrt(e1**2 + e2**2))
         height = 2 * radii
         width = 2 * radii * q
-        for c, h, w, a, t in zip(centers, height, width, angle, object_types):
-            rr, cc = skimage.draw.ellipse(c[0], c[1], w, h, shape=self.cutout.shape, 
-                                          rotation=a)
-            mask[cc, rr] = OBJECT_TYPE_COLOR[t]
-        return mask
+        # Rasterize all the ellipses at once, same as skimage.draw.ellipse with
+        # rows along x, and let later objects overwrite the earlier ones
+        y, x = np.ogrid[0:self.cutout.shape[0], 0:self.cutout.shape[1]]
+        dx = x[None] - self.j[:, None, None]
+        dy = y[None] - self.i[:, None, None]
+        cos_a = np.cos(angle)[:, None, None]
+        sin_a = np.sin(angle)[:, None, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            distances = ((dx * cos_a + dy * sin_a) / width[:, None, None]) ** 2 + (
+                (dx * sin_a - dy * cos_a) / height[:, None, None]
+            ) ** 2
+        inside = distances < 1
+        last = len(inside) - 1 - np.argmax(inside[::-1], axis=0)
+        object_types = self.brick_index.object_types[self.indices]
+        mask = np.where(inside.any(axis=0), object_types[last], 0)
+        return mask.astype(np.uint8)
 
     def get_brightest_object_catalog(
         self, n_objects: int = 20
-    ) -> Dict[str, List[float]]:
-        self.catalog.sort(keys="FLUX_I")
-        brightest_object_data = {key: [] for key in NEARBY_CATALOG_INFORMATION}
-        brightest_object_catalog = self.catalog[:n_objects]
+    ) -> Dict[str, np.ndarray]:
+        order = np.argsort(np.asarray(self.catalog["FLUX_I"]), kind="stable")[:n_objects]
         # Check there is at least one object
         # The center object should at least be in the catalog
         assert (
-            len(brightest_object_catalog) > 0
+            len(order) > 0
         ), "The nearby catalog should at least contain one object."
 
-        for obj in brightest_object_catalog:
-            object_coordinates = SkyCoord(ra=obj["RA"]* u.deg, dec=obj["DEC"] * u.deg, unit="deg")
-            x_ind, y_ind = self.cutout.wcs.world_to_array_index(object_coordinates)
-
-            for key in NEARBY_CATALOG_INFORMATION:
-                if key == "TYPE":
-                    data = OBJECT_TYPE_COLOR[obj[key]]
-                elif key == "X":
-                    data = y_ind
-                elif key == "Y":
-                    data = x_ind
-                else:
-                    data = obj[key]
-                brightest_object_data[key].append(data)
-
-        # Pad with zeros data if necessary
-        for _ in range(len(brightest_object_catalog), n_objects):
-            for key in NEARBY_CATALOG_INFORMATION:
-                brightest_object_data[key].append(0)
+        brightest_object_data = {}
+        for key in NEARBY_CATALOG_INFORMATION:
+            if key == "TYPE":
+                data = self.brick_index.object_types[self.indices[order]]
+            elif key == "X":
+                data = self.j[order]
+            elif key == "Y":
+                data = self.i[order]
+            else:
+                data = np.asarray(self.catalog[key])[order]
+            # Pad with zeros data if necessary
+            dtype = np.int64 if key in ("TYPE", "X", "Y") else np.float64
+            padded = np.zeros(n_objects, dtype=dtype)
+            padded[: len(order)] = data
+            brightest_object_data[key] = padded
 
         return brightest_object_data
 
@@ -225,9 +228,24 @@ def build_catalog_dr10_south(legacysurvey_root_dir, output_dir, num_processes=1,
     return output_files
 
 
-def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str):
-    """Function that processes all the bricks that fall in a given healpix index"""
+def _write_catalog(catalog: Table, filename: str):
+    """Writes a catalog to a new HDF5 file with resizable datasets"""
+    with h5py.File(filename, 'w') as hdf5_file:
+        for key in catalog.colnames:
+            shape = catalog[key].shape
+            hdf5_file.create_dataset(key, data=catalog[key], compression="lzf", chunks=True, maxshape=(None, *shape[1:]))
+
+
+@traced
+def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str, shard_tag: Optional[str] = None):
+    """Function that processes all the bricks that fall in a given healpix index.
+
+    By default, the bricks are appended to `group_filename` under a file lock. If `shard_tag`
+    is provided, each brick is instead written to its own file in a `shards` directory next
+    to `group_filename`, to be assembled later by `merge_shards`.
+    """
     print(f"Process healpix {group_filename}.")
+    annotate(healpix=int(group['healpix'][0]), n_bricks=len(np.unique(group['BRICKNAME'])))
 
     # Create unique object ids for the group
     group['gid'] = np.arange(len(group))
@@ -257,6 +275,7 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
             image_filename = os.path.join(legacysurvey_root_dir, f'dr10/south/coadd/{brick_group}/{brick_name}', 'legacysurvey-{}-{}.fits.fz'.format(brick_name, band))
             with fits.open(image_filename) as hdul:
                 images[band] = hdul[1].copy()
+            record_input(image_filename)
 
         model_image_filename = os.path.join(
             legacysurvey_root_dir,
@@ -277,6 +296,8 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
         rgb_image = ImageOps.flip(rgb_image)
         rgb_image = np.array(rgb_image)
         rgb_image = np.moveaxis(rgb_image, -1, 0)  # Reshape C, H, W
+        record_input(model_image_filename, rgb_image_filename)
+        mark('read')
 
         # Post processing the mask to make it binary
         data = images['maskbits'].data 
@@ -286,10 +307,13 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
             maskclean &= (data & 2**bit)==0
         images['maskbits'].data = maskclean.astype(data.dtype)
 
+        wcs = WCS(images['image-g'].header)
+        # Index the brick catalog once for all the cutouts of this brick
+        brick_index = BrickCatalogIndex(brick, wcs)
+
         for obj in brick:
             # Create a cutout for each band
             ra, dec = obj['RA'], obj['DEC']
-            wcs = WCS(images['image-g'].header)
             x, y = wcs.all_world2pix(ra, dec, 1)
             position = (x, y)
             size = (_cutout_size, _cutout_size)
@@ -313,7 +337,7 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
 
             # Build cutout catalog and mask
             cutout = Cutout2D(images["image-i"].data, position, size, wcs=wcs)
-            catalog_selector = CatalogSelector(brick, cutout)
+            catalog_selector = CatalogSelector(brick_index, cutout)
             cutout_mask = catalog_selector.get_object_mask()
             cutout_catalog = catalog_selector.get_brightest_object_catalog()
 
@@ -364,6 +388,7 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
                 obj_data.update({f"catalog_{key}": val})
             out_images.append(obj_data)
 
+        mark('transform')
         # If we didn't find any images, we return 0
         if len(out_images) == 0:
             continue
@@ -373,36 +398,53 @@ def _processing_fn(group: Table, legacysurvey_root_dir: str, group_filename: str
 
         # Join on object_id with the input catalog
         catalog = join(group, images, 'gid', join_type='inner')
+        record_objects(len(catalog))
+        mark('transform')
             
         # Create the output directory if it does not exist
         out_path = os.path.dirname(group_filename)
         if not os.path.exists(out_path):
             os.makedirs(out_path, exist_ok=True)
 
-        with FileLock(group_filename + ".lock"):
-            if os.path.exists(group_filename):
-                # Load the existing file and concatenate the data with current data
-                with h5py.File(group_filename, 'a') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
-                        hdf5_file[key][-shape[0]:] = catalog[key]
-            else:           
-                # This is the first time we write the file, so we define the datasets
-                with h5py.File(group_filename, 'w') as hdf5_file:
-                    for key in catalog.colnames:
-                        shape = catalog[key].shape
-                        if len(shape) == 1:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="lzf", chunks=True, maxshape=(None,))
-                        else:
-                            hdf5_file.create_dataset(key, data=catalog[key], compression="lzf", chunks=True, maxshape=(None, *shape[1:]))
+        if shard_tag is not None:
+            # Each brick goes to its own shard, no lock is needed
+            shard_dir = os.path.join(out_path, 'shards')
+            os.makedirs(shard_dir, exist_ok=True)
+            shard_filename = os.path.join(shard_dir, f'{brick_name}-{shard_tag}.hdf5')
+            # Write to a temporary file first so that a crashed worker never leaves a partial shard
+            _write_catalog(catalog, shard_filename + '.tmp')
+            os.replace(shard_filename + '.tmp', shard_filename)
+            record_output(shard_filename)
+        else:
+            with FileLock(group_filename + ".lock"):
+                if os.path.exists(group_filename):
+                    # Load the existing file and concatenate the data with current data
+                    with h5py.File(group_filename, 'a') as hdf5_file:
+                        for key in catalog.colnames:
+                            shape = catalog[key].shape
+                            hdf5_file[key].resize(hdf5_file[key].shape[0] + shape[0], axis=0)
+                            hdf5_file[key][-shape[0]:] = catalog[key]
+                else:
+                    # This is the first time we write the file, so we define the datasets
+                    _write_catalog(catalog, group_filename)
+        mark('write')
 
         del catalog, images, out_images
 
+    if shard_tag is None:
+        record_output(group_filename)
+    return 1
+
 
-def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_processes=1, proc_id=None, healpix_idx=None):
+def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_processes=1, proc_id=None, healpix_idx=None, sharded=False,
+                    tracer: Optional[BuildTracer] = None):
     """ Extract cutouts for all detections in the parent sample   
+
+    If a `tracer` is provided, the stage timings of each healpix cell are recorded in it.
     """
+    # Shards are named after the catalog they come from, as a healpix cell can span several catalogs
+    shard_tag = os.path.splitext(os.path.basename(parent_sample))[0] if sharded else None
+
     # Load catalog
     parent_sample = Table.read(parent_sample)
 
@@ -418,7 +460,11 @@ def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_proce
         if healpix_idx is not None and group['healpix'][0] not in healpix_idx:
             continue
         group_filename = os.path.join(out_path, 'healpix={}/001-of-001.hdf5'.format(group['healpix'][0]))
-        map_args.append((group, legacysurvey_root_dir, group_filename))
+        map_args.append((group, legacysurvey_root_dir, group_filename, shard_tag))
+
+    # Cells with the most bricks to read first, so that the pool is not left waiting on them at the end.
+    # Cells are not split into shards, as objects of a cell are already written brick by brick.
+    map_args = largest_first(map_args, cost=lambda arg: len(np.unique(arg[0]['BRICKNAME'])))
 
     # Run the parallel processing
     with Pool(num_processes) as pool:
@@ -427,7 +473,7 @@ def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_proce
             result = pool.apply_async(
                 _processing_fn,
                 arg,
-                error_callback=partial(print_healpix_error, healpix_filename=arg[-1]),
+                error_callback=partial(print_healpix_error, healpix_filename=arg[2]),
             )
             results.append(result)
         # Wait for submitted jobs
@@ -435,7 +481,8 @@ def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_proce
         for result in results:
             result.wait()
             if result.successful():
-                n_successful_jobs += 1
+                record = result.get()
+                n_successful_jobs += tracer.add(record) if tracer is not None else record['result']
 
     if n_successful_jobs == len(map_args):
         print("Done!")
@@ -447,6 +494,53 @@ def extract_cutouts(parent_sample, legacysurvey_root_dir,  output_dir, num_proce
         )
 
 
+def _merge_healpix_shards(healpix_dir: str) -> int:
+    """Assembles all the brick shards of a healpix cell into a single 001-of-001.hdf5 file"""
+    shard_dir = os.path.join(healpix_dir, 'shards')
+    shard_files = sorted(glob.glob(os.path.join(shard_dir, '*.hdf5')))
+    if len(shard_files) == 0:
+        return 0
+
+    # Read the schema and the number of rows of every shard to preallocate the output
+    lengths = []
+    for shard_file in shard_files:
+        with h5py.File(shard_file, 'r') as shard:
+            if len(lengths) == 0:
+                schema = {key: (shard[key].shape[1:], shard[key].dtype) for key in shard.keys()}
+            lengths.append(shard['object_id'].shape[0])
+    n_rows = sum(lengths)
+
+    group_filename = os.path.join(healpix_dir, '001-of-001.hdf5')
+    with h5py.File(group_filename + '.tmp', 'w') as hdf5_file:
+        for key, (shape, dtype) in schema.items():
+            hdf5_file.create_dataset(key, shape=(n_rows, *shape), dtype=dtype, compression="lzf", chunks=True, maxshape=(None, *shape))
+        offset = 0
+        for shard_file, length in zip(shard_files, lengths):
+            with h5py.File(shard_file, 'r') as shard:
+                for key in schema:
+                    hdf5_file[key][offset:offset + length] = shard[key][:]
+            offset += length
+
+    # Replacing the previous file makes reruns of the same cell idempotent
+    os.replace(group_filename + '.tmp', group_filename)
+    shutil.rmtree(shard_dir)
+    return n_rows
+
+
+def merge_shards(output_dir, num_processes=1, healpix_idx=None):
+    """ Merge the brick shards produced by `extract_cutouts(..., sharded=True)` into one file per healpix cell
+    """
+    out_path = os.path.join(output_dir, 'dr10_south_21')
+    healpix_dirs = sorted(glob.glob(os.path.join(out_path, 'healpix=*')))
+    if healpix_idx is not None:
+        healpix_dirs = [d for d in healpix_dirs if int(d.split('healpix=')[-1]) in healpix_idx]
+    healpix_dirs = [d for d in healpix_dirs if os.path.isdir(os.path.join(d, 'shards'))]
+
+    with Pool(num_processes) as pool:
+        n_rows = list(tqdm(pool.imap_unordered(_merge_healpix_shards, healpix_dirs), total=len(healpix_dirs)))
+    print(f"Merged {sum(n_rows)} objects in {len(healpix_dirs)} healpix cells.")
+
+
 def main(args):
     # Create the output directory if it doesn't exist
     if not os.path.exists(args.output_dir):
@@ -455,19 +549,39 @@ def main(args):
     # Check if ran as part of a slurm job, if so, only the procid will be processed
     slurm_procid = int(os.getenv('SLURM_PROCID')) if 'SLURM_PROCID' in os.environ else None
 
+    tracer = BuildTracer(args.trace_file, name='legacysurvey')
+
+    if args.merge_only:
+        with tracer.stage('merge'):
+            merge_shards(args.output_dir, num_processes=args.num_processes, healpix_idx=args.healpix_idx)
+        tracer.close()
+        return
+
     # Build the catalogs
-    catalog_files = build_catalog_dr10_south(args.data_dir, args.output_dir, 
-                                             num_processes=args.num_processes,
-                                             n_output_files=args.nsplits,
-                                             proc_id=slurm_procid)
+    with tracer.stage('catalog'):
+        catalog_files = build_catalog_dr10_south(args.data_dir, args.output_dir, 
+                                                 num_processes=args.num_processes,
+                                                 n_output_files=args.nsplits,
+                                                 proc_id=slurm_procid)
     if args.catalog_only:
+        tracer.close()
         return
 
     # Extract the cutouts
     for sample in catalog_files:
         print("Processing file", sample)
         extract_cutouts(sample, args.data_dir, args.output_dir, 
-                        num_processes=args.num_processes, proc_id=slurm_procid, healpix_idx=args.healpix_idx)
+                        num_processes=args.num_processes, proc_id=slurm_procid, healpix_idx=args.healpix_idx,
+                        sharded=args.sharded, tracer=tracer)
+
+    if args.sharded:
+        if slurm_procid is not None:
+            # Other tasks may still be writing shards, the merge has to be run separately with --merge_only
+            print("Shards written, run again with --merge_only once all tasks are done.")
+        else:
+            with tracer.stage('merge'):
+                merge_shards(args.output_dir, num_processes=args.num_processes, healpix_idx=args.healpix_idx)
+    tracer.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Builds a catalog for the Legacy Survey images from DR10.')
@@ -477,6 +591,9 @@ if __name__ == '__main__':
     parser.add_argument('--catalog_only', action='store_true', help='Only compile the catalog, do not extract cutouts')
     parser.add_argument('--nsplits', type=int, default=10, help='Number of splits for the catalog')
     parser.add_argument('--healpix_idx', nargs="+", type=int, default=None, help='List of healpix indices to process')
+    parser.add_argument('--sharded', action='store_true', help='Write one shard per brick without locking, then merge them per healpix cell')
+    parser.add_argument('--merge_only', action='store_true', help='Only merge existing brick shards into healpix files')
+    parser.add_argument('--trace_file', type=str, default=None, help='JSON-lines file to which per-healpix stage timings are appended')
     args = parser.parse_args()
     print(args.healpix_idx)
     main(args)
@@ -0,0 +1,223 @@
+""" Static reader of the metadata of the dataset builder scripts.
+
+The citation, acknowledgements, description, homepage, license, version and configurations of a
+builder are read from the syntax tree of its script, without importing `datasets` or executing
+the module. The module constants (`_CITATION`, `_DESCRIPTION`, ...), the class attributes
+(`VERSION`, `BUILDER_CONFIGS`, `DEFAULT_CONFIG_NAME`) and the arguments of the `DatasetInfo`
+returned by `_info()` are evaluated with stand-ins for the `datasets` classes, so that they match
+the `info` of the builder loaded with `load_dataset_builder` for its default configuration.
+
+Results are cached on disk, keyed by the modification time and size of each script, so that
+listing all datasets only parses the scripts that changed since the last call.
+
+Usage:
+    python scripts/metadata.py [--data desi hsc] [--json]
+"""
+import argparse
+import ast
+import json
+import os
+import sys
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# Bumped whenever the content of the extracted metadata changes, to invalidate caches
+_EXTRACTOR_VERSION = 1
+
+_scripts_dir = os.path.dirname(os.path.abspath(__file__))
+_default_cache = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                              "mmu", "script_metadata.json")
+
+INFO_KEYS = ["citation", "description", "homepage", "license", "version"]
+
+# Builtins available to the evaluated expressions, enough to assemble strings and configurations
+_builtins = {f.__name__: f for f in [dict, enumerate, int, float, len, list, range, sorted, str, tuple, zip]}
+
+
+def _builder_config(*args, **kwargs):
+    return dict(kwargs)
+
+
+def _stand_ins(config_classes):
+    datasets = SimpleNamespace(
+        BuilderConfig=_builder_config,
+        DatasetInfo=_builder_config,
+        Version=lambda version, *args, **kwargs: str(version),
+    )
+    names = {
+        "datasets": datasets,
+        "DataFilesPatternsDict": SimpleNamespace(from_patterns=lambda patterns, *args, **kwargs: patterns),
+        "BuilderConfig": _builder_config,
+        "DatasetInfo": _builder_config,
+        "Version": datasets.Version,
+    }
+    names.update({name: _builder_config for name in config_classes})
+    return names
+
+
+def _evaluate(node: ast.expr, namespace: dict):
+    """ Evaluates an expression with the given names, returning None if it cannot be evaluated """
+    try:
+        return eval(compile(ast.Expression(node), "<metadata>", "eval"), namespace)
+    except Exception:
+        return None
+
+
+def _assignments(body, namespace: dict):
+    """ Evaluates the simple assignments of a block of statements, in order """
+    for statement in body:
+        if isinstance(statement, ast.Assign) and len(statement.targets) == 1 \
+                and isinstance(statement.targets[0], ast.Name):
+            value = _evaluate(statement.value, namespace)
+            if value is not None:
+                namespace[statement.targets[0].id] = value
+        elif isinstance(statement, ast.AnnAssign) and isinstance(statement.target, ast.Name) \
+                and statement.value is not None:
+            value = _evaluate(statement.value, namespace)
+            if value is not None:
+                namespace[statement.target.id] = value
+
+
+def _base_names(cls: ast.ClassDef):
+    return [base.attr if isinstance(base, ast.Attribute) else getattr(base, "id", None) for base in cls.bases]
+
+
+def _info_call(function: ast.FunctionDef) -> Optional[ast.Call]:
+    for node in ast.walk(function):
+        if isinstance(node, ast.Return) and isinstance(node.value, ast.Call):
+            func = node.value.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            if name == "DatasetInfo":
+                return node.value
+    return None
+
+
+def extract_metadata(source: str) -> dict:
+    """ Returns the metadata of a builder script, from its source code """
+    tree = ast.parse(source)
+    classes = [node for node in tree.body if isinstance(node, ast.ClassDef)]
+    config_classes = [cls.name for cls in classes if "BuilderConfig" in _base_names(cls)]
+    builders = [cls for cls in classes if any(name and name.endswith("BasedBuilder") for name in _base_names(cls))]
+
+    namespace = {"__builtins__": _builtins, **_stand_ins(config_classes)}
+    _assignments(tree.body, namespace)
+    module_names = set(namespace)
+
+    metadata = {
+        "builder": None,
+        "acknowledgements": namespace.get("_ACKNOWLEDGEMENTS"),
+        "default_config": None,
+        "configs": [],
+        **{key: None for key in INFO_KEYS},
+    }
+    if not builders:
+        return metadata
+
+    builder = builders[0]
+    metadata["builder"] = builder.name
+    class_namespace = dict(namespace)
+    _assignments(builder.body, class_namespace)
+    configs = class_namespace.get("BUILDER_CONFIGS") or []
+    metadata["configs"] = [
+        {"name": c.get("name"), "version": c.get("version"), "description": c.get("description"),
+         "data_files": c.get("data_files")}
+        for c in configs if isinstance(c, dict)
+    ]
+    default = class_namespace.get("DEFAULT_CONFIG_NAME")
+    if default is None and metadata["configs"]:
+        default = metadata["configs"][0]["name"]
+    metadata["default_config"] = default
+    default_config = next((c for c in configs if isinstance(c, dict) and c.get("name") == default), {})
+
+    # The version of the info of a builder is that of its configuration
+    metadata["version"] = default_config.get("version") or class_namespace.get("VERSION") \
+        or namespace.get("_VERSION")
+
+    attributes = {k: v for k, v in class_namespace.items() if k not in module_names}
+    self = SimpleNamespace(config=SimpleNamespace(**{**default_config, "name": default}), **attributes)
+    for function in builder.body:
+        if isinstance(function, ast.FunctionDef) and function.name == "_info":
+            local_namespace = {**class_namespace, "self": self, "cls": self}
+            _assignments(function.body, local_namespace)
+            call = _info_call(function)
+            if call is not None:
+                for keyword in call.keywords:
+                    if keyword.arg in INFO_KEYS and keyword.arg != "version":
+                        metadata[keyword.arg] = _evaluate(keyword.value, local_namespace)
+    return metadata
+
+
+def list_datasets(scripts_dir: str = _scripts_dir) -> List[str]:
+    """ Returns the names of the datasets with a builder script `<name>/<name>.py` """
+    return sorted(name for name in os.listdir(scripts_dir)
+                  if os.path.isfile(os.path.join(scripts_dir, name, f"{name}.py")))
+
+
+def _load_cache(cache_file: str) -> dict:
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_cache(cache: dict, cache_file: str):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError as e:
+        # The cache is only an optimization, e.g. on read-only home directories
+        print(f"Unable to write the metadata cache {cache_file}: {e}", file=sys.stderr)
+
+
+def get_metadata(datasets: Optional[List[str]] = None,
+                 scripts_dir: str = _scripts_dir,
+                 cache_file: Optional[str] = _default_cache) -> Dict[str, dict]:
+    """
+    Returns the metadata of the builder scripts of the given datasets, all of them by default.
+    Args:
+        datasets (List[str]): The names of the datasets.
+        scripts_dir (str): The directory of the dataset scripts.
+        cache_file (str): The JSON file caching the metadata, or None to disable the cache.
+    Returns:
+        A dictionary with the metadata of each dataset.
+    """
+    datasets = datasets if datasets is not None else list_datasets(scripts_dir)
+    cache = _load_cache(cache_file) if cache_file is not None else {}
+    updated = False
+    results = {}
+    for dataset in datasets:
+        script_path = os.path.abspath(os.path.join(scripts_dir, dataset, f"{dataset}.py"))
+        if not os.path.isfile(script_path):
+            raise FileNotFoundError(f"Dataset script not found: {script_path}")
+        stat = os.stat(script_path)
+        key = [stat.st_mtime_ns, stat.st_size, _EXTRACTOR_VERSION]
+        entry = cache.get(script_path)
+        if entry is None or entry["key"] != key:
+            with open(script_path, encoding="utf-8") as f:
+                entry = {"key": key, "metadata": extract_metadata(f.read())}
+            cache[script_path] = entry
+            updated = True
+        results[dataset] = entry["metadata"]
+    if updated and cache_file is not None:
+        _save_cache(cache, cache_file)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the datasets and the metadata of their builder scripts.")
+    parser.add_argument("-d", "--data", nargs="+", help="Specific datasets to list.")
+    parser.add_argument("--json", action="store_true", help="Print the full metadata as JSON.")
+    parser.add_argument("--no_cache", action="store_true", help="Do not read or write the metadata cache.")
+    args = parser.parse_args()
+
+    metadata = get_metadata(args.data, cache_file=None if args.no_cache else _default_cache)
+    if args.json:
+        print(json.dumps(metadata, indent=2))
+    else:
+        for dataset, info in metadata.items():
+            configs = ", ".join(str(c["name"]) for c in info["configs"])
+            print(f"{dataset:20} {str(info['version']):8} {configs}")
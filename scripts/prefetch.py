@@ -0,0 +1,85 @@
+""" Bounded prefetching of the input files read by the per-cell workers of the build_parent_sample pipelines.
+
+The workers of the spectroscopic surveys read thousands of small FITS files per healpix cell, one
+after the other, and spend most of their time waiting on the latency of the network filesystem.
+`prefetch` runs the function reading each file in a pool of threads, up to `depth` files ahead of
+the one being consumed, so that the next files are opened and decoded while the worker transforms
+the current ones:
+
+    results = []
+    for result in prefetch(filenames, processing_fn, depth=8, max_bytes=512 * 1024**2, size=file_size):
+        results.append(result)
+
+Results are yielded in the order of the inputs. Besides `depth`, the loads in flight are bounded
+by `max_bytes`, the sum of the `size` of their inputs, e.g. their file size, so that prefetching
+large files does not exhaust the memory of the worker. An item larger than `max_bytes` is loaded
+alone, once nothing else is in flight.
+
+Exceptions raised by the function are raised when its result is consumed.
+"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional
+
+# Default prefetching of the pipelines, overridden with their --prefetch_depth and --prefetch_mb arguments
+DEFAULT_DEPTH = 8
+DEFAULT_MB = 512
+
+
+def file_size(*paths) -> int:
+    """ Total size of files, missing files counting for nothing """
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def prefetch(items: Iterable,
+             load: Callable,
+             depth: int = DEFAULT_DEPTH,
+             max_bytes: Optional[int] = None,
+             size: Optional[Callable] = None,
+             num_threads: Optional[int] = None) -> Iterator:
+    """ Yields `load(item)` for each item, in order, loading the following items in a pool of threads.
+
+    Args:
+        items: Inputs of `load`, e.g. file names.
+        load: Function opening and decoding an input.
+        depth: Maximum number of items loaded ahead of the one being consumed. Items are loaded
+            one at a time, without threads, if it is 0.
+        max_bytes: Maximum total `size` of the items loaded ahead, unbounded if None. Larger items
+            are loaded alone.
+        size: Function returning the size in bytes of an item, required with `max_bytes`.
+        num_threads: Number of threads loading items, `depth` by default.
+    """
+    if depth <= 0:
+        for item in items:
+            yield load(item)
+        return
+    if max_bytes is not None and size is None:
+        raise ValueError("The size of the items is required to bound the bytes in flight")
+
+    # Items are paired with their size, so that the next one is only loaded if it fits within max_bytes
+    items = ((item, size(item) if max_bytes is not None else 0) for item in items)
+    upcoming = next(items, _end)
+    pending = deque()  # (future, size) of the items loaded ahead, in order
+    in_flight = 0
+    executor = ThreadPoolExecutor(max_workers=num_threads or depth)
+    try:
+        while True:
+            # Load items ahead while within both bounds, or if nothing is loading
+            while upcoming is not _end and len(pending) < depth and (
+                    max_bytes is None or in_flight + upcoming[1] <= max_bytes or not pending):
+                item, item_size = upcoming
+                pending.append((executor.submit(load, item), item_size))
+                in_flight += item_size
+                upcoming = next(items, _end)
+            if not pending:
+                return
+            future, item_size = pending.popleft()
+            in_flight -= item_size
+            yield future.result()
+    finally:
+        # Stops loading items if the consumer stops early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+_end = object()
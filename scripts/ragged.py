@@ -0,0 +1,46 @@
+""" Ragged (values + offsets) storage of variable-length columns in the parent sample HDF5 files.
+
+Columns whose rows have different lengths, like the binned spectra of Chandra, are stored in a
+group of the file with one flat dataset per column, holding the concatenated rows, and a shared
+`offsets` dataset of `n_rows + 1` indices, so that row `i` of column `k` is
+
+    group[k][offsets[i]:offsets[i + 1]]
+
+Compared to vlen datasets, which h5py writes one element at a time, each column is written in a
+single call, and readers can load a whole column at once and slice it in memory. The group has
+no `object_id`, so that its datasets are not mistaken for columns of the catalog.
+"""
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+
+def pack_ragged(rows: Sequence[np.ndarray], dtype=None) -> Tuple[np.ndarray, np.ndarray]:
+    """ Concatenates variable-length rows into a flat array of values and the offsets of the rows """
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if len(rows) == 0:
+        return np.zeros(0, dtype=dtype or np.float64), offsets
+    return np.concatenate(rows).astype(dtype, copy=False) if dtype is not None else np.concatenate(rows), offsets
+
+
+def write_ragged(parent, name: str, columns: Dict[str, Sequence[np.ndarray]], dtype=None, **kwargs):
+    """ Writes columns of variable-length rows to the group `name` of an HDF5 file or group.
+
+    All the columns must have the same number of rows, and the same length for each row, as they
+    share the offsets of the group. Additional arguments, e.g. `compression`, are passed to
+    `create_dataset` for the values of the columns.
+    """
+    group = parent.create_group(name)
+    offsets = None
+    for key, rows in columns.items():
+        values, column_offsets = pack_ragged(rows, dtype=dtype)
+        if offsets is None:
+            offsets = column_offsets
+            group.create_dataset('offsets', data=offsets)
+        elif not np.array_equal(offsets, column_offsets):
+            raise ValueError(f"The rows of {key} do not have the same lengths as those of the other columns of {name}")
+        # Empty datasets cannot be chunked, and hence compressed
+        group.create_dataset(key, data=values, **(kwargs if len(values) else {}))
+    return group
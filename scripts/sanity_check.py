@@ -1,39 +1,356 @@
-import multiprocessing
-import h5py
+""" Integrity verifier of a parent sample, against the features of its builder script.
+
+The sample is the directory of a dataset, containing its builder script `<name>/<name>.py`.
+For each configuration of the builder, every file of its train split is checked in a pool of
+processes:
+ - every group of the file holding a one dimensional `object_id` column must have the same number
+   of rows in all its columns,
+ - every example generated by the builder from the file must match the shapes and dtypes of the
+   features declared by `_info()`, and be encodable by them.
+
+The size, modification time and checksum of the files that pass are written to a manifest, and
+files are only checked again when they change, or when the builder script changes, so that a
+release can be revalidated quickly after a partial rebuild.
+
+Usage:
+    python sanity_check.py /mnt/ceph/users/polymathic/MultimodalUniverse/desi --n_proc 32
+"""
 import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
 from glob import glob
+
+import h5py
+import numpy as np
+from datasets import (
+    Array2D,
+    Array3D,
+    Array4D,
+    Array5D,
+    DownloadManager,
+    Sequence,
+    Value,
+    load_dataset_builder,
+)
 from tqdm import tqdm
 
+# Builders are loaded once per configuration in each worker process
+_builders = {}
+
+
+def load_builder(sample_path: str, config: str):
+    if (sample_path, config) not in _builders:
+        _builders[(sample_path, config)] = load_dataset_builder(sample_path, config, trust_remote_code=True)
+    return _builders[(sample_path, config)]
+
+
+def builder_script(sample_path: str) -> str:
+    return os.path.join(sample_path, os.path.basename(os.path.normpath(sample_path)) + ".py")
+
+
+def checksum(filename: str, block_size: int = 2**24) -> str:
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def config_files(builder):
+    """ Returns the files of the train split, in the format expected by `_generate_examples` """
+    dl_manager = DownloadManager(dataset_name=builder.name, base_path=builder.base_path)
+    for split_generator in builder._split_generators(dl_manager):
+        if split_generator.name == "train":
+            return [f if isinstance(f, str) else list(f) for f in split_generator.gen_kwargs["files"]]
+    return []
+
+
+def entry_paths(entry):
+    return [entry] if isinstance(entry, str) else entry
+
+
+# Kinds of numpy dtypes accepted by each kind of feature dtype, numbers being cast to each other on encoding
+_compatible_kinds = {"b": "biuf", "i": "biuf", "u": "biuf", "f": "biuf", "c": "biufc", "S": "SUO", "U": "SUO", "O": "SUO"}
+
+
+def _dtype_kind(dtype: str) -> str:
+    if dtype == "string" or dtype == "large_string":
+        return "U"
+    if dtype == "binary" or dtype == "large_binary":
+        return "S"
+    if dtype == "bool":
+        return "b"
+    try:
+        return np.dtype(dtype).kind
+    except TypeError:
+        # Timestamps and other arrow types, only checked by the encoding
+        return None
+
+
+def _check_dtype(array: np.ndarray, dtype: str, name: str):
+    kind = _dtype_kind(dtype)
+    if kind is None or array.size == 0 or array.dtype.kind not in "biufcSUO":
+        return []
+    if array.dtype.kind == "O" and kind not in "SU":
+        return [f"{name}: expected {dtype} values, got objects"]
+    if array.dtype.kind not in _compatible_kinds[kind]:
+        return [f"{name}: expected {dtype} values, got {array.dtype}"]
+    return []
+
+
+def check_example(example, feature, name: str = "example"):
+    """ Returns the list of mismatches between an example and a feature of a builder """
+    if isinstance(feature, dict):
+        if not isinstance(example, dict):
+            return [f"{name}: expected a dictionary, got {type(example).__name__}"]
+        # Undeclared keys are dropped by the encoding, but declared ones would silently be null
+        errors = [f"{name}.{k}: missing" for k in feature if k not in example]
+        for k in feature:
+            if k in example:
+                errors += check_example(example[k], feature[k], f"{name}.{k}")
+        return errors
+
+    if isinstance(feature, (list, Sequence)):
+        length = feature.length if isinstance(feature, Sequence) else -1
+        inner = feature.feature if isinstance(feature, Sequence) else feature[0]
+        if isinstance(feature, Sequence) and isinstance(inner, dict):
+            # Sequences of dictionaries are given either as lists of dictionaries, or as
+            # dictionaries of sequences of the same length
+            if not isinstance(example, dict):
+                return check_example(example, [inner], name)
+            errors = check_example(example, {k: Sequence(v, length=length) for k, v in inner.items()}, name)
+            lengths = {len(v) for v in example.values() if hasattr(v, "__len__")}
+            if len(lengths) > 1:
+                errors.append(f"{name}: sequences of different lengths {sorted(lengths)}")
+            return errors
 
-def check_file(filename: str):
+        # Nested sequences of values are checked at once as an array
+        dims = [length]
+        while isinstance(inner, Sequence) and not isinstance(inner.feature, dict):
+            dims.append(inner.length)
+            inner = inner.feature
+        if isinstance(inner, Value):
+            try:
+                array = np.asarray(example)
+            except ValueError:
+                array = None
+            if array is not None and array.ndim >= len(dims) and array.dtype != object:
+                if array.ndim != len(dims):
+                    return [f"{name}: expected {len(dims)} dimensions, got shape {array.shape}"]
+                if any(d >= 0 and d != s for d, s in zip(dims, array.shape)):
+                    return [f"{name}: expected shape {tuple(d if d >= 0 else None for d in dims)}, got {array.shape}"]
+                return _check_dtype(array, inner.dtype, name)
+
+        if not hasattr(example, "__len__") or isinstance(example, (str, bytes)):
+            return [f"{name}: expected a sequence, got {type(example).__name__}"]
+        if length >= 0 and len(example) != length:
+            return [f"{name}: expected {length} elements, got {len(example)}"]
+        inner = feature.feature if isinstance(feature, Sequence) else feature[0]
+        errors = []
+        for i, value in enumerate(example):
+            errors += check_example(value, inner, f"{name}[{i}]")
+            if errors:
+                break
+        return errors
+
+    if isinstance(feature, (Array2D, Array3D, Array4D, Array5D)):
+        array = np.asarray(example)
+        shape = tuple(feature.shape)
+        if array.ndim != len(shape) or any(d is not None and d != s for d, s in zip(shape, array.shape)):
+            return [f"{name}: expected shape {shape}, got {array.shape}"]
+        return _check_dtype(array, feature.dtype, name)
+
+    if isinstance(feature, Value):
+        if example is None:
+            return []
+        array = np.asarray(example)
+        if array.ndim != 0:
+            return [f"{name}: expected a scalar {feature.dtype}, got shape {array.shape}"]
+        return _check_dtype(array, feature.dtype, name)
+
+    # Other features, like images or class labels, are only checked by the encoding
+    return []
+
+
+def check_row_counts(filename: str):
+    """ Returns the columns of a file whose number of rows differs from that of `object_id` in their group """
+    errors = []
+    with h5py.File(filename, "r") as f:
+        groups = [f]
+        f.visititems(lambda _, obj: groups.append(obj) if isinstance(obj, h5py.Group) else None)
+        for group in groups:
+            if not isinstance(group.get("object_id"), h5py.Dataset) or group["object_id"].ndim != 1:
+                continue
+            n_rows = group["object_id"].shape[0]
+            for key, column in group.items():
+                if isinstance(column, h5py.Dataset) and column.ndim >= 1 and column.shape[0] != n_rows:
+                    errors.append(f"{column.name}: {column.shape[0]} rows, expected {n_rows} as object_id")
+    return errors
+
+
+def verify_entry(args):
+    """ Checks the files of one entry of the train split of a configuration """
+    sample_path, config, entry, max_examples = args
+    result = {"config": config, "files": entry_paths(entry), "errors": [], "n_examples": 0, "checksums": {}}
     try:
-        with h5py.File(filename, "r") as f:
-            f["object_id"][:]
+        for filename in result["files"]:
+            result["errors"] += check_row_counts(filename)
+
+        builder = load_builder(sample_path, config)
+        features = builder.info.features
+        for _, example in builder._generate_examples(files=[entry]):
+            errors = check_example(example, dict(features))
+            if not errors:
+                try:
+                    features.encode_example(example)
+                except Exception as e:
+                    errors.append(f"encoding failed: {type(e).__name__}: {e}")
+            if errors:
+                # Columns are usually wrong for all the examples of a file, the first one is enough
+                result["errors"] += [f"example {result['n_examples']}: {error}" for error in errors]
+                break
+            result["n_examples"] += 1
+            if max_examples is not None and result["n_examples"] >= max_examples:
+                break
+
+        if not result["errors"]:
+            result["checksums"] = {filename: checksum(filename) for filename in result["files"]}
     except Exception as e:
-        return filename, e
+        result["errors"].append(f"{type(e).__name__}: {e}")
+    return result
+
+
+def _stat(filename: str):
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def unchanged(filename: str, record) -> bool:
+    """ Whether a file matches its manifest record, comparing checksums only if the modification time changed """
+    if record is None:
+        return False
+    stat = _stat(filename)
+    if stat["size"] != record["size"]:
+        return False
+    if stat["mtime_ns"] == record["mtime_ns"]:
+        return True
+    if checksum(filename) == record["checksum"]:
+        # Touched or copied, but not modified
+        record.update(stat)
+        return True
+    return False
+
+
+def load_manifest(manifest_path: str, builder_checksum: str):
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("builder_checksum") == builder_checksum:
+            return manifest
+        print("The builder script changed since the last verification, checking all files")
+    return {"builder_checksum": builder_checksum, "files": {}}
+
+
+def save_manifest(manifest, manifest_path: str):
+    # Written to a temporary file first, so that an interrupted run does not corrupt the manifest
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def verify_sample(sample_path: str,
+                  configs=None,
+                  manifest_path=None,
+                  n_proc: int = 1,
+                  chunks: int = 1,
+                  max_examples=None,
+                  force: bool = False,
+                  save_every: int = 100):
+    """ Checks the files of a parent sample which changed since the last verification.
+
+    Returns:
+        The errors found in each failing file.
+    """
+    sample_path = os.path.abspath(sample_path)
+    manifest_path = manifest_path or os.path.join(sample_path, "sanity_manifest.json")
+    manifest = load_manifest(manifest_path, checksum(builder_script(sample_path)))
+    if force:
+        manifest["files"] = {}
+
+    builder = load_dataset_builder(sample_path, trust_remote_code=True)
+    configs = configs or [config.name for config in builder.BUILDER_CONFIGS]
+    tasks = []
+    referenced = set()
+    n_unchanged = 0
+    for config in configs:
+        try:
+            entries = config_files(load_builder(sample_path, config))
+        except Exception as e:
+            print(f"Skipping configuration {config}, whose files cannot be resolved: {e}")
+            continue
+        for entry in entries:
+            paths = entry_paths(entry)
+            referenced.update(os.path.abspath(p) for p in paths)
+            records = [manifest["files"].get(os.path.relpath(p, sample_path)) for p in paths]
+            # Files only checked on their first examples are checked again by a full verification
+            if all(unchanged(p, r) and r["config"] == config and (r.get("full") or max_examples is not None)
+                   for p, r in zip(paths, records)):
+                n_unchanged += 1
+            else:
+                tasks.append((sample_path, config, entry, max_examples))
+
+    unreferenced = set(os.path.abspath(p) for p in glob(os.path.join(sample_path, "**", "*.hdf5"), recursive=True)) - referenced
+    if unreferenced:
+        print(f"{len(unreferenced)} hdf5 files are not referenced by any configuration, e.g. {sorted(unreferenced)[0]}")
+    print(f"Checking {len(tasks)} files, {n_unchanged} unchanged since the last verification")
+
+    failures = {}
+    with multiprocessing.Pool(n_proc) as pool:
+        results = tqdm(pool.imap_unordered(verify_entry, tasks, chunksize=chunks), total=len(tasks))
+        for i, result in enumerate(results):
+            name = os.path.relpath(result["files"][0], sample_path)
+            results.set_postfix_str(name, refresh=False)
+            for filename in result["files"]:
+                manifest["files"].pop(os.path.relpath(filename, sample_path), None)
+            if result["errors"]:
+                failures[name] = result["errors"]
+                tqdm.write(f"{name} ({result['config']}) failed: " + "; ".join(result["errors"][:5]))
+                continue
+            for filename in result["files"]:
+                manifest["files"][os.path.relpath(filename, sample_path)] = {
+                    **_stat(filename),
+                    "checksum": result["checksums"][filename],
+                    "config": result["config"],
+                    "n_examples": result["n_examples"],
+                    "full": max_examples is None,
+                    "verified_at": time.time(),
+                }
+            if (i + 1) % save_every == 0:
+                save_manifest(manifest, manifest_path)
+    save_manifest(manifest, manifest_path)
+
+    print(f"{len(failures)} files failed out of {len(tasks)} checked, manifest written to {manifest_path}")
+    return failures
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Tests whether all hdf5 can be read correctly for a given sample."
+        description="Checks the hdf5 files of a sample against the features of its builder, skipping the files unchanged since the last run."
     )
-    parser.add_argument("sample_path", type=str, help="Path of the sample")
+    parser.add_argument("sample_path", type=str, help="Path of the sample, containing its builder script")
+    parser.add_argument("--configs", type=str, nargs="+", default=None, help="Configurations to check, all of them by default")
+    parser.add_argument("--manifest", type=str, default=None, help="Path of the manifest, sanity_manifest.json in the sample by default")
     parser.add_argument("--n_proc", type=int, default=1, help="Number of processes")
     parser.add_argument("--chunks", type=int, default=1, help="Chunk size per process")
+    parser.add_argument("--max_examples", type=int, default=None, help="Number of examples checked per file, all of them by default")
+    parser.add_argument("--force", action="store_true", help="Check all files, ignoring the manifest")
     args = parser.parse_args()
-    root = args.sample_path
-    n_proc = args.n_proc
-    chunks = args.chunks
-    path = f"{root}/*/*/*.hdf5"
-    files = glob(path)
-    n_problematic_files = 0
-    with multiprocessing.Pool(n_proc) as pool:
-        results = tqdm(
-            pool.imap_unordered(check_file, files, chunksize=chunks), total=len(files)
-        )
-        for r in results:
-            if r is not None:
-                filename, error = r
-                print(f"Fail to load {filename} due to error {error}")
-                n_problematic_files += 1
-    print(f"Failed to load {n_problematic_files} files out of {len(files)}")
+
+    failures = verify_sample(args.sample_path, configs=args.configs, manifest_path=args.manifest,
+                             n_proc=args.n_proc, chunks=args.chunks, max_examples=args.max_examples,
+                             force=args.force)
+    if failures:
+        raise SystemExit(1)
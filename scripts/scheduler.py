@@ -0,0 +1,136 @@
+""" Cost-aware scheduling of the healpix cells processed by the build_parent_sample pipelines.
+
+Processing the cells in catalog order leaves the pool waiting on the densest cells (Galactic
+plane, Kepler field, deep fields) long after the other workers are done. Instead, the cost of
+each cell is estimated as the sum of the costs of its objects (one per object by default, or
+e.g. the number of files to read per object), tasks are run largest first and, on request,
+cells whose cost exceeds a fraction of the cost per worker are split into several `NNN-of-MMM.hdf5`
+shards, which the dataset builders already load with their `healpix=*/*.hdf5` patterns:
+
+    tasks = plan_cells(catalog['healpix'], num_workers=args.num_processes, oversubscription=4)
+    remove_stale_shards(tasks, cell_dir)
+    map_args = [(catalog[task.rows], task.filename(cell_dir(task.healpix)), ...) for task in tasks]
+    print_plan(tasks, args.num_processes)
+    with Pool(args.num_processes) as pool:
+        results = list(pool.imap_unordered(save_in_standard_format, map_args))
+
+The split of a cell only depends on the costs of its objects and its number of shards, so that
+the shard of a cell can be recomputed by a separate job with `split_cell`.
+"""
+import glob
+import heapq
+import math
+import os
+import re
+from typing import Callable, List, NamedTuple, Optional
+
+import numpy as np
+
+_shard_pattern = re.compile(r'^(\d+)-of-(\d+)\.hdf5$')
+
+
+def shard_filename(cell_dir: str, shard: int, n_shards: int) -> str:
+    """ Returns the path of a shard of a healpix cell, numbered from 0 """
+    return os.path.join(cell_dir, f'{shard + 1:03d}-of-{n_shards:03d}.hdf5')
+
+
+class CellTask(NamedTuple):
+    """ A shard of a healpix cell, with the indices of its rows in the catalog and its estimated cost """
+    healpix: int
+    shard: int
+    n_shards: int
+    rows: np.ndarray
+    cost: float
+
+    def filename(self, cell_dir: str) -> str:
+        return shard_filename(cell_dir, self.shard, self.n_shards)
+
+
+def split_cell(costs: np.ndarray, n_shards: int) -> List[np.ndarray]:
+    """ Splits the rows of a cell into contiguous shards of about the same cost """
+    costs = np.asarray(costs, dtype=np.float64)
+    if n_shards <= 1:
+        return [np.arange(len(costs))]
+    cumulative = np.cumsum(costs)
+    bounds = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, n_shards) / n_shards, side='right')
+    return np.split(np.arange(len(costs)), bounds)
+
+
+def plan_cells(healpix,
+               costs=None,
+               num_workers: int = 1,
+               max_cost: Optional[float] = None,
+               oversubscription: Optional[float] = None,
+               min_objects: int = 100,
+               order=None) -> List[CellTask]:
+    """ Plans the processing of the healpix cells of a catalog, largest tasks first.
+
+    Args:
+        healpix: Healpix index of each object of the catalog.
+        costs: Estimated processing cost of each object, 1 by default.
+        num_workers: Number of processes running the tasks.
+        max_cost: Maximum cost of a task, above which a cell is split into several shards. Cells are not
+            split if None, unless `oversubscription` is given.
+        oversubscription: If given, and `max_cost` is None, the maximum cost of a task is the total cost
+            divided by `oversubscription` times the number of workers, so that the largest tasks are small
+            enough for the pool to remain busy until the end.
+        min_objects: Minimum number of objects of a shard, cells are not split into smaller shards.
+        order: Key by which the rows of a cell are sorted before splitting it, e.g. the input file of each
+            object, so that the shards of a cell read as few common files as possible.
+
+    Returns:
+        The list of tasks, by decreasing cost.
+    """
+    healpix = np.asarray(healpix)
+    costs = np.ones(len(healpix)) if costs is None else np.asarray(costs, dtype=np.float64)
+    if max_cost is None and oversubscription is not None:
+        max_cost = costs.sum() / (oversubscription * max(num_workers, 1))
+
+    if order is None:
+        index = np.argsort(healpix, kind='stable')
+    else:
+        index = np.lexsort((np.asarray(order), healpix))
+    cells, starts = np.unique(healpix[index], return_index=True)
+
+    tasks = []
+    for cell, rows in zip(cells, np.split(index, starts[1:])):
+        cell_costs = costs[rows]
+        n_shards = max(1, min(math.ceil(cell_costs.sum() / max_cost) if max_cost is not None and max_cost > 0 else 1,
+                              len(rows) // max(min_objects, 1)))
+        for shard, shard_rows in enumerate(split_cell(cell_costs, n_shards)):
+            tasks.append(CellTask(int(cell), shard, n_shards, rows[shard_rows], float(cell_costs[shard_rows].sum())))
+    return sorted(tasks, key=lambda task: -task.cost)
+
+
+def largest_first(tasks, cost: Callable) -> list:
+    """ Sorts tasks by decreasing cost, for pipelines which do not split their cells """
+    return sorted(tasks, key=cost, reverse=True)
+
+
+def estimated_utilization(costs, num_workers: int) -> float:
+    """ Fraction of the time the workers are busy, when tasks are given in order to the first idle worker """
+    if len(costs) == 0:
+        return 1.
+    loads = [0.] * max(num_workers, 1)
+    for cost in costs:
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return sum(costs) / (len(loads) * max(loads)) if max(loads) > 0 else 1.
+
+
+def print_plan(tasks: List[CellTask], num_workers: int):
+    n_cells = len({task.healpix for task in tasks})
+    n_split = len({task.healpix for task in tasks if task.n_shards > 1})
+    costs = [task.cost for task in tasks]
+    print(f"Processing {n_cells} healpix cells in {len(tasks)} tasks, {n_split} cells split into shards, "
+          f"estimated pool utilization {100 * estimated_utilization(costs, num_workers):.0f}%")
+
+
+def remove_stale_shards(tasks: List[CellTask], cell_dir: Callable[[int], str]):
+    """ Removes the shards of a cell written by a previous build with a different number of shards,
+    which would otherwise be loaded along with the new ones. """
+    n_shards = {task.healpix: task.n_shards for task in tasks}
+    for healpix, n in n_shards.items():
+        for path in glob.glob(os.path.join(cell_dir(healpix), '*-of-*.hdf5')):
+            match = _shard_pattern.match(os.path.basename(path))
+            if match is not None and int(match.group(2)) != n:
+                os.remove(path)
@@ -1,13 +1,20 @@
 import os
+import sys
 import argparse
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table, join
+from functools import partial
 from multiprocessing import Pool
 from tqdm import tqdm
 import healpy as hp
 import h5py
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from prefetch import DEFAULT_DEPTH, DEFAULT_MB, file_size, prefetch
+from scheduler import plan_cells, print_plan, remove_stale_shards
+
 _healpix_nside = 16
 
 # Breakdown of the different surveys, each one will be stored as a subdataset
@@ -31,6 +38,7 @@ def processing_fn(args):
     
     # Load the plate file
     hdus = fits.open(filename)
+    record_input(filename)
 
     flux = hdus[0].data[fiber_ids]
     ivar = hdus[1].data[fiber_ids]
@@ -60,11 +68,13 @@ def processing_fn(args):
             'spectrum_lsf_sigma': lsf_sigma}
 
 
-def save_in_standard_format(args):
+@traced
+def save_in_standard_format(args, prefetch_depth=DEFAULT_DEPTH, prefetch_mb=DEFAULT_MB):
     """ This function takes care of iterating through the different input files 
     corresponding to this healpix index, and exporting the data in standard format.
     """
     catalog, output_filename, sdss_data_path = args
+    annotate(healpix=int(catalog['healpix'][0]), survey=catalog['SURVEY'][0].strip())
     # Create the output directory if it does not exist
     if not os.path.exists(os.path.dirname(output_filename)):
         os.makedirs(os.path.dirname(output_filename))
@@ -89,10 +99,10 @@ def save_in_standard_format(args):
         map_args += [(os.path.join(sdss_data_path, survey.strip(),str(plate).zfill(4), filename), 
                       fiberid, object_id)]
 
-    # Process all files
-    results = []
-    for args in map_args:
-        results.append(processing_fn(args))
+    # Process all files, reading the next plates in threads while the previous ones are processed
+    results = list(prefetch(map_args, processing_fn, depth=prefetch_depth,
+                            max_bytes=prefetch_mb * 1024**2, size=lambda args: file_size(args[0])))
+    mark('read')
 
     # Pad all spectra to the same length
     max_length = max([len(d['spectrum_flux'][0]) for d in results])
@@ -112,17 +122,24 @@ def save_in_standard_format(args):
 
     # Making sure we didn't lose anyone
     assert len(catalog) == len(spectra), "There was an error in the join operation, probably some spectra files are missing"
+    mark('transform')
 
     # Save all columns to disk in HDF5 format
     with h5py.File(output_filename, 'w') as hdf5_file:
         for key in catalog.colnames:
             hdf5_file.create_dataset(key, data=catalog[key])
+    mark('write')
+    record_output(output_filename)
+    record_objects(len(catalog))
     return 1
 
 def main(args):
+    tracer = BuildTracer(args.trace_file, name='sdss')
+
     # Load the catalog file and apply main cuts
-    catalog = Table.read(os.path.join(args.sdss_data_path, "specObj-dr17.fits"))
-    catalog = catalog[selection_fn(catalog)]
+    with tracer.stage('catalog'):
+        catalog = Table.read(os.path.join(args.sdss_data_path, "specObj-dr17.fits"))
+        catalog = catalog[selection_fn(catalog)]
 
     # Add healpix index to the catalog
     catalog['healpix'] = hp.ang2pix(_healpix_nside, catalog['PLUG_RA'], catalog['PLUG_DEC'], lonlat=True, nest=True)
@@ -132,22 +149,27 @@ def main(args):
         print("Processing survey:", survey)
 
         cat_survey = catalog[catalog['SURVEY'] == survey]
-        cat_survey = cat_survey.group_by(['healpix'])
+
+        # Largest cells first, dense cells being split with --oversubscription into shards which keep the objects of a plate together
+        tasks = plan_cells(cat_survey['healpix'], num_workers=args.num_processes, order=cat_survey['PLATE'],
+                           oversubscription=args.oversubscription)
+        cell_dir = lambda healpix: os.path.join(args.output_dir, survey.strip(), 'healpix={}'.format(healpix))
+        remove_stale_shards(tasks, cell_dir)
+        print_plan(tasks, args.num_processes)
 
         # Preparing the arguments for the parallel processing
         map_args = []
-        for group in cat_survey.groups:
-            # Create a filename for the group
-            group_filename = os.path.join(args.output_dir, '{}/healpix={}/001-of-001.hdf5'.format(survey.strip(), group['healpix'][0]))
-            map_args.append((group, group_filename, args.sdss_data_path))
+        for task in tasks:
+            map_args.append((cat_survey[task.rows], task.filename(cell_dir(task.healpix)), args.sdss_data_path))
 
         # Run the parallel processing
         with Pool(args.num_processes) as pool:
-            results = list(tqdm(pool.imap(save_in_standard_format, map_args), total=len(map_args)))
+            results = list(tqdm(tracer.collect(pool.imap_unordered(partial(save_in_standard_format, prefetch_depth=args.prefetch_depth, prefetch_mb=args.prefetch_mb), map_args)), total=len(map_args)))
 
         if sum(results) != len(map_args):
             print("There was an error in the parallel processing, some files may not have been processed correctly")
 
+    tracer.close()
     print("All done!")
 
 if __name__ == '__main__':
@@ -155,6 +177,10 @@ if __name__ == '__main__':
     parser.add_argument('sdss_data_path', type=str, help='Path to the local copy of the SDSS data')
     parser.add_argument('output_dir', type=str, help='Path to the output directory')
     parser.add_argument('--num_processes', type=int, default=10, help='The number of processes to use for parallel processing')
+    parser.add_argument('--oversubscription', type=float, default=None, help='Split dense healpix cells into shards, so that each task costs at most the total divided by oversubscription times the number of processes. Cells are not split by default')
+    parser.add_argument('--prefetch_depth', type=int, default=DEFAULT_DEPTH, help='Number of plate files read ahead in threads by each process, 0 to read them one at a time')
+    parser.add_argument('--prefetch_mb', type=float, default=DEFAULT_MB, help='Maximum size in MB of the plate files read ahead by each process')
+    parser.add_argument('--trace_file', type=str, default=None, help='JSON-lines file to which per-healpix stage timings are appended')
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
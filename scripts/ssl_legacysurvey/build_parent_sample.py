@@ -29,22 +29,9 @@ _image_size = 152
 _pixel_scale = 0.262
 _healpix_nside = 16
 
-def _processing_fn(args):
-    catalog, input_files, output_filename = args
-
-    if not os.path.exists(os.path.dirname(output_filename)):
-        os.makedirs(os.path.dirname(output_filename))
-
-    keys = catalog['internal_inds']
-
-    # Sort the input files by name
-    input_files = sorted(input_files)
-
-    # Open all the data files
-    files = [h5py.File(file, 'r') for file in input_files]
-
+def _read_rows(files, keys):
+    """ Reads the requested internal indices one row at a time, in catalog order. """
     images = []
-    indss = []
     # Loop over the indices and yield the requested data
     for i, id in enumerate(keys):
         # Get the entry from the corresponding file
@@ -61,12 +48,74 @@ def _processing_fn(args):
         })
 
     # Aggregate all images into an astropy table
-    images = Table({k: [d[k] for d in images] for k in images[0].keys()})
+    return Table({k: [d[k] for d in images] for k in images[0].keys()})
+
+def _read_blocks(files, keys, max_gap=0):
+    """ Reads the rows of all requested internal indices by sorting them and coalescing
+    them into contiguous ranges, each range being read with a single slice.
+
+    Ranges separated by at most `max_gap` unrequested rows are merged into a single read.
+    Returns the inds, images and psfsize of the requested rows, in the order of `keys`.
+    """
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    file_idx = sorted_keys // 1_000_000
+    file_ind = sorted_keys % 1_000_000
+
+    # Start a new range when the gap is too large or when changing file
+    breaks = np.flatnonzero((np.diff(file_ind) > max_gap + 1) | (np.diff(file_idx) != 0)) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(keys)]])
+
+    first = files[file_idx[0]]
+    inds = np.empty(len(keys), dtype=first['inds'].dtype)
+    images = np.empty((len(keys), *first['images'].shape[1:]), dtype='float32')
+    psfsize = np.empty((len(keys), *first['psfsize'].shape[1:]), dtype='float32')
+    for start, end in zip(starts, ends):
+        f = files[file_idx[start]]
+        block = slice(file_ind[start], file_ind[end - 1] + 1)
+        # Position of the requested rows within the block
+        rows = file_ind[start:end] - file_ind[start]
+        inds[order[start:end]] = f['inds'][block][rows]
+        images[order[start:end]] = f['images'][block][rows]
+        psfsize[order[start:end]] = f['psfsize'][block][rows]
+    return inds, images, psfsize
+
+def _processing_fn(args):
+    catalog, input_files, output_filename, block_reads, max_gap, chunk_cache_mb = args
+
+    if not os.path.exists(os.path.dirname(output_filename)):
+        os.makedirs(os.path.dirname(output_filename))
+
+    keys = catalog['internal_inds']
+
+    # Sort the input files by name
+    input_files = sorted(input_files)
+
+    # Open all the data files
+    if chunk_cache_mb is not None:
+        files = [h5py.File(file, 'r', rdcc_nbytes=chunk_cache_mb * 1024**2) for file in input_files]
+    else:
+        files = [h5py.File(file, 'r') for file in input_files]
+
+    if block_reads:
+        inds, image_array, image_psf_fwhm = _read_blocks(files, keys, max_gap=max_gap)
+        images = Table({
+            'object_id': keys,
+            'inds': inds,
+            'image_band': np.tile(np.array([f.lower().encode("utf-8") for f in _filters], dtype=_utf8_filter_type), (len(keys), 1)),
+            'image_array': image_array,
+            'image_psf_fwhm': image_psf_fwhm,
+            'image_scale': np.tile(np.array([_pixel_scale for f in _filters]).astype(np.float32), (len(keys), 1)),
+        })
+    else:
+        images = _read_rows(files, keys)
 
     # Close all the data files
     for file in files:
         file.close()
-    
+
     # Making sure we found the right number of images
     assert len(catalog) == len(images), "There was an error retrieving images"
     # Join on inds with the input catalog
@@ -97,8 +146,13 @@ def _processing_fn(args):
 
     return 1
 
-def save_in_standard_format(catalog_filename, sample_name, data_path, output_dir, num_processes=None):
+def save_in_standard_format(catalog_filename, sample_name, data_path, output_dir, num_processes=None,
+                            block_reads=False, max_gap=0, chunk_cache_mb=None):
     """ This function takes care of saving the dataset in the standard format used by the rest of the project
+
+    If `block_reads` is set, the images of each healpix group are read in sorted contiguous ranges
+    instead of one at a time in catalog order. `chunk_cache_mb` sets the size of the HDF5 chunk cache
+    of each input file in every worker process.
     """
     # Load the catalog
     catalog = Table.read(catalog_filename)
@@ -112,7 +166,7 @@ def save_in_standard_format(catalog_filename, sample_name, data_path, output_dir
     for group in groups.groups:
         # Create a filename for the group
         group_filename = os.path.join(output_dir, '{}/healpix={}/001-of-001.hdf5'.format(sample_name,group['healpix'][0]))
-        map_args.append((group, input_files, group_filename))
+        map_args.append((group, input_files, group_filename, block_reads, max_gap, chunk_cache_mb))
 
     print('Exporting aggregated dataset in hdf5 format to disk...')
 
@@ -170,7 +224,8 @@ def main(args):
             catalog.write(catalog_filename, overwrite=True)
 
         # Next step, export the data into the standard format
-        save_in_standard_format(catalog_filename, sample, args.data_path, args.output_dir, num_processes=args.num_processes)
+        save_in_standard_format(catalog_filename, sample, args.data_path, args.output_dir, num_processes=args.num_processes,
+                                block_reads=args.block_reads, max_gap=args.max_gap, chunk_cache_mb=args.chunk_cache_mb)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Builds a catalog for the DECaLS images of the stein et al. sample')
@@ -179,6 +234,9 @@ if __name__ == '__main__':
     parser.add_argument('--num_processes', type=int, default=1, help='Number of parallel processes to use')
     parser.add_argument('--only_north', action='store_true', help='Only process the north sample')
     parser.add_argument('--only_south', action='store_true', help='Only process the south sample')
+    parser.add_argument('--block_reads', action='store_true', help='Read images in sorted contiguous blocks instead of one at a time')
+    parser.add_argument('--max_gap', type=int, default=0, help='Maximum number of unrequested rows between two indices read in the same block')
+    parser.add_argument('--chunk_cache_mb', type=int, default=None, help='Size in MB of the HDF5 chunk cache of each input file, per process')
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -12,6 +12,7 @@ def main():
     parser.add_argument('--data_path', type=str, help="Data path for storing downloaded products.") # This is confusing is it required?
     parser.add_argument('--fits_output_path', type=str, help="Path to save the fits lightcurve data.")
     parser.add_argument('--pipeline', type=str, default='spoc', help=f"TESS pipeline to download. Options are {PIPELINES}. Defaults to 'spoc'.")
+    parser.add_argument('--trace_file', type=str, default=None, help="JSON-lines file to which per-healpix stage timings are appended.")
     args = parser.parse_args()
 
     if args.pipeline not in PIPELINES:
@@ -28,7 +29,8 @@ def main():
             data_path = args.data_path, 
             hdf5_output_dir = args.hdf5_output_path,
             fits_dir = args.fits_output_path,
-            n_processes = args.n_processes
+            n_processes = args.n_processes,
+            trace_file = args.trace_file
     )
     downloader.download_sector(tiny = args.tiny, show_progress = True, save_catalog = True)
         
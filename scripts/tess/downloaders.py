@@ -6,6 +6,7 @@ _CHUNK_SIZE = 8192
 
 import shutil
 import os 
+import sys
 from astropy.io import fits
 import numpy as np
 from astropy.table import Table, join, Row
@@ -19,6 +20,9 @@ import time
 import aiohttp
 import asyncio
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from instrumentation import BuildTracer, annotate, mark, record_input, record_objects, record_output, traced
+from ragged import write_ragged
 
 # In the inherited class - implement the correct data cleaning procedures.
 
@@ -47,6 +51,8 @@ class TESS_Downloader(ABC):
         Number of processes to use for parallel processing.
     async_downloads: bool,
         Whether the MAST should be queried asynchronously.
+    trace_file: str,
+        JSON-lines file to which per-healpix stage timings of the conversion are appended.
 
     Methods
     -------
@@ -66,7 +72,8 @@ class TESS_Downloader(ABC):
         Save the standardised batch of light curves dict in a hdf5 file
     '''
 
-    def __init__(self, sector: int, data_path: str, hdf5_output_dir: str, fits_dir: str, n_processes: int = 1, async_downloads: bool = True):   
+    def __init__(self, sector: int, data_path: str, hdf5_output_dir: str, fits_dir: str, n_processes: int = 1, async_downloads: bool = True,
+                 trace_file: str = None):   
         '''
         Initialisation for the TESS_Downloader class
         Parameters
@@ -85,6 +92,8 @@ class TESS_Downloader(ABC):
             Number of processes to use for parallel processing
         async_downloads: bool,
             Whether the MAST should be queried asynchronously
+        trace_file: str,
+            JSON-lines file to which per-healpix stage timings of the conversion are appended
 
         Returns
         -------
@@ -97,6 +106,7 @@ class TESS_Downloader(ABC):
         self.fits_dir = fits_dir
         self.n_processes = n_processes
         self.async_downloads = async_downloads
+        self.trace_file = trace_file
 
     def __repr__(self) -> str:
         return f"TESS_Downloader(sector={self.sector}, data_path={self.data_path}, hdf5_output_dir={self.hdf5_output_dir}, fits_dir={self.fits_dir}, n_processes={self.n_processes})"
@@ -175,6 +185,7 @@ class TESS_Downloader(ABC):
     ):
         pass
 
+    @traced
     def save_in_standard_format(self, args: tuple[Table, str], del_fits: bool = True) -> bool:
         '''
         Save the standardised batch of light curves dict in a hdf5 file 
@@ -189,30 +200,34 @@ class TESS_Downloader(ABC):
         '''
 
         subcatalog, output_filename = args
+        annotate(healpix=int(subcatalog['healpix'][0]))
         
         if not os.path.exists(os.path.dirname(output_filename)):
             os.makedirs(os.path.dirname(output_filename))
 
         results = [] 
         for row in tqdm(subcatalog):
+            record_input(os.path.join(self.fits_dir, self.fits_url(row)[1]))
             result = self.processing_fn(row, del_fits=del_fits)
             if result is not None: # Usually for files not found.
                 results.append(result)
+        mark('read')
 
-        max_length = max([len(d['time']) for d in results])
-
-        for i in range(len(results)):
-            for key in results[i].keys():
-                if isinstance(results[i][key], np.ndarray):
-                    results[i][key] = np.pad(results[i][key], (0,max_length - len(results[i][key])), mode='constant')
-
+        # Time series are stored as ragged columns of the `lightcurve` group, rather than padded to the
+        # longest light curve of the cell
+        series = [k for k, v in results[0].items() if isinstance(v, np.ndarray)]
         lightcurves = Table({k: [d[k] for d in results]
-                        for k in results[0].keys()})
+                        for k in results[0].keys() if k not in series})
         lightcurves.convert_unicode_to_bytestring()
+        mark('transform')
 
         with h5py.File(output_filename, 'w') as hdf5_file:
             for key in lightcurves.colnames:
                 hdf5_file.create_dataset(key, data=lightcurves[key])
+            write_ragged(hdf5_file, 'lightcurve', {k: [d[k] for d in results] for k in series})
+        mark('write')
+        record_output(output_filename)
+        record_objects(len(lightcurves))
         return 1
 
     @abstractmethod
@@ -477,8 +492,10 @@ class TESS_Downloader(ABC):
             group_filename = os.path.join(self.hdf5_output_dir, '{}/healpix={}/001-of-001.hdf5'.format(self.pipeline, group['healpix'][0]))
             map_args.append((group, group_filename))
 
+        tracer = BuildTracer(self.trace_file, name=f'tess_{self.pipeline}_{self.sector_str}')
         with Pool(self.n_processes) as pool:
-            results = list(tqdm(pool.imap(self.save_in_standard_format, map_args), total=len(map_args)))
+            results = list(tqdm(tracer.collect(pool.imap(self.save_in_standard_format, map_args)), total=len(map_args)))
+        tracer.close()
 
         if sum(results) != len(map_args):
             print("There was an error in the parallel processing of the fits files to standard format, some files may not have been processed correctly")
@@ -100,6 +100,34 @@ class CustomBuilderConfig(datasets.BuilderConfig):
         self.lc_features = lc_features
         self.base_features = base_features
 
+class _RaggedColumn:
+    """Column of variable-length rows, sliced from its flat values with the offsets of the rows"""
+
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+class _LightCurveFile:
+    """Columns of a file whose time series are stored as ragged columns of its `lightcurve` group"""
+
+    def __init__(self, data):
+        self.data = data
+        self.lightcurve = data["lightcurve"]
+        self.offsets = self.lightcurve["offsets"][:]
+
+    def __getitem__(self, key):
+        if key != "offsets" and key in self.lightcurve:
+            return _RaggedColumn(self.lightcurve[key], self.offsets)
+        return self.data[key]
+
+    def keys(self):
+        return [k for k in self.data if k != "lightcurve"] + [k for k in self.lightcurve if k != "offsets"]
+
+
 class TESS(datasets.GeneratorBasedBuilder):
     """TESS Full Frame Image Light Curves Dataset.
     
@@ -284,13 +312,17 @@ class TESS(datasets.GeneratorBasedBuilder):
                 # Preparing an index for fast searching through the catalog
                 sort_index = np.argsort(data["object_id"][:])
                 sorted_ids = data["object_id"][:][sort_index]
+
+                # Time series are stored either as ragged columns of the `lightcurve` group, read with
+                # their exact length, or padded to the longest light curve of the file
+                columns = _LightCurveFile(data) if isinstance(data.get("lightcurve"), h5py.Group) else data
                
                 for k in keys:
                     # Extract the indices of requested ids in the catalog
                     i = sort_index[np.searchsorted(sorted_ids, k)]
                     
                     # Build example based on pipeline type
-                    example = self._build_example(data, i)
+                    example = self._build_example(columns, i)
                     yield str(data["object_id"][i]), example
     
     def _build_example(self, data, i):
@@ -1,13 +1,14 @@
 # Small script to run the dataset preparation for all MultimodalUniverse datasets
-from datasets import load_dataset, Dataset
-from huggingface_hub import DatasetCardData, DatasetCard
+from huggingface_hub import DatasetCardData, DatasetCard, HfApi
 from glob import glob
-from functools import partial
-import pickle
-import sys
+import json
+import os
 import shutil
 import argparse
 
+from export_parquet import export_sample, select_shards
+from metadata import get_metadata
+
 # Define the destination folder where the scripts will be copied
 DESTINATION_FOLDER = "/mnt/ceph/users/polymathic/MultimodalUniverse"
 
@@ -21,6 +22,8 @@ if __name__ == "__main__":
     parser.add_argument("--copy", action="store_true", help="Copy the dataset to the destination folder")
     parser.add_argument("--destination", type=str, default=DESTINATION_FOLDER, help="Destination folder")
     parser.add_argument("--max_size", type=int, default=MAX_SIZE, help="Maximum size of the dataset to upload")
+    parser.add_argument("--parquet_dir", type=str, default="/tmp/mmu_parquet", help="Folder where the Parquet shards are exported before uploading")
+    parser.add_argument("--n_proc", type=int, default=1, help="Number of processes used to export the shards")
     args = parser.parse_args()
     only_cards = args.only_cards
     copy = args.copy
@@ -34,9 +37,6 @@ if __name__ == "__main__":
         datasets = [d.split('/')[-1].split('.py')[0] for d in datasets]
     print(f"Found {len(datasets)} datasets to upload: {datasets}")
 
-    def gen_from_iterable_dataset(iterable_ds):
-        yield from iterable_ds
-
     for dataset in datasets:
         print(f'Preparing {dataset} dataset')
 
@@ -47,35 +47,39 @@ if __name__ == "__main__":
             print("Copied file:", f"{dataset}/{dataset}.py")
 
         try:
-            dset = load_dataset(f'{destination}/{dataset}', 
-                                trust_remote_code=True, streaming=True, split='train')
-
-            # Extract the first element of the dataset to evaluate the size
-            top = next(iter(dset))
-            element_size = sys.getsizeof(pickle.dumps(top))
-            max_elements = int(max_size * 1e9 / element_size)
-            # TODO: Remove this line and instead use the max size to know how many elements to upload
-            max_elements = 100000
-            print(f"Element size: {element_size} bytes, so we can upload {max_elements} elements to the hub.")
-
-            if not only_cards:
-                # Restrict the dataset to the maximum number of elements as to remain within budget
-                dset = dset.take(max_elements)
-
-                ds = Dataset.from_generator(partial(gen_from_iterable_dataset, dset), 
-                                            features=dset.features,
-                                            cache_dir=f'/tmp/hf_cache/{dataset}')
-
-                # Save the dataset
-                ds.push_to_hub(f'MultimodalUniverse/{dataset}', config_name=dset.config_name)
+            info = get_metadata([dataset], scripts_dir=destination)[dataset]
+            export_dir = f"{args.parquet_dir}/{dataset}"
+            manifest_path = f"{export_dir}/manifest.json"
+
+            if only_cards:
+                # The card lists the configurations of the shards of a previous upload, if any
+                manifest = {'configs': {}}
+                if os.path.exists(manifest_path):
+                    with open(manifest_path) as f:
+                        manifest = json.load(f)
+                shards = select_shards(manifest, max_size * 1e9)
+            else:
+                # Shards are written with their exact size, so that the upload remains within budget
+                manifest = export_sample(f'{destination}/{dataset}', export_dir, n_proc=args.n_proc)
+                shards = select_shards(manifest, max_size * 1e9)
+                n_bytes = sum(shard['n_bytes'] for shard in shards)
+                print(f"Uploading {len(shards)} shards out of {sum(len(c['shards']) for c in manifest['configs'].values())}, "
+                      f"{n_bytes / 1e9:.2f} GB out of {manifest['n_bytes'] / 1e9:.2f} GB")
+                HfApi().upload_folder(folder_path=export_dir,
+                                      repo_id=f'MultimodalUniverse/{dataset}',
+                                      repo_type='dataset',
+                                      allow_patterns=[shard['path'] for shard in shards])
                 print(f"Dataset {dataset} uploaded to the hub")
+            configs = sorted({shard['path'].split('/')[0] for shard in shards})
 
             # Create the dataset card
             card = DatasetCardData(
-                description=dset.description,
-                homepage=dset.homepage,
-                version=dset.version.__str__(),
-                citation=dset.citation,
+                description=info['description'],
+                homepage=info['homepage'],
+                version=str(info['version']),
+                citation=info['citation'],
+                configs=[{'config_name': c, 'data_files': [{'split': 'train', 'path': f'{c}/train-*'}]}
+                         for c in configs],
             )
             content=f"""
     ---
@@ -84,11 +88,11 @@ if __name__ == "__main__":
 
     # {dataset.capitalize()} Dataset
 
-    {dset.license}
+    {info['license']}
 
-    {dset.description}
+    {info['description']}
 
-    {dset.citation}
+    {info['citation']}
     """
             c = DatasetCard(content)
             c.push_to_hub(f'MultimodalUniverse/{dataset}')